@@ -4,6 +4,7 @@ Model script for (C + Rc) || (L + Rl)
 
 import numpy as np
 from collections import OrderedDict
+from Models.modelcore import frequency_context
 
 j = 1j
 
@@ -32,11 +33,13 @@ def model(w, params):
     """
     # Extract individual component values from params list
     Rc, C, Rl, L = params
+    # Terms that depend on the frequencies only, computed once per grid
+    ctx = frequency_context(w)
     # This is the definition of the model impedance which we want to
     # fit to the data points.  Modify it to represent the circuit you
     # want to fit to the data.
-    Zlr = (j * w * L) + Rl
-    Zcr = 1/(j * w * C) + Rc
+    Zlr = (ctx.jw * L) + Rl
+    Zcr = 1/(ctx.jw * C) + Rc
     Y = 1/Zcr + 1/Zlr
     Z = 1 / Y
     return Z
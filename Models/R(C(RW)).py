@@ -3,6 +3,7 @@ Model script for R + (Q || (R + W))
 """
 import numpy as np
 from collections import OrderedDict
+from Models.modelcore import frequency_context
 
 j = 1j
 # Ordered dictionary of parameter names, initial guess values, and
@@ -11,6 +12,8 @@ j = 1j
 PINIT = 0       # index to init_val
 PBOUNDS = 1     # index to boundaries
 BOUNDWEIGHT = 6
+# fit log/normalized parameters, see modelcore.ParamTransform
+TRANSFORM = True
 PARAMS = OrderedDict([
     # name init_val (min,max)
     ('Rs',(500,(1e-3,1e3))),
@@ -29,13 +32,15 @@ def model(w,params):
     """
      # Extract individual component values from params list
      Rs,C,Rf,W = params
+     # Terms that depend on the frequencies only, computed once per grid
+     ctx = frequency_context(w)
      # This is the definition of the model impedance which we want to
      #  fit to the data points.  Modify it to represent the circuit you
      #  want to fit to the data.
      # Zq = 1 / ( Yq * (1j * w)**n )
-     Zc = 1 / (1j*w*C)
+     Zc = 1 / (ctx.jw*C)
 
-     Zw = W * w**(-0.5) * (1-j)
+     Zw = W * ctx.inv_sqrt_w * (1-j)
      Zrw = Rf + Zw
      # Zrw = Rf
      Yp = 1/Zc + 1/Zrw
@@ -44,3 +49,25 @@ def model(w,params):
      # print(Z)
 
      return Z
+
+
+def guess(w,Z,R_inf,peaks):
+     """
+    Starting values from the distribution of relaxation times of the data,
+    see drt.initial_guess.
+    :param w: radian frequency array
+    :param Z: complex impedance array of the data
+    :param R_inf: high-frequency resistance of the DRT
+    :param peaks: list of (tau, R) of the DRT peaks, largest R first
+    :return: list of component values in the order of PARAMS
+    """
+     tau, Rf = peaks[0]
+     # the regularized DRT underestimates R_inf; Re(Z) at the highest
+     # frequency is Rs plus what is left there of the relaxation
+     h = np.argmax(w)
+     Rs = max(R_inf, Z[h].real - Rf / (1 + (w[h] * tau) ** 2))
+     # at the lowest frequency the capacitive branch is nearly open and
+     # -Im(Z) is the Warburg term W / sqrt(w)
+     k = np.argmin(w)
+     W = max(-Z[k].imag, 0) * np.sqrt(w[k])
+     return [Rs, tau / Rf, Rf, W]
@@ -3,6 +3,7 @@ Model script for R + (C|| (R))
 """
 import numpy as np
 from collections import OrderedDict
+from Models.modelcore import frequency_context
 
 j = 1j
 # Ordered dictionary of parameter names, initial guess values, and
@@ -28,11 +29,13 @@ def model(w,params):
     """
      # Extract individual component values from params list
      Rs,C,Rf = params
+     # Terms that depend on the frequencies only, computed once per grid
+     ctx = frequency_context(w)
      # This is the definition of the model impedance which we want to
      #  fit to the data points.  Modify it to represent the circuit you
      #  want to fit to the data.
      # Zq = 1 / ( Yq * (1j * w)**n )
-     Zc = 1 / (1j*w*C)
+     Zc = 1 / (ctx.jw*C)
      # Zrw = Rf + Zw
      Yp = 1/Zc + 1/Rf
      Z = Rs + 1/Yp
@@ -40,3 +43,21 @@ def model(w,params):
      # print(Z)
 
      return Z
+
+
+def guess(w,Z,R_inf,peaks):
+     """
+    Starting values from the distribution of relaxation times of the data,
+    see drt.initial_guess.
+    :param w: radian frequency array
+    :param Z: complex impedance array of the data
+    :param R_inf: high-frequency resistance of the DRT
+    :param peaks: list of (tau, R) of the DRT peaks, largest R first
+    :return: list of component values in the order of PARAMS
+    """
+     tau, R = peaks[0]
+     # the regularized DRT underestimates R_inf; Re(Z) at the highest
+     # frequency is Rs plus what is left there of the relaxation
+     h = np.argmax(w)
+     Rs = max(R_inf, Z[h].real - R / (1 + (w[h] * tau) ** 2))
+     return [Rs, tau / R, R]
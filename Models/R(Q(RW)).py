@@ -3,6 +3,7 @@ Model script for Rs + (Q || (Rf + W))
 """
 import numpy as np
 from collections import OrderedDict
+from Models.modelcore import frequency_context
 
 j = 1j
 # Ordered dictionary of parameter names, initial guess values, and
@@ -11,6 +12,8 @@ j = 1j
 PINIT = 0       # index to init_val
 PBOUNDS = 1     # index to boundaries
 BOUNDWEIGHT = 10
+# fit log/normalized parameters, see modelcore.ParamTransform
+TRANSFORM = True
 PARAMS = OrderedDict([
     # name init_val (min,max)
     ('Rs',(490,(1,1e3))),
@@ -30,12 +33,14 @@ def model(w,params):
     """
      # Extract individual component values from params list
      Rs,Yq,n,Rf,W = params
+     # Terms that depend on the frequencies only, computed once per grid
+     ctx = frequency_context(w)
      # This is the definition of the model impedance which we want to
      #  fit to the data points.  Modify it to represent the circuit you
      #  want to fit to the data.
      # Zq = 1 / ( Yq * np.float_power((1j * w),n) )
-     Zq = np.divide(1,( Yq * np.float_power((1j * w),n) ))
-     Zw = W * w**(-0.5) * (1-j)
+     Zq = np.divide(1,( Yq * np.float_power(ctx.jw,n) ))
+     Zw = W * ctx.inv_sqrt_w * (1-j)
      Zrw = Rf + Zw
      Yp = 1/Zq + 1/Zrw
      Z = Rs + 1/Yp
@@ -43,3 +48,53 @@ def model(w,params):
      # print(Z)
 
      return Z
+
+
+def jacobian(w,params):
+     """
+    Derivatives of model() with respect to each parameter, used by the fitter
+    instead of finite differences.
+    :param w: radian frequency array
+    :param params: list of component values to apply to the model equations
+    :return: complex array, row k is dZ/dparams[k] for freqs w
+    """
+     Rs,Yq,n,Rf,W = params
+     # Terms that depend on the frequencies only, computed once per grid
+     ctx = frequency_context(w)
+     jwn = np.float_power(ctx.jw,n)
+     Zw1 = ctx.inv_sqrt_w * (1-j)
+     Zrw = Rf + W * Zw1
+     Yp = Yq * jwn + 1/Zrw
+     # Z = Rs + 1/Yp, so dZ/dx = -dYp/dx / Yp**2
+     dZdYp = -1 / (Yp * Yp)
+     dZ = np.empty((5, len(w)), dtype=np.complex128)
+     dZ[0] = 1
+     dZ[1] = dZdYp * jwn
+     dZ[2] = dZdYp * Yq * jwn * ctx.term('log_jw', lambda w: np.log(1j * w))
+     dZ[3] = dZdYp * -1 / (Zrw * Zrw)
+     dZ[4] = dZ[3] * Zw1
+     return dZ
+
+
+def guess(w,Z,R_inf,peaks):
+     """
+    Starting values from the distribution of relaxation times of the data,
+    see drt.initial_guess.  n is kept at PINIT; Yq follows from the peak
+    time constant, tau**n = Rf * Yq.
+    :param w: radian frequency array
+    :param Z: complex impedance array of the data
+    :param R_inf: high-frequency resistance of the DRT
+    :param peaks: list of (tau, R) of the DRT peaks, largest R first
+    :return: list of component values in the order of PARAMS
+    """
+     tau, Rf = peaks[0]
+     n = PARAMS['n'][PINIT]
+     # the regularized DRT underestimates R_inf; Re(Z) at the highest
+     # frequency is Rs plus what is left there of the relaxation
+     h = np.argmax(w)
+     Rs = max(R_inf, Z[h].real - Rf / (1 + (w[h] * tau) ** 2))
+     # at the lowest frequency the capacitive branch is nearly open and
+     # -Im(Z) is the Warburg term W / sqrt(w)
+     k = np.argmin(w)
+     W = max(-Z[k].imag, 0) * np.sqrt(w[k])
+     return [Rs, tau ** n / Rf, n, Rf, W]
@@ -0,0 +1,180 @@
+"""
+Forward-mode automatic differentiation of model scripts
+
+The models are complex valued, so the usual complex-step trick cannot be used
+to differentiate them.  Instead every parameter is replaced by a Dual number
+which carries the derivatives of its value with respect to all parameters.
+Evaluating model(w, params) once with Dual parameters then gives the complex
+impedance and the complete Jacobian dZ/dparams in one pass.
+
+Dual implements the arithmetic operators and the numpy ufuncs used by the
+model scripts (add, subtract, multiply, divide, power, float_power, sqrt, exp,
+log, reciprocal, ...).  A model doing something Dual does not support (e.g.
+writing into a preallocated array in place) raises TypeError, and
+jacobian_for() then returns None so that the fitter falls back to finite
+differences.  The fitter only uses it for model scripts that set
+AUTODIFF = True (see Models.registry).
+"""
+
+import numpy as np
+
+
+def _value(x):
+    return x.val if isinstance(x, Dual) else x
+
+
+def _der(x, ndim):
+    """
+    Derivative array of x, with axes inserted so that it broadcasts against
+    a result of ndim dimensions.  Constants have no derivative (None).
+    """
+    if not isinstance(x, Dual):
+        return None
+    der = x.der
+    missing = ndim - (der.ndim - 1)
+    if missing > 0:
+        der = der.reshape(der.shape[:1] + (1,) * missing + der.shape[1:])
+    return der
+
+
+def _chain(val, *terms):
+    """
+    Sum the non-constant derivative terms (der, factor) into a Dual of value val.
+    """
+    der = None
+    for d, factor in terms:
+        if d is None:
+            continue
+        d = d * factor
+        der = d if der is None else der + d
+    if der is None:
+        return val
+    return Dual(val, der)
+
+
+class Dual(object):
+    """
+    Value together with its derivatives along a leading parameter axis:
+    der[k] is d(val)/d(param k) and has the shape of val.
+    """
+
+    def __init__(self, val, der):
+        self.val = val
+        self.der = der
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        rule = _RULES.get(ufunc)
+        if method != '__call__' or rule is None or kwargs.get('out') is not None:
+            return NotImplemented
+        vals = [_value(x) for x in inputs]
+        val = ufunc(*vals)
+        ndim = np.ndim(val)
+        ders = [_der(x, ndim) for x in inputs]
+        return rule(val, vals, ders)
+
+    def __add__(self, other):
+        return np.add(self, other)
+
+    def __radd__(self, other):
+        return np.add(other, self)
+
+    def __sub__(self, other):
+        return np.subtract(self, other)
+
+    def __rsub__(self, other):
+        return np.subtract(other, self)
+
+    def __mul__(self, other):
+        return np.multiply(self, other)
+
+    def __rmul__(self, other):
+        return np.multiply(other, self)
+
+    def __truediv__(self, other):
+        return np.true_divide(self, other)
+
+    def __rtruediv__(self, other):
+        return np.true_divide(other, self)
+
+    def __pow__(self, other):
+        return np.power(self, other)
+
+    def __rpow__(self, other):
+        return np.power(other, self)
+
+    def __neg__(self):
+        return np.negative(self)
+
+    def __pos__(self):
+        return self
+
+
+def _power(val, vals, ders):
+    (a, b), (da, db) = vals, ders
+    terms = []
+    if da is not None:
+        terms.append((da, b * np.power(a, b - 1.0)))
+    if db is not None:
+        terms.append((db, val * np.log(a)))
+    return _chain(val, *terms)
+
+
+def _float_power(val, vals, ders):
+    (a, b), (da, db) = vals, ders
+    terms = []
+    if da is not None:
+        terms.append((da, b * np.float_power(a, b - 1)))
+    if db is not None:
+        terms.append((db, val * np.log(a)))
+    return _chain(val, *terms)
+
+
+_RULES = {
+    np.add: lambda val, v, d: _chain(val, (d[0], 1), (d[1], 1)),
+    np.subtract: lambda val, v, d: _chain(val, (d[0], 1), (d[1], -1)),
+    np.multiply: lambda val, v, d: _chain(val, (d[0], v[1]), (d[1], v[0])),
+    np.true_divide: lambda val, v, d: _chain(val, (d[0], 1 / v[1]), (d[1], -val / v[1])),
+    np.negative: lambda val, v, d: _chain(val, (d[0], -1)),
+    np.positive: lambda val, v, d: _chain(val, (d[0], 1)),
+    np.reciprocal: lambda val, v, d: _chain(val, (d[0], -val * val)),
+    np.square: lambda val, v, d: _chain(val, (d[0], 2 * v[0])),
+    np.sqrt: lambda val, v, d: _chain(val, (d[0], 0.5 / val)),
+    np.exp: lambda val, v, d: _chain(val, (d[0], val)),
+    np.log: lambda val, v, d: _chain(val, (d[0], 1 / v[0])),
+    np.power: _power,
+    np.float_power: _float_power,
+}
+
+
+def dual_params(params):
+    """
+    :param params: parameter values
+    :return: list of Dual numbers, seeded with the unit derivative of each parameter
+    """
+    seeds = np.eye(len(params))
+    return [Dual(np.float64(p), seeds[k]) for k, p in enumerate(params)]
+
+
+def jacobian_for(model, n_params):
+    """
+    Build a jacobian(w, params) function for a model by automatic differentiation.
+    :param model: model function, model(w, params)
+    :param n_params: number of model parameters
+    :return: function returning the complex (n_params, len(w)) array dZ/dparams,
+             or None when the model cannot be evaluated with Dual numbers
+    """
+    def jacobian(w, params):
+        Z = model(w, dual_params(params))
+        if not isinstance(Z, Dual):
+            return np.zeros((len(params), len(w)), dtype=np.complex128)
+        return np.broadcast_to(Z.der, (len(params), len(w)))
+
+    # Probe once on a small grid; unsupported operations raise here, not mid-fit
+    w = np.logspace(0, 4, 5)
+    try:
+        with np.errstate(all='ignore'):
+            jacobian(w, np.ones(n_params))
+    except (TypeError, ValueError, AttributeError):
+        return None
+    return jacobian
+
@@ -0,0 +1,426 @@
+"""
+Circuit strings compiled to model scripts
+
+Instead of writing a script in Models/ for every topology, a model can be
+named by its circuit.  Two notations are understood:
+
+    R(Q(RW))           Boukamp style: elements written next to each other
+                       are in series, the contents of a pair of parentheses
+                       in parallel, alternating with the nesting depth
+                       (R + (Q || (R + W)))
+    Rs-p(Q1,R1-W1)     "-" joins elements in series, p(a,b,...) puts its
+                       arguments in parallel; every element carries its own
+                       name (a type letter followed by a label).  The string
+                       must hold a "-" or a p(...), so that a mistyped model
+                       name such as Randles is not taken for one resistor
+
+The elements are
+
+    R   resistor              Z = R
+    C   capacitor             Z = 1/(jwC)
+    L   inductor              Z = jwL
+    Q   constant phase (CPE)  Z = 1/(Q (jw)^n), parameters Q and n
+    W   semi-infinite Warburg Z = W w^-0.5 (1-j)
+
+compile_circuit() turns a circuit into the source of an ordinary model
+script: PARAMS with the default guesses and bounds of DEFAULTS, a model()
+taking its frequency terms from frequency_context(), and an analytic
+jacobian().  The generated module is kept in memory and its source in
+CACHE_DIR, under a hash of the circuit string, the parameter overrides and
+GENERATOR_VERSION, so the other processes of a batch and later runs import
+it without generating it again.  Models.registry.get_model() compiles any name
+that is not a script in Models/ but parses as a circuit, so
+
+    python Zfit.py -f data -m "Rs-p(Q1,R1-W1)"
+
+fits a topology nobody has written a script for.  Parameter names are the
+element names of the dash notation; in Boukamp strings they are the type
+letter, numbered in order of appearance when a type occurs more than once
+(R(Q(RW)) gives R1, Q, n, R2, W).  The CPE exponent is called n followed by
+the label of its element.  The names become variables of the generated
+code, so a name that is not a Python identifier, is a keyword or is one of
+the RESERVED names of the generated script (Qp would give np) is rejected.
+"""
+
+import hashlib
+import importlib.util
+import keyword
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+
+MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
+# generated model scripts, one file per circuit; None keeps them in memory only
+CACHE_DIR = os.path.join(MODEL_DIR, '__circuits__')
+# changes whenever the generated code changes, so stale cache files are not used
+GENERATOR_VERSION = 2
+BOUNDWEIGHT = 10
+
+# default (init_val, (min, max)) of each parameter kind
+DEFAULTS = {
+    'R': (100.0, (1e-3, 1e9)),
+    'C': (1e-6, (1e-12, 1.0)),
+    'L': (1e-6, (1e-12, 1.0)),
+    'Q': (1e-5, (1e-12, 1.0)),
+    'n': (0.8, (0.3, 1.0)),
+    'W': (100.0, (1e-3, 1e7)),
+}
+ELEMENTS = 'RCLQW'
+# names the generated script defines itself, besides the z0, z1, ... of its nodes
+RESERVED = frozenset(['np', 'OrderedDict', 'frequency_context', 'j', 'CIRCUIT', 'PINIT',
+                      'PBOUNDS', 'BOUNDWEIGHT', 'PARAMS', 'model', 'jacobian', 'w', 'params', 'ctx', 'dZ'])
+
+_modules = {}
+_lock = threading.Lock()
+
+
+def _boukamp(text):
+    """
+    :return: circuit tree of a Boukamp style string
+    """
+    counts = dict((kind, text.count(kind)) for kind in ELEMENTS)
+    seen = dict((kind, 0) for kind in ELEMENTS)
+    pos = [0]
+
+    def group(depth):
+        items = []
+        while pos[0] < len(text) and text[pos[0]] != ')':
+            char = text[pos[0]]
+            pos[0] += 1
+            if char == '(':
+                items.append(group(depth + 1))
+                if pos[0] >= len(text):
+                    raise ValueError("unbalanced '(' in circuit %r" % text)
+                pos[0] += 1
+            else:
+                seen[char] += 1
+                label = str(seen[char]) if counts[char] > 1 else ''
+                items.append(('element', char, label))
+        if not items:
+            raise ValueError("empty group in circuit %r" % text)
+        if len(items) == 1:
+            return items[0]
+        return ('parallel' if depth % 2 else 'series', items)
+
+    tree = group(0)
+    if pos[0] != len(text):
+        raise ValueError("unbalanced ')' in circuit %r" % text)
+    return tree
+
+
+_TOKEN = re.compile(r'p\(|[A-Za-z]\w*|[-,()]')
+
+
+def _dashed(text):
+    """
+    :return: circuit tree of a string in the "-" / p(...) notation
+    """
+    tokens = _TOKEN.findall(text)
+    if ''.join(tokens) != text:
+        raise ValueError("unexpected characters in circuit %r" % text)
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else None
+
+    def take(expected=None):
+        token = peek()
+        if token is None or (expected is not None and token != expected):
+            raise ValueError("expected %r at token %d of circuit %r" % (expected or 'an element', pos[0], text))
+        pos[0] += 1
+        return token
+
+    def series():
+        items = [term()]
+        while peek() == '-':
+            take('-')
+            items.append(term())
+        return items[0] if len(items) == 1 else ('series', items)
+
+    def term():
+        token = take()
+        if token == 'p(':
+            items = [series()]
+            while peek() == ',':
+                take(',')
+                items.append(series())
+            take(')')
+            return items[0] if len(items) == 1 else ('parallel', items)
+        if token[0] not in ELEMENTS:
+            raise ValueError("unknown element %r in circuit %r, expected one of %s" % (token, text, ELEMENTS))
+        return ('element', token[0], token[1:])
+
+    tree = series()
+    if peek() is not None:
+        raise ValueError("unexpected %r in circuit %r" % (peek(), text))
+    return tree
+
+
+def parse(text):
+    """
+    :param text: circuit string, e.g. "R(Q(RW))" or "Rs-p(Q1,R1-W1)"
+    :return: tree of ('element', kind, label), ('series', [items]) and
+             ('parallel', [items]) nodes
+    """
+    text = re.sub(r'\s+', '', text)
+    if not text:
+        raise ValueError("empty circuit")
+    if re.match(r'^[%s()]+$' % ELEMENTS, text):
+        return _boukamp(text)
+    if '-' not in text and 'p(' not in text:
+        raise ValueError("%r is not a circuit: the dash notation needs a '-' or a p(...)" % text)
+    return _dashed(text)
+
+
+def is_circuit(text):
+    try:
+        parse(text)
+    except ValueError:
+        return False
+    return True
+
+
+def _elements(tree):
+    if tree[0] == 'element':
+        return [tree]
+    return [element for item in tree[1] for element in _elements(item)]
+
+
+def parameter_names(tree):
+    """
+    :return: list of (element, [parameter names]) in order of appearance
+    :raises ValueError: when a name occurs twice or cannot be a variable of the generated script
+    """
+    names = []
+    for element in _elements(tree):
+        kind, label = element[1], element[2]
+        names.append((element, [kind + label, 'n' + label] if kind == 'Q' else [kind + label]))
+    flat = [name for element, group in names for name in group]
+    for name in flat:
+        if (not name.isidentifier() or keyword.iskeyword(name) or name in RESERVED
+                or re.match(r'^z\d+$', name)):
+            raise ValueError("parameter name %r cannot be used, rename its element" % name)
+    duplicates = sorted(set(name for name in flat if flat.count(name) > 1))
+    if duplicates:
+        raise ValueError("parameter names %s occur more than once" % ', '.join(duplicates))
+    return names
+
+
+class _Writer(object):
+    """
+    Straight-line code of one circuit: an impedance variable per node, and
+    for jacobian() the factor dZ/dZnode of every element.
+    """
+
+    def __init__(self, tree):
+        self.lines = []
+        self.count = 0
+        self.params = OrderedDict()
+        for element, names in parameter_names(tree):
+            self.params[id(element)] = names
+        # (element, variable of its impedance, chain factors of its parallel branches)
+        self.leaves = []
+        self.root = self.node(tree, [])
+        self.frequency_dependent = any(element[1] != 'R' for element, z, chain in self.leaves)
+
+    def emit(self, expression):
+        name = 'z%d' % self.count
+        self.count += 1
+        self.lines.append('%s = %s' % (name, expression))
+        return name
+
+    def node(self, tree, chain):
+        """
+        :param chain: factors dZ/dZ(tree), one per enclosing parallel branch
+        :return: variable holding the impedance of tree
+        """
+        if tree[0] == 'element':
+            name = self.element(tree)
+            self.leaves.append((tree, name, chain))
+            return name
+        if tree[0] == 'series':
+            parts = [self.node(item, chain) for item in tree[1]]
+            return self.emit(' + '.join(parts))
+        # parallel: Z = 1/sum(1/Zi), dZ/dZi = (Z/Zi)**2; the factors refer to
+        # the parallel impedance, so its variable name is reserved up front
+        name = 'z%d' % self.count
+        self.count += 1
+        parts = []
+        for item in tree[1]:
+            factor = []
+            part = self.node(item, chain + [factor])
+            parts.append(part)
+            factor.append('(%s / %s)**2' % (name, part))
+        self.lines.append('%s = 1 / (%s)' % (name, ' + '.join('1/' + part for part in parts)))
+        return name
+
+    def element(self, tree):
+        kind = tree[1]
+        names = self.params[id(tree)]
+        if kind == 'R':
+            return names[0]
+        if kind == 'C':
+            return self.emit('1 / (ctx.jw * %s)' % names[0])
+        if kind == 'L':
+            return self.emit('ctx.jw * %s' % names[0])
+        if kind == 'Q':
+            return self.emit('1 / (%s * np.float_power(ctx.jw, %s))' % tuple(names))
+        return self.emit('%s * ctx.inv_sqrt_w * (1-j)' % names[0])
+
+    def derivatives(self):
+        """
+        :return: expression of dZ/dparam for every parameter, in PARAMS order
+        """
+        result = []
+        for element, z, chain in self.leaves:
+            kind = element[1]
+            names = self.params[id(element)]
+            factor = ' * '.join(f[0] for f in chain)
+            if kind == 'R':
+                own = ['1']
+            elif kind in ('C', 'Q'):
+                own = ['-%s / %s' % (z, names[0])]
+                if kind == 'Q':
+                    own.append("-%s * ctx.term('log_jw', lambda w: np.log(1j * w))" % z)
+            elif kind == 'L':
+                own = ['ctx.jw']
+            else:
+                own = ['ctx.inv_sqrt_w * (1-j)']
+            for own_term in own:
+                if not factor:
+                    result.append(own_term)
+                elif own_term == '1':
+                    result.append(factor)
+                else:
+                    result.append('%s * (%s)' % (factor, own_term))
+        return result
+
+
+def model_source(text, params=None):
+    """
+    :param text: circuit string
+    :param params: optional {name: (init_val, (min, max))} overriding DEFAULTS
+    :return: source of a model script for the circuit
+    """
+    tree = parse(text)
+    writer = _Writer(tree)
+    names = [name for element, group in parameter_names(tree) for name in group]
+    params = params or {}
+    unknown = sorted(set(params) - set(names))
+    if unknown:
+        raise ValueError("circuit %r has no parameters %s" % (text, ', '.join(unknown)))
+    entries = []
+    for name in names:
+        init, (lo, hi) = params.get(name, DEFAULTS[name[0]])
+        entries.append("    (%r, (%r, (%r, %r)))," % (name, float(init), float(lo), float(hi)))
+    body = ['    ' + line for line in writer.lines]
+    result = writer.root
+    if not writer.frequency_dependent:
+        # a purely resistive circuit still has one value per frequency
+        result = '%s + 0 * ctx.inv_sqrt_w' % result
+    unpack = '    %s = params' % (', '.join(names) if len(names) > 1 else names[0] + ',')
+    derivatives = ['    dZ[%d] = %s' % (k, expression) for k, expression in enumerate(writer.derivatives())]
+    return '\n'.join([
+        '"""',
+        'Model script for the circuit %s' % text,
+        'Generated by Models.circuit (version %d), do not edit.' % GENERATOR_VERSION,
+        '"""',
+        'import numpy as np',
+        'from collections import OrderedDict',
+        'from Models.modelcore import frequency_context',
+        '',
+        'j = 1j',
+        'CIRCUIT = %r' % text,
+        'PINIT = 0       # index to init_val',
+        'PBOUNDS = 1     # index to boundaries',
+        'BOUNDWEIGHT = %r' % BOUNDWEIGHT,
+        'PARAMS = OrderedDict([',
+        '    # name init_val (min,max)',
+    ] + entries + [
+        '])',
+        '',
+        '',
+        'def model(w, params):',
+        '    """',
+        '    Impedance of %s for all frequencies w.' % text,
+        '    :param w: radian frequency array',
+        '    :param params: list of component values, in PARAMS order',
+        '    :return: complex impedance array corresponding to freqs w',
+        '    """',
+        unpack,
+        '    ctx = frequency_context(w)',
+    ] + body + [
+        '    return %s' % result,
+        '',
+        '',
+        'def jacobian(w, params):',
+        '    """',
+        '    Derivatives of model() with respect to each parameter.',
+        '    :param w: radian frequency array',
+        '    :param params: list of component values, in PARAMS order',
+        '    :return: complex array, row k is dZ/dparams[k] for freqs w',
+        '    """',
+        unpack,
+        '    ctx = frequency_context(w)',
+    ] + body + [
+        '    dZ = np.empty((%d, len(w)), dtype=np.complex128)' % len(names),
+    ] + derivatives + [
+        '    return dZ',
+        '',
+    ])
+
+
+def _load(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _write(path, source):
+    """
+    Write the source atomically; several processes may compile the same circuit.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp, 'w', encoding='utf-8') as f:
+        f.write(source)
+    os.replace(temp, path)
+
+
+def compile_circuit(text, params=None):
+    """
+    Model script module of a circuit, generated on first use.
+    :param text: circuit string, see the module docstring
+    :param params: optional {name: (init_val, (min, max))} overriding DEFAULTS
+    :return: module with PARAMS, PINIT, PBOUNDS, BOUNDWEIGHT, model() and jacobian()
+    """
+    key = '%s\n%r\n%d' % (re.sub(r'\s+', '', text), sorted((params or {}).items()), GENERATOR_VERSION)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    with _lock:
+        module = _modules.get(digest)
+        if module is not None:
+            return module
+        name = 'Models.__circuits__.c_' + digest
+        path = os.path.join(CACHE_DIR, 'c_%s.py' % digest) if CACHE_DIR else None
+        source = None
+        if path is not None and not os.path.isfile(path):
+            source = model_source(text, params)
+            try:
+                _write(path, source)
+            except OSError:
+                path = None
+        if path is None:
+            source = source or model_source(text, params)
+            # no writable cache: compile the source into a module of its own
+            spec = importlib.util.spec_from_loader(name, loader=None)
+            module = importlib.util.module_from_spec(spec)
+            module.__file__ = '<circuit %s>' % text
+            exec(compile(source, module.__file__, 'exec'), module.__dict__)
+        else:
+            module = _load(name, path)
+        sys.modules[name] = module
+        _modules[digest] = module
+    return module
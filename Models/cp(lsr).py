@@ -4,6 +4,7 @@ Model script for C || (L + R)
 
 import numpy as np
 from collections import OrderedDict
+from Models.modelcore import frequency_context
 
 j = 1j
 
@@ -13,6 +14,8 @@ j = 1j
 PINIT = 0       # index to init_val
 PBOUNDS = 1     # index to boundaries
 BOUNDWEIGHT = 1e10
+# fit log/normalized parameters, see modelcore.ParamTransform
+TRANSFORM = True
 PARAMS = OrderedDict ([
     # name  init_val (min, max)
     ('R', (1e3, (0, np.inf))),
@@ -31,11 +34,13 @@ def model(w, params):
     """
     # Extract individual component values from params list
     R, C, L = params
+    # Terms that depend on the frequencies only, computed once per grid
+    ctx = frequency_context(w)
     # This is the definition of the model impedance which we want to
     # fit to the data points.  Modify it to represent the circuit you
     # want to fit to the data.
-    Zlr = (j * w * L) + R
-    Zc = 1/(j * w * C)
+    Zlr = (ctx.jw * L) + R
+    Zc = 1/(ctx.jw * C)
     Y = 1/Zc + 1/Zlr
     Z = 1 / Y
     return Z
@@ -4,6 +4,7 @@ Model script for C || R
 
 import numpy as np
 from collections import OrderedDict
+from Models.modelcore import frequency_context
 
 # Ordered dictionary of parameter names, initial guess values, and
 # min/max bounds. Use +/-np.inf for unbounded, set min = max to
@@ -11,6 +12,8 @@ from collections import OrderedDict
 PINIT = 0       # index to init_val
 PBOUNDS = 1     # index to boundaries
 BOUNDWEIGHT = 1e10
+# fit log/normalized parameters, see modelcore.ParamTransform
+TRANSFORM = True
 PARAMS = OrderedDict ([
     # name  init_val (min, max)
     ('R', (1e3, (0, np.inf))),
@@ -28,8 +31,10 @@ def model(w, params):
     """
     # Extract individual component values from params list
     R, C = params
+    # Terms that depend on the frequencies only, computed once per grid
+    ctx = frequency_context(w)
     # This is the definition of the model impedance which we want to
     # fit to the data points.  Modify it to represent the circuit you
     # want to fit to the data.
-    Y = 1.0/R + (1j * w * C)
+    Y = 1.0/R + (ctx.jw * C)
     return 1.0 / Y
@@ -0,0 +1,423 @@
+"""
+Fused evaluation of model scripts
+
+A model script builds its impedance from a handful of numpy operations, each
+of which allocates a new complex array of len(w) values, and recomputes the
+terms that depend on the frequencies only (1j*w, np.sqrt(w), w**-0.5, ...)
+on every call although the fitter evaluates it hundreds of times on the same
+grid.  Decorating the script's model with @fused
+
+    from Models.fusion import fused
+
+    @fused
+    def model(w, params):
+        ...
+
+makes the first call on a grid trace model() once with placeholder
+parameters.  The trace is a straight list of ufunc calls from which
+
+    - every value that does not depend on the parameters is computed once
+      and kept (frequency-only terms, constant arrays, trans_line1's branch
+      factors),
+    - repeated identical subexpressions are computed once (trans_line1
+      evaluates the same skin impedance in every segment),
+    - the remaining operations write into a few preallocated buffers, reused
+      as soon as a value is no longer needed, instead of fresh temporaries.
+
+When numba is installed the remaining operations are instead compiled into a
+single loop over the frequencies, so that no intermediate array is written at
+all.  The results are the same operations in the same order as model() itself.
+
+Only plain evaluations are fused: one 1-D float parameter vector on a grid of
+at least MIN_POINTS frequencies: 512 with numba, 20000 without it, below
+which the numpy plan saves too little to pay for itself.  Dual parameters
+(Models.autodiff), batches of parameter vectors (modelcore.fit_batch) and
+smaller grids go to model() directly, as does any model whose trace fails:
+one that branches on a parameter value, writes into an array in place or
+uses a numpy function other than the ufuncs in SUPPORTED.
+
+The bundled model scripts are not decorated.  Their spectra have tens to a
+few hundred points, where the decorator only adds its checks to every call,
+and the numba kernel has not been measured against them.  Time a script
+with benchmarks/bench_fusion.py before decorating it for large grids.
+"""
+
+import functools
+import importlib.util
+import threading
+from operator import itemgetter
+
+import numpy as np
+
+SUPPORTED = frozenset([np.add, np.subtract, np.multiply, np.true_divide, np.negative, np.positive,
+                       np.reciprocal, np.square, np.sqrt, np.exp, np.log, np.power, np.float_power])
+
+# compile the fused plan with numba when it is installed
+USE_NUMBA = True
+HAVE_NUMBA = importlib.util.find_spec('numba') is not None
+# grids smaller than this are evaluated by model() itself.  Without numba the
+# buffered numpy plan only breaks even with model() at about 20000 points
+# (benchmarks/bench_fusion.py)
+MIN_POINTS = 512 if USE_NUMBA and HAVE_NUMBA else 20000
+# plans kept per model, one per frequency grid
+MAX_PLANS = 4
+
+
+class _Node(object):
+    """
+    Placeholder for one value of a traced model evaluation.  varies is True
+    when the value depends on the parameters.
+    """
+
+    def __init__(self, trace, value, varies, index):
+        self.trace = trace
+        self.value = value
+        self.varies = varies
+        self.index = index
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if method != '__call__' or kwargs or ufunc not in SUPPORTED:
+            return NotImplemented
+        return self.trace.op(ufunc, inputs)
+
+    def __array_function__(self, func, types, args, kwargs):
+        return NotImplemented
+
+    def __array__(self, *args, **kwargs):
+        raise TypeError("a traced value cannot be converted to an array")
+
+    def __bool__(self):
+        raise TypeError("a model branching on a parameter value cannot be fused")
+
+    def __len__(self):
+        if self.varies:
+            raise TypeError("the length of a parameter dependent value is not known")
+        return len(self.value)
+
+    def __add__(self, other):
+        return np.add(self, other)
+
+    def __radd__(self, other):
+        return np.add(other, self)
+
+    def __sub__(self, other):
+        return np.subtract(self, other)
+
+    def __rsub__(self, other):
+        return np.subtract(other, self)
+
+    def __mul__(self, other):
+        return np.multiply(self, other)
+
+    def __rmul__(self, other):
+        return np.multiply(other, self)
+
+    def __truediv__(self, other):
+        return np.true_divide(self, other)
+
+    def __rtruediv__(self, other):
+        return np.true_divide(other, self)
+
+    def __pow__(self, other):
+        return np.power(self, other)
+
+    def __rpow__(self, other):
+        return np.power(other, self)
+
+    def __neg__(self):
+        return np.negative(self)
+
+    def __pos__(self):
+        return self
+
+
+class _Trace(object):
+    """
+    Operations recorded while model() runs on _Node placeholders.  Every
+    operation is also evaluated on the real values, so the shape and dtype
+    of every node are known.
+    """
+
+    def __init__(self):
+        self.nodes = []
+        # (ufunc, operands) of every node, None for the inputs
+        self.ops = []
+        self.memo = {}
+
+    def input(self, value, varies):
+        node = _Node(self, value, varies, len(self.nodes))
+        self.nodes.append(node)
+        self.ops.append(None)
+        return node
+
+    def op(self, ufunc, inputs):
+        key = [ufunc]
+        for x in inputs:
+            if isinstance(x, _Node):
+                if x.trace is not self:
+                    return NotImplemented
+                key.append(('node', x.index))
+            elif isinstance(x, (int, float, complex, np.generic)):
+                key.append(('const', type(x), x))
+            elif isinstance(x, np.ndarray):
+                # the operands are kept in self.ops, so the id is not reused
+                key.append(('array', id(x)))
+            else:
+                return NotImplemented
+        key = tuple(key)
+        node = self.memo.get(key)
+        if node is None:
+            value = ufunc(*[x.value if isinstance(x, _Node) else x for x in inputs])
+            varies = any(isinstance(x, _Node) and x.varies for x in inputs)
+            node = self.memo[key] = _Node(self, value, varies, len(self.nodes))
+            self.nodes.append(node)
+            self.ops.append((ufunc, inputs))
+        return node
+
+
+class _Plan(object):
+    """
+    Evaluation of one traced model on one frequency grid.
+
+    The varying operations run in trace order over a list of slot values:
+    slot k < n_params holds parameter k, the other slots the constants and
+    the results of earlier operations.  Array results are written into
+    per-thread buffers, the final result into a new array.
+    """
+
+    def __init__(self, trace, params, out, w):
+        # the grid is recognised by identity first (the fitter passes the same
+        # array on every call), then by value
+        self.source = w
+        self.w = w.copy()
+        self.n_params = len(params)
+        self.kernel = None
+        nodes, ops = trace.nodes, trace.ops
+        if not (isinstance(out, _Node) and out.varies):
+            self.constant = np.asarray(out.value if isinstance(out, _Node) else out)
+            return
+        self.constant = None
+        needed = self._needed(nodes, ops, out)
+        slot = dict((node.index, k) for k, node in enumerate(params))
+        self.slots = [node.value for node in params]
+        self.steps = []
+        # array buffers, (shape, dtype) each, and the free ones per (shape, dtype)
+        self.layout = []
+        free = {}
+        buffer_of = {}
+        last_use = {}
+        for i in needed:
+            for x in ops[i][1]:
+                if isinstance(x, _Node) and x.varies:
+                    last_use[x.index] = i
+        for i in needed:
+            ufunc, operands = ops[i]
+            refs = []
+            for x in operands:
+                if isinstance(x, _Node) and x.varies:
+                    refs.append(slot[x.index])
+                else:
+                    refs.append(len(self.slots))
+                    self.slots.append(x.value if isinstance(x, _Node) else x)
+            for x in operands:
+                if isinstance(x, _Node) and last_use.get(x.index) == i and x.index in buffer_of:
+                    spec = self.layout[buffer_of[x.index]]
+                    free.setdefault(spec, []).append(buffer_of.pop(x.index))
+            value = nodes[i].value
+            buf = None
+            if i != out.index and isinstance(value, np.ndarray) and value.ndim > 0:
+                spec = (value.shape, value.dtype)
+                if free.get(spec):
+                    buf = free[spec].pop()
+                else:
+                    buf = len(self.layout)
+                    self.layout.append(spec)
+                buffer_of[i] = buf
+            slot[i] = len(self.slots)
+            self.slots.append(None)
+            self.steps.append((ufunc, itemgetter(*refs), len(refs) == 1, slot[i], buf))
+        self.result = slot[out.index]
+        self.local = threading.local()
+        if USE_NUMBA:
+            self.kernel = _compile(self, nodes, ops, needed, params, out)
+
+    @staticmethod
+    def _needed(nodes, ops, out):
+        """
+        :return: indices of the varying operations out depends on, in trace order
+        """
+        needed = set()
+        stack = [out.index]
+        while stack:
+            i = stack.pop()
+            if i in needed or ops[i] is None or not nodes[i].varies:
+                continue
+            needed.add(i)
+            stack.extend(x.index for x in ops[i][1] if isinstance(x, _Node))
+        return sorted(needed)
+
+    def __call__(self, params):
+        if self.constant is not None:
+            return self.constant.copy()
+        if self.kernel is not None:
+            return self.kernel(np.asarray(params, dtype=np.float64))
+        buffers = getattr(self.local, 'buffers', None)
+        if buffers is None:
+            buffers = self.local.buffers = [np.empty(shape, dtype) for shape, dtype in self.layout]
+        values = list(self.slots)
+        values[:self.n_params] = params
+        for ufunc, operands, unary, target, buf in self.steps:
+            args = operands(values)
+            if unary:
+                args = (args,)
+            if buf is None:
+                values[target] = ufunc(*args)
+            else:
+                values[target] = ufunc(*args, out=buffers[buf])
+        return values[self.result]
+
+
+# scalar expression of each ufunc in a generated kernel
+_EXPRESSIONS = {
+    np.add: '({0} + {1})', np.subtract: '({0} - {1})', np.multiply: '({0} * {1})',
+    np.true_divide: '({0} / {1})', np.negative: '(-{0})', np.positive: '(+{0})',
+    np.reciprocal: '(1.0 / {0})', np.square: '({0} * {0})', np.sqrt: 'np.sqrt({0})',
+    np.exp: 'np.exp({0})', np.log: 'np.log({0})', np.power: '({0} ** {1})',
+    np.float_power: '({0} ** {1})',
+}
+
+
+def kernel_source(nodes, ops, needed, params, out):
+    """
+    Python source of a kernel(p, out, a0, a1, ...) evaluating the varying
+    operations: the parameter-only values once, the array values element by
+    element in one loop over the frequencies.  The constant arrays a0, a1, ...
+    are passed in, the constant scalars are globals c0, c1, ... of the kernel,
+    so that inf and nan need no literal.
+    :return: (source, constant arrays, {global name: constant scalar}), None
+             when an operand is an array that does not have the shape of the result
+    """
+    n = len(out.value)
+    names = dict((node.index, 'p[%d]' % k) for k, node in enumerate(params))
+    arrays = []
+    constants = {}
+    before, loop = [], []
+    for i in needed:
+        ufunc, operands = ops[i]
+        args = []
+        for x in operands:
+            value = x.value if isinstance(x, _Node) else x
+            if isinstance(x, _Node) and x.varies:
+                args.append(names[x.index])
+            elif np.ndim(value) == 0:
+                name = 'c%d' % len(constants)
+                constants[name] = complex(value) if np.iscomplexobj(value) else float(value)
+                args.append(name)
+            elif np.shape(value) == (n,):
+                args.append('a%d[i]' % len(arrays))
+                arrays.append(value)
+            else:
+                return None
+        value = nodes[i].value
+        names[i] = 't%d' % i
+        line = '%s = %s' % (names[i], _EXPRESSIONS[ufunc].format(*args))
+        if np.ndim(value) == 0:
+            before.append('    ' + line)
+        elif np.shape(value) == (n,):
+            loop.append('        ' + line)
+        else:
+            return None
+    loop.append('        out[i] = %s' % names[out.index])
+    arguments = ''.join(', a%d' % k for k in range(len(arrays)))
+    source = '\n'.join(['def kernel(p, out%s):' % arguments] + before +
+                       ['    for i in range(%d):' % n] + loop) + '\n'
+    return source, arrays, constants
+
+
+def _compile(plan, nodes, ops, needed, params, out):
+    """
+    :return: kernel(params) -> impedance array compiled with numba, None when
+             numba is not installed or cannot compile the plan
+    """
+    try:
+        import numba
+    except ImportError:
+        return None
+    generated = kernel_source(nodes, ops, needed, params, out)
+    if generated is None:
+        return None
+    source, arrays, constants = generated
+    namespace = {'np': np}
+    namespace.update(constants)
+    try:
+        exec(compile(source, '<fused kernel>', 'exec'), namespace)
+        compiled = numba.njit(error_model='numpy', cache=False)(namespace['kernel'])
+        shape, dtype = out.value.shape, out.value.dtype
+
+        def kernel(p):
+            result = np.empty(shape, dtype)
+            compiled(p, result, *arrays)
+            return result
+        # compile now, so that a failure falls back to the numpy plan
+        kernel(np.array([node.value for node in params], dtype=np.float64))
+    except Exception:
+        return None
+    return kernel
+
+
+def _trace(model, w, params):
+    trace = _Trace()
+    w_node = trace.input(w, False)
+    param_nodes = [trace.input(np.float64(p), True) for p in params]
+    out = model(w_node, param_nodes)
+    return _Plan(trace, param_nodes, out, w)
+
+
+def fused(model):
+    """
+    Decorator for the model(w, params) of a model script, see the module docstring.
+    The undecorated function is available as model.plain.
+    """
+    plans = []
+    lock = threading.Lock()
+    state = {'failed': False}
+
+    def plan_for(w, params):
+        for plan in plans:
+            if plan.source is w and plan.n_params == len(params):
+                return plan
+        for plan in plans:
+            if plan.w.shape == w.shape and plan.n_params == len(params) and np.array_equal(plan.w, w):
+                plan.source = w
+                return plan
+        with lock:
+            try:
+                plan = _trace(model, w, params)
+            except Exception:
+                state['failed'] = True
+                return None
+            plans.insert(0, plan)
+            del plans[MAX_PLANS:]
+        return plan
+
+    @functools.wraps(model)
+    def wrapper(w, params):
+        if (state['failed'] or type(w) is not np.ndarray or w.ndim != 1 or len(w) < MIN_POINTS
+                or w.dtype != np.float64 or not _plain_params(params)):
+            return model(w, params)
+        plan = plan_for(w, params)
+        if plan is None:
+            return model(w, params)
+        return plan(params)
+
+    wrapper.plain = model
+    return wrapper
+
+
+def _plain_params(params):
+    """
+    :return: True for one vector of real parameter values
+    """
+    if isinstance(params, np.ndarray):
+        return params.ndim == 1 and params.dtype.kind == 'f'
+    return isinstance(params, (list, tuple)) and all(type(p) in (float, int, np.float64) for p in params)
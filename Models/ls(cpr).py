@@ -4,6 +4,7 @@ Model script for L + (C || R)
 
 import numpy as np
 from collections import OrderedDict
+from Models.modelcore import frequency_context
 
 j = 1j
 
@@ -29,9 +30,11 @@ def model(w, params):
     """
     # Extract individual component values from params list
     Ls, Cp, Rp = params
+    # Terms that depend on the frequencies only, computed once per grid
+    ctx = frequency_context(w)
     # This is the definition of the model impedance which we want to
     # fit to the data points.  Modify it to represent the circuit you
     # want to fit to the data.
-    Ycp = (j * w * Cp) + 1/Rp
-    Z = 1 / Ycp + (j * w * Ls)
+    Ycp = (ctx.jw * Cp) + 1/Rp
+    Z = 1 / Ycp + (ctx.jw * Ls)
     return Z
@@ -4,6 +4,7 @@ Model script for L + R
 
 import numpy as np
 from collections import OrderedDict
+from Models.modelcore import frequency_context
 
 j = 1j
 
@@ -30,8 +31,10 @@ def model(w, params):
     """
     # Extract individual component values from params list
     R, L = params
+    # Terms that depend on the frequencies only, computed once per grid
+    ctx = frequency_context(w)
     # This is the definition of the model impedance which we want to
     # fit to the data points.  Modify it to represent the circuit you
     # want to fit to the data.
-    Z = (j * w * L) + R
+    Z = (ctx.jw * L) + R
     return Z
@@ -4,6 +4,7 @@ Model script for Ls + Rs + (Cp || Rp)
 
 import numpy as np
 from collections import OrderedDict
+from Models.modelcore import frequency_context
 
 j = 1j
 
@@ -13,6 +14,8 @@ j = 1j
 PINIT = 0       # index to init_val
 PBOUNDS = 1     # index to boundaries
 BOUNDWEIGHT = 1000
+# fit log/normalized parameters, see modelcore.ParamTransform
+TRANSFORM = True
 PARAMS = OrderedDict ([
     # name  init_val (min, max)
     ('Ls', (200e-9, (0, np.inf))),
@@ -32,9 +35,11 @@ def model(w, params):
     """
     # Extract individual component values from params list
     Ls, Rs, Cp, Rp = params
+    # Terms that depend on the frequencies only, computed once per grid
+    ctx = frequency_context(w)
     # This is the definition of the model impedance which we want to
     # fit to the data points.  Modify it to represent the circuit you
     # want to fit to the data.
-    Ycp = (j * w * Cp) + 1/Rp
-    Z = 1/Ycp + (j * w * Ls) + Rs
+    Ycp = (ctx.jw * Cp) + 1/Rp
+    Z = 1/Ycp + (ctx.jw * Ls) + Rs
     return Z
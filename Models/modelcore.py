@@ -1,5 +1,12 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
 import numpy as np
-from scipy.optimize import leastsq
+from scipy.optimize import leastsq, least_squares
+from numpy.linalg import LinAlgError
+from Models.registry import ModelSpec, model_spec
 
 """
 Core modeling functions common to all modeling scripts
@@ -12,71 +19,906 @@ Two types of weighting are applied here:
 2. Model weighting, which is used to obtain closer model fitting in specified
    frequency regions.  This weighting is applied graphically from the main GUI.
 
-This module makes several references to objects in the model script, but to avoid
-duplicating it in each model it is made into a separate module here.  The linkage is
-as follows:
-1. This module is imported in Zfit when it is first loaded
-2. The module script is dynamically reloaded in Zfit every time Model is clicked
-3. Zfit dynamically assigns the unresolved references from this module to the model.
-   This allows this module to access the model as required.
+This module only holds the fitting machinery; everything that belongs to a model
+(model(), PARAMS, PINIT, PBOUNDS, BOUNDWEIGHT) is read from the model script and
+carried by a Fitter instance, never stored in this module.  Each call therefore
+works on its own state, so several models can be fitted at the same time from
+threads or from a long-running service.
 """
 
-def _residuals(params, w, Z, m_weight):
+# frequency grids whose FrequencyContext is kept, least recently used dropped first
+MAX_CONTEXTS = 16
+
+_contexts = OrderedDict()
+_contexts_lock = threading.Lock()
+_recent = threading.local()
+
+
+class FrequencyContext(object):
+    """
+    Terms of a model that depend on the frequency grid only (1j*w, np.sqrt(w),
+    w**-0.5, a fixed load impedance, ...), computed on first use and then
+    kept for every later call on the same grid.  A model script gets the
+    context of its grid with frequency_context(w):
+
+        ctx = frequency_context(w)
+        Zw = W * ctx.inv_sqrt_w * (1-j)
+        Zl = ctx.term('load', lambda w: np.full(len(w), 49.9 + 0j))
+
+    The cached arrays are shared by every fit on the grid and are read-only.
+    A term is cached under its name together with the code of fn and the
+    values it closes over or takes as defaults, so two models using the same
+    name for different terms, a model script edited and reloaded, or one
+    term factory called with different arguments never get each other's
+    array.
+    """
+
+    def __init__(self, w):
+        """
+        :param w: radian frequency array
+        """
+        self.w = w
+        self.terms = {}
+
+    def term(self, name, fn):
+        """
+        :param name: name of the term in this context
+        :param fn: function of w computing the term on first use
+        :return: fn(w), computed once per grid
+        """
+        key = _term_key(name, fn)
+        value = self.terms.get(key)
+        if value is None:
+            value = fn(self.w)
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+            self.terms[key] = value
+        return value
+
+    @property
+    def jw(self):
+        return self.term('jw', lambda w: 1j * w)
+
+    @property
+    def sqrt_w(self):
+        return self.term('sqrt_w', np.sqrt)
+
+    @property
+    def inv_sqrt_w(self):
+        return self.term('inv_sqrt_w', lambda w: w**(-0.5))
+
+
+def _term_key(name, fn):
+    """
+    :return: cache key of FrequencyContext.term(name, fn); fn itself when the
+             values it depends on cannot be hashed
+    """
+    code = getattr(fn, '__code__', None)
+    if code is None:
+        return name, fn
+    values = tuple(cell.cell_contents for cell in fn.__closure__ or ()) + (fn.__defaults__ or ())
+    values = tuple((v.dtype.str, v.shape, v.tobytes()) if isinstance(v, np.ndarray) else v for v in values)
+    key = (name, code, values)
+    try:
+        hash(key)
+    except TypeError:
+        return name, fn
+    return key
+
+
+def frequency_context(w):
+    """
+    FrequencyContext of a frequency grid, shared by all fits on an identical
+    grid (the files of a sweep usually are) and kept for the MAX_CONTEXTS
+    most recently used grids.  The grid is recognised by identity first, as
+    the fitter passes the same array on every call, then by value; a grid
+    must therefore not be changed in place once it has been used.
+    Anything but a 1-D ndarray (e.g. the placeholders traced by
+    Models.fusion) gets a context of its own that is not kept.
+    :param w: radian frequency array
+    :return: FrequencyContext
+    """
+    if type(w) is not np.ndarray or w.ndim != 1:
+        return FrequencyContext(w)
+    recent = getattr(_recent, 'context', None)
+    if recent is not None and (recent[0] is w or recent[1].w is w):
+        return recent[1]
+    key = (w.dtype.str, w.tobytes())
+    with _contexts_lock:
+        context = _contexts.get(key)
+        if context is None:
+            grid = w.copy()
+            grid.setflags(write=False)
+            context = _contexts[key] = FrequencyContext(grid)
+            while len(_contexts) > MAX_CONTEXTS:
+                _contexts.popitem(last=False)
+        else:
+            _contexts.move_to_end(key)
+    _recent.context = (w, context)
+    return context
+
+
+def _residuals(params, model, w, Z, m_weight):
     """
     This is the error function minimized by leastsq.  It should return the
     difference between the model and the data, not the square.
     :param params: tuple of variables to supply to model()
+    :param model: model function, model(w, params)
     :param w: radian frequency array
     :param Z: impedance data to match
     :return:
     """
     # Get difference between model and target, apply modeling weight
-    diff = Z - model(w, params)
+    diff = np.asarray(Z - model(w, params), dtype=np.complex128)
     diff *= m_weight
-    diff.astype(np.complex128)
-    # Split complex result into real & imag parts to minimize both
-    zd = np.zeros(Z.size*2, dtype=np.float64)
-    zd[0:zd.size:2] = diff.real.astype(np.float64)
-    zd[1:zd.size:2] = diff.imag.astype(np.float64)
-    return zd
+    # Split complex result into real & imag parts to minimize both; a complex
+    # array viewed as float64 already holds them interleaved
+    return diff.view(np.float64)
 
 def _penalties(params, bounds, b_weight):
     # Build an array with number of parameters elements, 0 if the
     # parameter is within bounds and how far out if not:
-    penalties = [np.fmin(x-lo, 0) + np.fmax(0, x-hi) for x, (lo, hi) in zip(params, bounds)]
+    lo, hi = np.array(bounds, dtype=np.float64).T
+    penalties = np.fmin(params - lo, 0) + np.fmax(0, params - hi)
     # Scale for how much it should hurt if you're out of bounds
-    return b_weight * np.array(penalties)
+    return b_weight * penalties
 
 
-def _b_residuals(params, w, Z, m_weight, bounds, b_weight):
+def _b_residuals(params, model, w, Z, m_weight, bounds, b_weight):
     """
     Create array of residuals including "penalty" elements when parameter
     min/max limits are exceeded.
     :param params: parameters adjusted to fit
+    :param model: model function, model(w, params)
     :param w: radian frequency array
     :param Z: target complex impedance array
     :return: array of residuals plus penalties
     """
-    ba = np.hstack((_residuals(params, w, Z, m_weight), _penalties(params, bounds, b_weight)))
+    ba = np.hstack((_residuals(params, model, w, Z, m_weight), _penalties(params, bounds, b_weight)))
     return ba
 
 
-def fit_model(Z, m_weight, f):
+class _ResidualEngine(object):
+    """
+    _b_residuals and its Jacobian (laid out for leastsq(..., col_deriv=1): one
+    row per parameter) for the duration of one fit, writing into buffers
+    allocated once instead of building new arrays on every call.
+    The residual buffer is a float64 array whose first 2*len(Z) elements are
+    also viewed as complex, so Z - model(w, params) lands directly in the
+    interleaved real/imag layout leastsq minimizes.
+
+    With b_weight=None the penalty elements are left out altogether, for
+    optimizers that enforce the bounds themselves.
+
+    Every call returns the same buffer, overwritten by the next call.  leastsq
+    with a Jacobian copies what it is given into its own work arrays, so it can
+    use the buffers directly.  Callers that keep the arrays between calls must
+    copy them: least_squares, and leastsq estimating the Jacobian by finite
+    differences, which would otherwise difference the buffer against itself
+    (see Fitter._fit_leastsq and Fitter._fit_trf).
+    """
+
+    def __init__(self, model, w, Z, m_weight, lower, upper, b_weight, jacobian=None):
+        """
+        :param model: model function, model(w, params)
+        :param w: radian frequency array
+        :param Z: target complex impedance array
+        :param m_weight: array of modeling weights to apply to residuals
+        :param lower: array of lower parameter bounds
+        :param upper: array of upper parameter bounds
+        :param b_weight: penalty weight, already scaled by the number of samples, None for no penalties
+        :param jacobian: function returning the complex dZ/dparams array, jacobian(w, params)
+        """
+        n, m = len(lower), Z.size
+        n_pen = n if b_weight is not None else 0
+        self.model = model
+        self.w = w
+        self.Z = np.ascontiguousarray(Z, dtype=np.complex128)
+        self.m_weight = np.asarray(m_weight, dtype=np.float64)
+        self.lower = lower
+        self.upper = upper
+        self.b_weight = b_weight
+        self.model_jacobian = jacobian
+        self.out = np.empty(m*2 + n_pen, dtype=np.float64)
+        self.diff = self.out[:m*2].view(np.complex128)
+        self.pen = self.out[m*2:]
+        self.scratch = np.empty(n, dtype=np.float64)
+        self.jd = np.zeros((n, m*2 + n_pen), dtype=np.float64) if jacobian is not None else None
+        self.jdiag = np.arange(n_pen), m*2 + np.arange(n_pen)
+
+    def residuals(self, params):
+        np.subtract(self.Z, self.model(self.w, params), out=self.diff)
+        self.diff *= self.m_weight
+        if self.b_weight is None:
+            return self.out
+        # b_weight * (fmin(x-lo, 0) + fmax(0, x-hi)), see _penalties
+        np.subtract(params, self.lower, out=self.scratch)
+        np.fmin(self.scratch, 0, out=self.pen)
+        np.subtract(params, self.upper, out=self.scratch)
+        np.fmax(self.scratch, 0, out=self.scratch)
+        self.pen += self.scratch
+        self.pen *= self.b_weight
+        return self.out
+
+    def jacobian(self, params):
+        m = self.Z.size
+        dz = self.jd[:, :m*2].view(np.complex128)
+        np.multiply(self.model_jacobian(self.w, params), self.m_weight, out=dz)
+        np.negative(dz, out=dz)
+        if self.b_weight is None:
+            return self.jd
+        # A penalty grows with slope b_weight once its parameter leaves the bounds
+        self.jd[self.jdiag] = self.b_weight * ((params < self.lower) | (params > self.upper))
+        return self.jd
+
+
+class ParamTransform(object):
+    """
+    Map between model parameters x and the variables u the optimizer works on.
+    Parameters of one model easily span 12 orders of magnitude (C1=200e-12
+    next to R1=100), which the optimizer handles badly when it steps them
+    directly.  Each parameter is therefore moved to a space where it is of
+    order one:
+    - u = log(x) when the lower bound is strictly positive and the bounds span
+      at least LOG_RATIO (three decades),
+    - u = (x - min) / (max - min) when both bounds are finite,
+    - u = x / |PINIT| otherwise.
+    Narrow positive ranges stay linear: the log map bends the cost surface of
+    resonant models such as xdcr2 and makes them converge more slowly.
+    With enabled=False u = x.  Works on (n_params,) and (n_spectra, n_params) arrays.
+    """
+
+    LOG_RATIO = 1e3
+
+    def __init__(self, init_val, lower, upper, enabled=True):
+        n = len(init_val)
+        self.log = np.zeros(n, dtype=bool)
+        self.offset = np.zeros(n)
+        self.scale = np.ones(n)
+        self.identity = not enabled
+        if not enabled:
+            return
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.log = (lower > 0) & (upper / lower >= self.LOG_RATIO)
+        finite = np.isfinite(lower) & np.isfinite(upper) & (upper > lower) & ~self.log
+        self.offset = np.where(finite, lower, 0.0)
+        self.scale = np.where(finite, upper - lower,
+                              np.where(init_val != 0, np.abs(init_val), 1.0))
+        self.scale[self.log] = 1.0
+
+    def to_u(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        u = (x - self.offset) / self.scale
+        u[..., self.log] = np.log(x[..., self.log])
+        return u
+
+    def to_x(self, u):
+        u = np.asarray(u, dtype=np.float64)
+        x = u * self.scale + self.offset
+        x[..., self.log] = np.exp(u[..., self.log])
+        return x
+
+    def dx_du(self, x):
+        """
+        :param x: parameters, as returned by to_x()
+        :return: derivative of each parameter with respect to its own u
+        """
+        d = np.broadcast_to(self.scale, np.shape(x)).copy()
+        d[..., self.log] = np.asarray(x)[..., self.log]
+        return d
+
+    def covariance(self, cov_u, x):
+        """
+        :param cov_u: covariance matrix in u space, or None
+        :param x: parameters the covariance belongs to
+        :return: covariance matrix of the parameters x
+        """
+        if cov_u is None:
+            return None
+        d = self.dx_du(x)
+        return cov_u * np.outer(d, d)
+
+
+class Fitter(object):
+    """
+    Fitting context for one model.  The parameter metadata comes from the
+    model's ModelSpec (see Models.registry), which is computed once when the
+    model script is loaded.  A Fitter is not modified by fit(), so one instance
+    may be shared between threads.
+
+    Two solver backends are available:
+    'leastsq': MINPACK Levenberg-Marquardt, bounds enforced softly through
+               BOUNDWEIGHT penalties (the default)
+    'trf':     scipy.optimize.least_squares trust-region-reflective, using the
+               (min, max) tuples in PARAMS as hard bounds, no penalties
+    A model script picks its backend with BACKEND = 'trf'; the backend
+    argument (Backend in config.ini) overrides it.
+
+    With transform=True both backends step the parameters in the space of
+    ParamTransform (log for wide positive bounds); the results and their
+    covariance are mapped back to the model parameters.  The transform helps
+    some models and hurts others (see benchmarks/bench_transform.py), so it
+    is opt-in: a model script turns it on with TRANSFORM = True, and the
+    transform argument (Transform in config.ini) overrides it.
+
+    The Jacobian is the model script's jacobian(w, params) if it declares one,
+    else the automatically differentiated model (see Models.autodiff) if the
+    script sets AUTODIFF = True.  Without either, or with jacobian=False, it is
+    estimated by finite differences, costing n_params+1 model calls per
+    iteration.  A Dual evaluation costs several model calls, so autodiff saves
+    far more model calls than time and is slower for most bundled models
+    (see benchmarks/bench_jacobian.py): it is opt-in like the transform.
+    """
+
+    def __init__(self, model, jacobian=True, backend=None, transform=None, maxfev=None):
+        """
+        :param model: ModelSpec from Models.registry.get_model(), or a model script module
+        :param jacobian: use the analytic/automatic Jacobian when the model has one
+        :param backend: 'leastsq' or 'trf', None for the model's BACKEND or 'leastsq'
+        :param transform: fit in the scaled space of ParamTransform, None for the model's TRANSFORM
+        :param maxfev: limit of residual evaluations, None for the backend's default
+        """
+        if not isinstance(model, ModelSpec):
+            model = model_spec(model)
+        self.spec = model
+        self.model = model.model
+        self.keys = model.keys
+        self.init_val = model.init_val
+        self.bounds = model.bounds
+        self.boundweight = model.boundweight
+        self.jacobian = model.jacobian if jacobian else None
+        self.backend = backend or model.backend or 'leastsq'
+        if self.backend not in ('leastsq', 'trf'):
+            raise ValueError("unknown fitting backend %r" % self.backend)
+        if transform is None:
+            transform = model.transform
+        self.transform = ParamTransform(self.init_val, model.lower, model.upper, transform)
+        self.maxfev = maxfev
+
+    def fit(self, Z, m_weight, f, p0=None):
+        """
+        Fit the model to impedance data Z over frequency range f
+        :param Z: impedance array to fit
+        :param m_weight: array of modeling weights to apply to residuals
+        :param f: Hz frequency array
+        :param p0: starting parameters, e.g. the result of a neighbouring spectrum; default PINIT
+        :return: output in the format of leastsq whichever backend is used, see
+        http://docs.scipy.org/doc/scipy-0.14.0/reference/generated/scipy.optimize.leastsq.html
+        The infodict also holds the parameter uncertainties, see parameter_errors().
+        """
+        # Convert f to angular freq; the context's copy of the grid is the same
+        # array for every file measured on this grid
+        w = frequency_context(2 * np.pi * np.asarray(f, dtype=np.float64)).w
+        p0 = self.init_val if p0 is None else np.asarray(p0, dtype=np.float64)
+        if self.backend == 'trf':
+            result = self._fit_trf(w, Z, m_weight, p0)
+        else:
+            result = self._fit_leastsq(w, Z, m_weight, p0)
+        result[2].update(parameter_errors(result[1], result[2]['fvec'], 2 * np.size(Z)))
+        return result
+
+    def _fit_leastsq(self, w, Z, m_weight, p0):
+        # Scale penalty weight by number of residual samples
+        b_weight = len(w) * self.boundweight
+        engine = _ResidualEngine(self.model, w, Z, m_weight, self.spec.lower, self.spec.upper,
+                                 b_weight, self.jacobian)
+        residuals, jacobian = self._in_u_space(engine)
+        t = self.transform
+        # a log parameter must start strictly inside its bounds; the others may
+        # start outside, the penalty term pulls them back
+        u0 = t.to_u(np.where(t.log, np.clip(p0, self.spec.lower, self.spec.upper), p0))
+        if jacobian is None:
+            # the finite differences keep the residuals of the current point
+            def fun(u):
+                return residuals(u).copy()
+            u, cov_u, infodict, mesg, ier = leastsq(fun, u0,
+                           full_output=True, maxfev=self.maxfev or 1000000,ftol=1e-12,factor=0.1)
+        else:
+            u, cov_u, infodict, mesg, ier = leastsq(residuals, u0, Dfun=jacobian,
+                           col_deriv=1, full_output=True, maxfev=self.maxfev or 1000000,ftol=1e-12,factor=0.1)
+        x = t.to_x(u)
+        return x, t.covariance(cov_u, x), infodict, mesg, ier
+
+    def _in_u_space(self, engine):
+        """
+        :return: residual and col_deriv Jacobian functions of u, the latter None
+                 when the Jacobian is left to finite differences
+        """
+        t = self.transform
+        if t.identity:
+            return engine.residuals, (engine.jacobian if self.jacobian is not None else None)
+
+        def residuals(u):
+            return engine.residuals(t.to_x(u))
+
+        def jacobian(u):
+            x = t.to_x(u)
+            # out of place: the engine's buffer must not be scaled in place
+            return engine.jacobian(x) * t.dx_du(x)[:, np.newaxis]
+
+        return residuals, (jacobian if self.jacobian is not None else None)
+
+    def _fit_trf(self, w, Z, m_weight, p0):
+        lower, upper = self.spec.lower, self.spec.upper
+        # least_squares wants lower < upper; min = max fixes a value, so give it
+        # the smallest possible room
+        upper = np.where(upper > lower, upper, np.nextafter(lower, np.inf))
+        t = self.transform
+        engine = _ResidualEngine(self.model, w, Z, m_weight, lower, upper, None, self.jacobian)
+        residuals, jacobian = self._in_u_space(engine)
+        # least_squares keeps the residuals and Jacobian of the current point
+        # while it evaluates trial points, so the engine buffers are copied
+        def fun(u):
+            return residuals(u).copy()
+
+        if jacobian is None:
+            jac = '2-point'
+        else:
+            def jac(u):
+                return jacobian(u).T.copy()
+        with np.errstate(divide='ignore'):
+            lower_u, upper_u = t.to_u(lower), t.to_u(upper)
+        u0 = np.clip(t.to_u(np.clip(p0, lower, upper)), lower_u, upper_u)
+        res = least_squares(fun, u0, jac=jac, bounds=(lower_u, upper_u), method='trf',
+                            x_scale='jac', ftol=1e-12, xtol=1e-12, gtol=1e-12, max_nfev=self.maxfev or 100000)
+        # Translate to the leastsq output tuple so callers need not care which backend ran
+        try:
+            cov_u = np.linalg.inv(res.jac.T @ res.jac)
+        except np.linalg.LinAlgError:
+            cov_u = None
+        infodict = {'nfev': res.nfev, 'njev': res.njev or 0, 'fvec': res.fun,
+                    'active_mask': res.active_mask}
+        ier = {-1: 0, 0: 5}.get(res.status, res.status)
+        x = t.to_x(res.x)
+        return x, t.covariance(cov_u, x), infodict, res.message, ier
+
+
+def parameter_errors(cov_x, fvec, n_residuals):
+    """
+    Standard errors and correlations of the fitted parameters.  The covariance
+    returned by the optimizers is (J^T J)^-1; scaled by the residual variance
+    s**2 = sum(fvec**2) / (n_residuals - n_params) it estimates the covariance
+    of the parameters.  Penalty elements of fvec are zero inside the bounds and
+    do not count as residuals.
+    :param cov_x: covariance matrix as returned by Fitter.fit(), or None
+    :param fvec: final residuals
+    :param n_residuals: number of data residuals, 2 * number of frequencies
+    :return: dict of 'pcov' (scaled covariance), 'stderr' (sqrt of its
+             diagonal) and 'corr' (correlation matrix), all None when the
+             optimizer gave no covariance (singular Jacobian)
+    """
+    if cov_x is None:
+        return {'pcov': None, 'stderr': None, 'corr': None}
+    n = len(cov_x)
+    dof = n_residuals - n
+    s2 = np.sum(np.asarray(fvec) ** 2) / dof if dof > 0 else np.nan
+    pcov = cov_x * s2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stderr = np.sqrt(np.diag(pcov))
+        corr = pcov / np.outer(stderr, stderr)
+    return {'pcov': pcov, 'stderr': stderr, 'corr': corr}
+
+
+def bootstrap(model, Z, m_weight, f, params, n_samples, mode='residual', seed=None, fitter=None):
+    """
+    Resampling estimate of the parameter uncertainties of a finished fit.  Each
+    replicate spectrum is the fitted model plus
+    - 'residual':   the fit residuals drawn with replacement over the frequencies
+    - 'montecarlo': normal noise of the residual variance, real and imaginary
+    and every replicate is refitted, warm-started from params.  With a fitter
+    the replicates are fitted one by one with its backend, Jacobian and
+    transform, the settings the original fit used.  Without one they are
+    refitted together by fit_batch(), which costs a few batched iterations
+    per replicate but uses forward differences in the model parameters and
+    may end in a worse minimum than Fitter.fit() (see fit_batch()).
+    :param model: ModelSpec or model script module
+    :param params: fitted parameters of Z
+    :param n_samples: number of replicates
+    :param mode: 'residual' or 'montecarlo'
+    :param seed: seed of the random generator
+    :param fitter: Fitter of the model to refit the replicates with, None for fit_batch()
+    :return: (standard deviation of each parameter over the replicates,
+              (n_samples, n_params) array of the refitted parameters)
+    """
+    spec = model if isinstance(model, ModelSpec) else model_spec(model)
+    if mode not in ('residual', 'montecarlo'):
+        raise ValueError("unknown bootstrap mode %r" % mode)
+    w = frequency_context(2 * np.pi * np.asarray(f, dtype=np.float64)).w
+    Zfit = spec.model(w, np.asarray(params, dtype=np.float64))
+    residual = np.asarray(Z) - Zfit
+    rng = np.random.default_rng(seed)
+    if mode == 'residual':
+        Zb = Zfit + residual[rng.integers(0, len(residual), (n_samples, len(residual)))]
+    else:
+        sigma = np.sqrt(np.sum(np.abs(residual) ** 2) / max(2 * len(residual) - len(params), 1))
+        Zb = Zfit + sigma * (rng.standard_normal((n_samples, len(residual))) +
+                             1j * rng.standard_normal((n_samples, len(residual))))
+    if fitter is None:
+        samples, info = fit_batch(spec, Zb, m_weight, f, p0=params)
+    else:
+        samples = np.array([fitter.fit(z, m_weight, f, params)[0] for z in Zb])
+    return np.std(samples, axis=0, ddof=1), samples
+
+
+def fit_model(model, Z, m_weight, f, backend=None, transform=None, p0=None, maxfev=None):
     """
     Entry point to fit model to impedance data Z over frequency range f
+    :param model: ModelSpec or model script module
     :param Z: impedance array to fit
     :param m_weight: array of modeling weights to apply to residuals
     :param f: Hz frequency array
-    :return: output from leastsq, see
-    http://docs.scipy.org/doc/scipy-0.14.0/reference/generated/scipy.optimize.leastsq.html
-    """
-    # Convert f to angular freq
-    w = 2 * np.pi * f
-    # Extract the guess values out of the PARAMS values tuple
-    init_val = [elem[PINIT] for elem in PARAMS.values()]
-    # Extract bounds list of tuples from PARAMS values tuple
-    bounds = [elem[PBOUNDS] for elem in PARAMS.values()]
-    # Scale penalty weight by number of residual samples
-    b_weight = len(w) * BOUNDWEIGHT
-    return leastsq(_b_residuals, init_val, args=(w, Z, m_weight, bounds, b_weight),
-                   full_output=True, maxfev=1000000,ftol=1e-12,factor=0.1)
+    :param backend: 'leastsq' or 'trf', see Fitter
+    :param transform: fit in the scaled space of ParamTransform, None for the model's TRANSFORM
+    :param p0: starting parameters, default PINIT
+    :param maxfev: limit of residual evaluations, None for the backend's default
+    :return: output from leastsq, see Fitter.fit(); ier is 5 when maxfev ran out
+    """
+    return Fitter(model, backend=backend, transform=transform, maxfev=maxfev).fit(Z, m_weight, f, p0)
+
+
+# multistart: a start agrees with the best fit when its cost is within this
+# relative distance (or below MULTISTART_RTOL**2 * sum(|Z|**2), an exact fit),
+# and the search stops once MULTISTART_AGREE starts agree
+MULTISTART_RTOL = 1e-4
+MULTISTART_AGREE = 3
+# residual evaluations allowed per start; a start sampled far off wanders for
+# long, the best start is finished without limit when it ran out
+MULTISTART_MAXFEV = 2000
+# generations of the optional differential evolution stage
+DE_MAXITER = 30
+
+
+def _search_box(spec):
+    """
+    :return: (ParamTransform, lower u, upper u) of the PBOUNDS box; both ends
+             are the PINIT value for parameters with an infinite bound
+    """
+    t = ParamTransform(spec.init_val, spec.lower, spec.upper)
+    box = np.isfinite(spec.lower) & np.isfinite(spec.upper)
+    u0 = t.to_u(spec.init_val)
+    lo = np.where(box, t.to_u(np.where(box, spec.lower, spec.init_val)), u0)
+    hi = np.where(box, t.to_u(np.where(box, spec.upper, spec.init_val)), u0)
+    return t, lo, hi
+
+
+def sample_starts(spec, n, method='sobol', seed=None):
+    """
+    Starting points spread over the PBOUNDS box.  Points are drawn uniformly in
+    the space of ParamTransform, so parameters whose bounds span three decades
+    or more are sampled log-uniformly.  Parameters with an infinite bound keep
+    their PINIT value.
+    :param spec: ModelSpec
+    :param n: number of points
+    :param method: 'sobol' or 'lhs' (Latin hypercube), see scipy.stats.qmc
+    :param seed: seed of the sampler
+    :return: (n, n_params) array of starting parameters
+    """
+    from scipy.stats import qmc
+
+    t, lo, hi = _search_box(spec)
+    if method == 'sobol':
+        sampler = qmc.Sobol(len(lo), seed=seed)
+        # Sobol points are balanced in powers of two
+        unit = sampler.random_base2(int(np.ceil(np.log2(max(n, 1)))))[:n]
+    elif method == 'lhs':
+        unit = qmc.LatinHypercube(len(lo), seed=seed).random(n)
+    else:
+        raise ValueError("unknown sampling method %r" % method)
+    return t.to_x(lo + unit * (hi - lo))
+
+
+def _evolve(spec, w, Z, m_weight, seed=None):
+    """
+    Differential evolution of the bound-penalized cost over the PBOUNDS box,
+    each generation evaluated as one batch_model() call.
+    :return: best parameters found
+    """
+    from scipy.optimize import differential_evolution
+
+    t, lo, hi = _search_box(spec)
+    u0 = t.to_u(spec.init_val)
+    b_weight = len(w) * spec.boundweight
+
+    def cost(U):
+        P = t.to_x(np.atleast_2d(U.T))
+        with np.errstate(all='ignore'):
+            r = _batch_residuals(P, spec.model, w, Z, m_weight, spec.lower, spec.upper, b_weight)
+            c = np.sum(r ** 2, axis=1)
+        return np.where(np.isfinite(c), c, np.inf)
+
+    res = differential_evolution(cost, list(zip(lo, hi)), maxiter=DE_MAXITER, polish=False,
+                                 vectorized=True, updating='deferred', seed=seed, x0=u0)
+    return t.to_x(res.x)
+
+
+def _fit_start(args):
+    """
+    Fit one start of multistart() in a pool worker, the model looked up by name.
+    """
+    from Models.registry import get_model
+
+    name, Z, m_weight, f, backend, transform, p0 = args
+    fitter = Fitter(get_model(name), backend=backend, transform=transform, maxfev=MULTISTART_MAXFEV)
+    with np.errstate(all='ignore'):
+        return fitter.fit(Z, m_weight, f, p0)
+
+
+def multistart(model, Z, m_weight, f, n_starts=16, method='sobol', workers=1, backend=None,
+               transform=None, evolve=False, seed=None):
+    """
+    Global search: local fits from PINIT and from n_starts points sampled over
+    the PBOUNDS box (sample_starts), the best one kept.  The search stops early
+    once MULTISTART_AGREE fits have ended within MULTISTART_RTOL of the lowest
+    cost, i.e. once several starts have found the same minimum; a well-posed
+    fit then costs about MULTISTART_AGREE local fits.
+    Each start may take MULTISTART_MAXFEV residual evaluations.
+    :param model: ModelSpec or model script module
+    :param n_starts: number of sampled starting points besides PINIT
+    :param method: 'sobol' or 'lhs'
+    :param workers: processes fitting starts at the same time, 1 = in this process
+    :param backend: 'leastsq' or 'trf', see Fitter
+    :param transform: fit in the scaled space of ParamTransform, None for the model's TRANSFORM
+    :param evolve: first run a short differential evolution over the box and
+                   start from its best point before PINIT
+    :param seed: seed of the sampler and of the evolution
+    :return: output of fit_model() for the best start; the infodict also holds
+             'starts' (fits run) and 'start_costs' (their final costs)
+    """
+    spec = model if isinstance(model, ModelSpec) else model_spec(model)
+    starts = [spec.init_val]
+    if evolve:
+        w = frequency_context(2 * np.pi * np.asarray(f, dtype=np.float64)).w
+        starts.insert(0, _evolve(spec, w, np.asarray(Z), m_weight, seed))
+    starts.extend(sample_starts(spec, n_starts, method, seed))
+
+    costs, best = [], None
+    atol = MULTISTART_RTOL ** 2 * float(np.sum(np.abs(np.asarray(Z) * m_weight) ** 2))
+
+    def converged(result):
+        nonlocal best
+        cost = float(np.sum(result[2]['fvec'] ** 2))
+        costs.append(cost)
+        if best is None or cost < best[0]:
+            best = (cost, result)
+        agree = sum(c <= best[0] * (1 + MULTISTART_RTOL) + atol for c in costs)
+        return agree >= MULTISTART_AGREE
+
+    if workers == 1:
+        fitter = Fitter(spec, backend=backend, transform=transform, maxfev=MULTISTART_MAXFEV)
+        for p0 in starts:
+            # a start far from the data steps through overflowing models
+            with np.errstate(all='ignore'):
+                result = fitter.fit(Z, m_weight, f, p0)
+            if converged(result):
+                break
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_fit_start, (spec.name, Z, m_weight, f, backend, transform, p0))
+                       for p0 in starts]
+            for future in as_completed(futures):
+                if converged(future.result()):
+                    for pending in futures:
+                        pending.cancel()
+                    break
+
+    result = best[1]
+    if result[4] == 5:
+        # maxfev ran out
+        result = fit_model(spec, Z, m_weight, f, backend=backend, transform=transform, p0=result[0])
+    result[2]['starts'] = len(costs)
+    result[2]['start_costs'] = np.array(costs)
+    return result
+
+
+class CallStats(object):
+    """
+    Wrap a function, counting its calls and the time spent in them.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.calls = 0
+        self.seconds = 0.0
+
+    def __call__(self, *args):
+        start = time.perf_counter()
+        try:
+            return self.fn(*args)
+        finally:
+            self.calls += 1
+            self.seconds += time.perf_counter() - start
+
+
+def fit_model_profiled(model, Z, m_weight, f, backend=None, transform=None, p0=None, maxfev=None):
+    """
+    fit_model() with the model and Jacobian calls counted and timed.  Only this
+    entry point pays for the bookkeeping; fit_model() itself is untouched.
+    :return: (output of fit_model, dict of metrics): fit_s (wall time),
+             model_calls / model_s and jacobian_calls / jacobian_s (calls of
+             model() and jacobian() and the time spent in them), nfev, njev,
+             ier, mesg, cost (final sum of squares) and residual_norm
+    """
+    spec = model if isinstance(model, ModelSpec) else model_spec(model)
+    counted = copy.copy(spec)
+    counted.model = CallStats(spec.model)
+    counted.jacobian = CallStats(spec.jacobian) if spec.jacobian is not None else None
+    start = time.perf_counter()
+    result = fit_model(counted, Z, m_weight, f, backend=backend, transform=transform, p0=p0, maxfev=maxfev)
+    elapsed = time.perf_counter() - start
+    infodict = result[2]
+    cost = float(np.sum(infodict['fvec'] ** 2))
+    metrics = {'fit_s': elapsed,
+               'model_calls': counted.model.calls, 'model_s': counted.model.seconds,
+               'jacobian_calls': counted.jacobian.calls if counted.jacobian else 0,
+               'jacobian_s': counted.jacobian.seconds if counted.jacobian else 0.0,
+               'nfev': int(infodict['nfev']), 'njev': int(infodict.get('njev', 0)),
+               'ier': int(result[4]), 'mesg': str(result[3]),
+               'cost': cost, 'residual_norm': float(np.sqrt(cost))}
+    return result, metrics
+
+
+def batch_model(model, w, params):
+    """
+    Evaluate a model for many parameter sets in one call.  The model scripts are
+    written for a single parameter vector, but use nothing except broadcasting
+    arithmetic; handing them every parameter as an (n_spectra, 1) column makes
+    each expression evaluate all spectra at once.
+    :param model: model function, model(w, params)
+    :param w: radian frequency array
+    :param params: (n_spectra, n_params) array of parameter sets
+    :return: (n_spectra, len(w)) complex impedance array
+    """
+    Zm = model(w, params.T[:, :, np.newaxis])
+    return np.broadcast_to(Zm, (params.shape[0], w.size))
+
+
+def _batch_residuals(P, model, w, Z, m_weight, lower, upper, b_weight):
+    """
+    _b_residuals for a stack of parameter sets: row s holds the residuals and
+    penalties of P[s] against Z[s], in the same layout as _b_residuals.
+    """
+    diff = (Z - batch_model(model, w, P)) * m_weight
+    r = np.empty((P.shape[0], w.size*2 + P.shape[1]), dtype=np.float64)
+    # a C-ordered complex row viewed as float64 is already real/imag interleaved
+    r[:, :w.size*2] = np.ascontiguousarray(diff, dtype=np.complex128).view(np.float64)
+    r[:, w.size*2:] = b_weight * (np.fmin(P - lower, 0) + np.fmax(0, P - upper))
+    return r
+
+
+def fit_batch(model, Z, m_weight, f, p0=None, maxiter=500, ftol=1e-10, xtol=1e-10, fitter=None,
+              refit_ratio=10.0):
+    """
+    Fit one model to many spectra measured on the same frequency grid.  All
+    spectra are stepped together by a vectorized Levenberg-Marquardt loop:
+    every iteration costs one batched model evaluation for the trial steps and
+    one for the forward-difference Jacobians of the spectra that moved.  Each
+    spectrum stops on its own once it has converged.  As in MINPACK, the
+    damping of each parameter is scaled by the largest diagonal element of
+    J^T J seen so far.  Spectra still running after maxiter iterations, and
+    spectra whose cost relative to |Z|^2 is far above the median of the batch,
+    are fitted again one by one with fitter from their start, and the better
+    of both results is kept.
+
+    The batched loop has no analytic Jacobian and no parameter transform, and
+    on the models with many coupled parameters it ends in a worse local
+    minimum than Fitter.fit() more often: in benchmarks/bench_batch.py
+    without the refits, cost above twice that of the single fits on 15% of
+    the spectra of (csr)p(lsr) and on about 1% of rp(csr)p(lsr), trans_line1
+    and trans_line2, none on the other models.  The refits bring this down
+    to the odd spectrum, but they are single fits: where they are many, the
+    batch is little faster than fitting the spectra one by one.
+    :param model: ModelSpec or model script module
+    :param Z: (n_spectra, len(f)) impedance array to fit
+    :param m_weight: array of modeling weights, (len(f),) or (n_spectra, len(f))
+    :param f: Hz frequency array shared by all spectra
+    :param p0: starting parameters, (n_params,) or (n_spectra, n_params); default PINIT
+    :param maxiter: iteration limit
+    :param ftol: relative reduction of the sum of squares below which a spectrum has converged
+    :param xtol: relative step size below which a spectrum has converged
+    :param fitter: Fitter of the model refitting the spectra that reached
+                   maxiter, default Fitter(model)
+    :param refit_ratio: also refit the spectra whose relative cost is above
+                        refit_ratio times the median of the batch, None to
+                        refit only those that reached maxiter
+    :return: (params, info) where params is (n_spectra, n_params) and info holds
+             per-spectrum arrays 'cost' (sum of squares), 'nfev', 'nit', 'ier'
+             (1: ftol, 2: xtol, 3: no further reduction possible, 5: maxiter;
+             nfev of a refitted spectrum includes the refit, and ier is the
+             refit's when its result was kept) and 'refit' (refitted by fitter)
+    """
+    spec = model if isinstance(model, ModelSpec) else model_spec(model)
+    w = frequency_context(2 * np.pi * np.asarray(f, dtype=np.float64)).w
+    Z = np.atleast_2d(Z)
+    S, M, N = Z.shape[0], w.size, len(spec.keys)
+    m_weight = np.broadcast_to(m_weight, Z.shape)
+    b_weight = M * spec.boundweight
+    P = np.array(np.broadcast_to(spec.init_val if p0 is None else p0, (S, N)), dtype=np.float64)
+    P0 = P.copy()
+
+    def residuals(P, rows):
+        return _batch_residuals(P, spec.model, w, Z[rows], m_weight[rows],
+                                spec.lower, spec.upper, b_weight)
+
+    everyone = np.arange(S)
+    r = residuals(P, everyone)
+    cost = np.sum(r * r, axis=1)
+    lam = np.full(S, 1e-3)
+    nfev = np.ones(S, dtype=int)
+    nit = np.zeros(S, dtype=int)
+    ier = np.zeros(S, dtype=int)
+    A = np.empty((S, N, N))
+    g = np.empty((S, N))
+    scale = np.zeros((S, N))
+    stale = np.ones(S, dtype=bool)
+    eye = np.eye(N)
+    active = everyone
+
+    for it in range(maxiter):
+        if active.size == 0:
+            break
+        # Forward-difference Jacobians for the spectra whose parameters moved,
+        # all N perturbations of all of them in a single model call
+        rows = active[stale[active]]
+        if rows.size:
+            h = np.sqrt(np.finfo(np.float64).eps) * np.where(P[rows] != 0, np.abs(P[rows]), 1.0)
+            Pp = P[rows, np.newaxis, :] + h[:, :, np.newaxis] * eye
+            rp = residuals(Pp.reshape(-1, N), np.repeat(rows, N)).reshape(rows.size, N, -1)
+            JT = np.nan_to_num((rp - r[rows, np.newaxis, :]) / h[:, :, np.newaxis],
+                               nan=0.0, posinf=0.0, neginf=0.0)
+            A[rows] = JT @ JT.transpose(0, 2, 1)
+            g[rows] = np.einsum('snr,sr->sn', JT, r[rows])
+            nfev[rows] += N
+            stale[rows] = False
+            scale[rows] = np.maximum(scale[rows], np.diagonal(A[rows], axis1=1, axis2=2))
+
+        # Marquardt step with diagonal scaling, solved for all active spectra at once
+        D = scale[active]
+        D = np.maximum(D, 1e-30 * np.max(D, axis=1, keepdims=True) + 1e-300)
+        lhs = A[active] + lam[active, np.newaxis, np.newaxis] * (D[:, :, np.newaxis] * eye)
+        try:
+            delta = -np.linalg.solve(lhs, g[active][:, :, np.newaxis])[:, :, 0]
+        except LinAlgError:
+            delta = -np.array([np.linalg.lstsq(a, b, rcond=None)[0] for a, b in zip(lhs, g[active])])
+        trial = P[active] + delta
+        r_trial = residuals(trial, active)
+        cost_trial = np.sum(r_trial * r_trial, axis=1)
+        # a step into a region where the model is undefined is simply rejected
+        cost_trial[~np.isfinite(cost_trial)] = np.inf
+        nfev[active] += 1
+        nit[active] += 1
+
+        better = cost_trial < cost[active]
+        moved = active[better]
+        reduction = (cost[moved] - cost_trial[better]) / np.maximum(cost[moved], 1e-300)
+        P[moved] = trial[better]
+        r[moved] = r_trial[better]
+        cost[moved] = cost_trial[better]
+        stale[moved] = True
+        lam[moved] *= 0.3
+        lam[active[~better]] *= 10
+
+        small = np.all(np.abs(delta[better]) <= xtol * (np.abs(P[moved]) + xtol), axis=1)
+        # only trust a tiny reduction as convergence when the step was close to
+        # Gauss-Newton, a heavily damped step is small whatever the distance left
+        ier[moved[(reduction <= ftol) & (lam[moved] < 1)]] = 1
+        ier[moved[small & (ier[moved] == 0)]] = 2
+        ier[active[(lam[active] > 1e16) & (ier[active] == 0)]] = 3
+        active = active[ier[active] == 0]
+
+    ier[active] = 5
+    refit = ier == 5
+    if refit_ratio is not None:
+        # 同一批谱图的相对噪声相近，相对代价远高于中位数的多半停在了次优的局部极小
+        relative = cost / np.maximum(np.sum(np.abs(Z * m_weight) ** 2, axis=1), 1e-300)
+        refit |= relative > refit_ratio * np.median(relative)
+    if np.any(refit):
+        fitter = fitter or Fitter(spec)
+        for s in np.flatnonzero(refit):
+            params, cov_x, infodict, mesg, refit_ier = fitter.fit(Z[s], m_weight[s], f, P0[s])
+            refit_cost = float(np.sum(infodict['fvec'] ** 2))
+            nfev[s] += infodict['nfev']
+            if refit_cost < cost[s]:
+                P[s], cost[s], ier[s] = params, refit_cost, refit_ier
+    return P, {'cost': cost, 'nfev': nfev, 'nit': nit, 'ier': ier, 'refit': refit}
@@ -0,0 +1,118 @@
+"""
+Registry of the model scripts in Models/
+
+Each model script is imported once per process and its PARAMS dictionary is
+unpacked into arrays that the fitter can use directly.  Zfit fits thousands of
+spectra with the same model, so re-importing the script for every file is
+avoided.  When a model script is being edited, get_model(name, reload=True)
+re-imports it, but only if the source file has changed since it was loaded.
+A name that is not a script in Models/ but a circuit string ("R(CR)",
+"Rs-p(Q1,R1-W1)") is compiled into a model by Models.circuit.
+"""
+
+import os
+import threading
+import numpy as np
+from importlib import import_module, reload as _reload
+from Models.autodiff import jacobian_for
+
+MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules in Models/ that hold fitting machinery rather than a model
+CORE_MODULES = ('modelcore', 'registry', 'autodiff', 'fusion', 'circuit')
+
+_models = {}
+_lock = threading.Lock()
+
+
+class ModelSpec(object):
+    """
+    A loaded model script together with its parameter metadata.
+    The attributes below are computed once when the script is loaded.
+    """
+
+    def __init__(self, name, module):
+        self.name = name
+        self.module = module
+        self.model = module.model
+        self.path = module.__file__
+        # generated circuit models (Models.circuit) are never re-imported
+        self.mtime = os.path.getmtime(self.path) if not hasattr(module, 'CIRCUIT') else None
+        self.keys = list(module.PARAMS.keys())
+        # Extract the guess values out of the PARAMS values tuple
+        self.init_val = np.array([elem[module.PINIT] for elem in module.PARAMS.values()],
+                                 dtype=np.float64)
+        # Extract bounds list of tuples from PARAMS values tuple
+        self.bounds = [tuple(elem[module.PBOUNDS]) for elem in module.PARAMS.values()]
+        self.lower = np.array([lo for lo, hi in self.bounds], dtype=np.float64)
+        self.upper = np.array([hi for lo, hi in self.bounds], dtype=np.float64)
+        self.boundweight = module.BOUNDWEIGHT
+        # optional solver choice of the script, see modelcore.Fitter
+        self.backend = getattr(module, 'BACKEND', None)
+        # fit in the space of modelcore.ParamTransform, off unless the script opts in
+        self.transform = bool(getattr(module, 'TRANSFORM', False))
+        # dZ/dparams: the script's own jacobian(w, params) if it declares one,
+        # otherwise automatic differentiation of model() if the script opts in
+        # with AUTODIFF = True, else None for finite differences
+        self.jacobian = getattr(module, 'jacobian', None)
+        if self.jacobian is None and getattr(module, 'AUTODIFF', False):
+            self.jacobian = jacobian_for(self.model, len(self.keys))
+        # optional starting values from the DRT of the data, see drt.initial_guess
+        self.guess = getattr(module, 'guess', None)
+
+    @property
+    def PARAMS(self):
+        return self.module.PARAMS
+
+
+def available_models():
+    """
+    :return: sorted names of all model scripts in Models/
+    """
+    names = [path[:-3] for path in os.listdir(MODEL_DIR) if path.endswith('.py')]
+    return sorted(name for name in names if name not in CORE_MODULES)
+
+
+def model_spec(module):
+    """
+    Wrap an already imported model script module without going through the cache.
+    :param module: model script module
+    :return: ModelSpec
+    """
+    return ModelSpec(module.__name__.rpartition('.')[2], module)
+
+
+def _import(name):
+    """
+    Import the model script of that name, or compile the circuit it describes
+    """
+    if not os.path.isfile(os.path.join(MODEL_DIR, name + '.py')):
+        from Models import circuit
+
+        if circuit.is_circuit(name):
+            return circuit.compile_circuit(name)
+    return import_module("Models." + name)
+
+
+def _changed(spec):
+    return spec.mtime is not None and os.path.getmtime(spec.path) != spec.mtime
+
+
+def get_model(name, reload=False):
+    """
+    Return the ModelSpec for a model script, importing it on first use only.
+    :param name: model script name in Models/, e.g. "R(Q(RW))", or a circuit string
+    :param reload: re-import the script if its file changed since it was loaded
+    :return: ModelSpec
+    """
+    spec = _models.get(name)
+    if spec is not None and not (reload and _changed(spec)):
+        return spec
+    with _lock:
+        spec = _models.get(name)
+        if spec is None:
+            spec = ModelSpec(name, _import(name))
+        elif _changed(spec):
+            spec = ModelSpec(name, _reload(spec.module))
+        _models[name] = spec
+    return spec
@@ -4,6 +4,7 @@ Model script for Rp || (L + Rs)
 
 import numpy as np
 from collections import OrderedDict
+from Models.modelcore import frequency_context
 
 j = 1j
 
@@ -31,10 +32,12 @@ def model(w, params):
     """
     # Extract individual component values from params list
     Rs, L, Rp = params
+    # Terms that depend on the frequencies only, computed once per grid
+    ctx = frequency_context(w)
     # This is the definition of the model impedance which we want to
     # fit to the data points.  Modify it to represent the circuit you
     # want to fit to the data.
-    Zlr = (j * w * L) + Rs
+    Zlr = (ctx.jw * L) + Rs
     Y = 1/Zlr + 1/Rp
     Z = 1 / Y
     return Z
@@ -4,6 +4,7 @@ Model script for R || C || (L + Rl)
 
 import numpy as np
 from collections import OrderedDict
+from Models.modelcore import frequency_context
 
 j = 1j
 
@@ -32,11 +33,13 @@ def model(w, params):
     """
     # Extract individual component values from params list
     R, C, L, Rl = params
+    # Terms that depend on the frequencies only, computed once per grid
+    ctx = frequency_context(w)
     # This is the definition of the model impedance which we want to
     # fit to the data points.  Modify it to represent the circuit you
     # want to fit to the data.
-    Zl = (j * w * L) + Rl
-    Zc = 1/(j * w * C)
+    Zl = (ctx.jw * L) + Rl
+    Zc = 1/(ctx.jw * C)
     Y = 1/R + 1/Zc + 1/Zl
     Z = 1 / Y
     return Z
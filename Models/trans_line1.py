@@ -6,6 +6,7 @@ See LTspice schematic for one segment in ./Data/LineSegment.asc
 
 import numpy as np
 from collections import OrderedDict
+from Models.modelcore import frequency_context
 
 j = 1j
 
@@ -25,6 +26,11 @@ PARAMS = OrderedDict([
 ])
 
 
+# Skin effect branch factors, 10**(k/2) for each parallel L/R branch
+BRANCHES = 5
+BRANCH_FACTORS = [10**(x/2.0) for x in range(BRANCHES)]
+
+
 def model(w, params):
     """
     Model an arbitrary load impedance at the end of a cable.
@@ -37,8 +43,6 @@ def model(w, params):
     LENGTH = 3.0
     # Integer number of segments to split cable into
     SEGMENTS = 6
-    # Skin effect parallel L/R branches
-    BRANCHES = 5
     def load_z(w):
         """
         Define the load impedance at the cable end.
@@ -52,48 +56,52 @@ def model(w, params):
         Zl = np.full(len(w), 49.9 + 1j*0.0, dtype='complex')
         return Zl
 
-    def segment_z(Zl, w, Lps, Lsps, Rps, Cps, Gps):
+    def skin_z(w, dLs, dR):
         """
-        Return impedance array of a cable segment
-        See LTspice schem ".\Data\LineSegment.asc"
-        :param Zl: load impedance to this segment
+        Return impedance array of the parallel skin effect L/R branches
         :param w: radian frequency array
-        :param Lps: series inductance per segment
-        :param Lsps: skin inductance per segment
-        :param Rps: series resistance per segment
-        :param Cps: shunt capacitance per segment
-        :param Gps: shunt conductance per segment
+        :param dLs: skin inductance per half segment
+        :param dR: series resistance per half segment
         """
-        dL = Lps / 2.0
-        dLs = Lsps / 2.0
-        dR = Rps / 2.0
-        dC = Cps
-        dG = Gps
-        # Branch factors
-        bf = [10**(x/2.0) for x in range(BRANCHES)]
-        Ys = np.zeros(len(w), dtype='complex')
+        Ys = 0.0
         # For each skin effect branch:
-        for factor in bf:
+        for factor in BRANCH_FACTORS:
             Lb = dLs / factor
-            Xb = np.array(1j * w * Lb)
+            Xb = ctx.jw * Lb
             Rb = dR * factor
             Zb = Rb + Xb
-            Ys += 1.0 / Zb
-        # Total skin effect impedance
-        Zskin = 1.0 / Ys
+            Ys = Ys + 1.0 / Zb
+        return 1.0 / Ys
+
+    def segment_z(Zl, w, Zskin, XL, dC, dG):
+        """
+        Return impedance array of a cable segment
+        See LTspice schem ".\Data\LineSegment.asc"
+        :param Zl: load impedance to this segment
+        :param w: radian frequency array
+        :param Zskin: skin effect impedance of half a segment
+        :param XL: reactance of the incremental inductance of half a segment
+        :param dC: shunt capacitance per segment
+        :param dG: shunt conductance per segment
+        """
         # "Termination Z" is load in series with skin effect and incremental L
-        Zt = Zl + Zskin + 1j*w*dL
+        Zt = Zl + Zskin + XL
         # "Shunt Z" is parallel combination of Zt and incremental C and G
-        Zs = 1.0/(1.0/Zt + 1j*w*dC + dG)
+        Zs = 1.0/(1.0/Zt + ctx.jw*dC + dG)
         # Total segment Z is Zs in series with skin effect and incremental L
-        return Zs + Zskin + 1j*w*dL
+        return Zs + Zskin + XL
 
     # Get per-segment values from parameter list
     Lps, Lsps, Rps, Cps, Gps = [x * LENGTH / SEGMENTS for x in params]
+    # Terms that depend on the frequencies only, computed once per grid
+    ctx = frequency_context(w)
+    # The series elements are the same in every segment
+    Zskin = skin_z(w, Lsps / 2.0, Rps / 2.0)
+    XL = ctx.jw*(Lps / 2.0)
     # Initialize Z array (don't just refer to it)
-    Zmod = load_z(w) + 0.0
+    Zmod = ctx.term('load_z', load_z) + 0.0
     # Iterate cable segments, supplying previous Zmod as load to each iteration
     for s in range(SEGMENTS):
-        Zmod = segment_z(Zmod, w, Lps, Lsps, Rps, Cps, Gps)
+        Zmod = segment_z(Zmod, w, Zskin, XL, Cps, Gps)
     # Return impedance
     return Zmod
@@ -7,6 +7,7 @@ CG in shunt between them.
 
 import numpy as np
 from collections import OrderedDict
+from Models.modelcore import frequency_context
 
 j = 1j
 
@@ -60,19 +61,21 @@ def model(w, params):
         :param Cps: shunt capacitance per segment
         """
         # Half of series leg
-        Zleg = 1j*0.5*w*Lps + 0.5*Rps
+        Zleg = 0.5*ctx.jw*Lps + 0.5*Rps
         # Termination Z in series with half of series elements
         Zt = Zl + Zleg
         # Now in parallel with segment C and G
-        Yt = 1.0/Zt + 1j*w*Cps + Gps     # Bc is positive
+        Yt = 1.0/Zt + ctx.jw*Cps + Gps     # Bc is positive
         # In series with remainder of series elements
         Zt = 1.0/Yt + Zleg
         return Zt
 
     # Get per-segment values from parameter list
     Lps, Rps, Cps, Gps = [x * LENGTH / SEGMENTS for x in params]
+    # Terms that depend on the frequencies only, computed once per grid
+    ctx = frequency_context(w)
     # Initialize Z array (don't just refer to it)
-    Zmod = load_z(w) + 0.0
+    Zmod = ctx.term('load_z', load_z) + 0.0
     # Iterate cable segments, supplying previous Zmod as load to each iteration
     for s in range(SEGMENTS):
         Zmod = segment_z(Zmod, w, Lps, Rps, Cps, Gps)
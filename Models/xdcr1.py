@@ -2,8 +2,8 @@
 Model script for standard transducer model: (C1 + R1) || (C2 + R2 + L2)
 """
 
-import numpy as np
 from collections import OrderedDict
+from Models.modelcore import frequency_context
 
 j = 1j
 
@@ -31,11 +31,13 @@ def model(w, params):
     """
     # Extract individual component values from params list
     R1, C1, R2, C2, L2 = params
+    # Terms that depend on the frequencies only, computed once per grid
+    ctx = frequency_context(w)
     # This is the definition of the model impedance which we want to
     # fit to the data points.  Modify it to represent the circuit you
     # want to fit to the data.
     # (series R1, C1) || (series R2, C2, L2) 
-    Z1 = R1 + 1 / (j * w * C1)
-    Z2 = R2 + 1 / (j * w * C2) + j * w * L2
+    Z1 = R1 + 1 / (ctx.jw * C1)
+    Z2 = R2 + 1 / (ctx.jw * C2) + ctx.jw * L2
     Z = 1 / (1 / Z1 + 1 / Z2)
     return Z
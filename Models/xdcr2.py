@@ -3,8 +3,8 @@ Model script for 2-resonance transducer model:
 (C1 + R1) || (C2 + R2 + L2) || (C3 + R3 + L3)
 """
 
-import numpy as np
 from collections import OrderedDict
+from Models.modelcore import frequency_context
 
 j = 1j
 
@@ -37,12 +37,14 @@ def model(w, params):
     """
     # Extract individual component values from params list
     R1, C1, R2, C2, L2, R3, C3, L3 = params
+    # Terms that depend on the frequencies only, computed once per grid
+    ctx = frequency_context(w)
     # This is the definition of the model impedance which we want to
     # fit to the data points.  Modify it to represent the circuit you
     # want to fit to the data.
     # (series R1, C1) || (series R2, C2, L2) || (series R3, C3, L3)
-    Z1 = R1 + 1 / (j * w * C1)
-    Z2 = R2 + 1 / (j * w * C2) + j * w * L2
-    Z3 = R3 + 1 / (j * w * C3) + j * w * L3
+    Z1 = R1 + 1 / (ctx.jw * C1)
+    Z2 = R2 + 1 / (ctx.jw * C2) + ctx.jw * L2
+    Z3 = R3 + 1 / (ctx.jw * C3) + ctx.jw * L3
     Z = 1 / (1 / Z1 + 1 / Z2 + 1 / Z3)
     return Z
@@ -5,133 +5,891 @@ DATAFORMAT = {"tab":'\t',
               }
 SKIPROWS = 1
 POTENTIAL = 0
+DELIMITER = "tab"
 IMPORT_TYPE = "Zreal_Zimag"
+RELOAD_MODELS = 0
+BACKEND = ""
+# fit in log/normalized parameters: "" = the TRANSFORM of the model script (off when it sets none), 1 = on, 0 = off
+TRANSFORM = ""
+RESULT_FORMAT = ""
+EXPORT_TEXT = 1
+# JSON lines file of per-file fit metrics, empty = off (see metrics.py)
+METRICS = ""
+WORKERS = 1
+VECTORIZED = 0
+SWEEP = 0
+# sweep mode: refit from PINIT when a warm-started fit ends with a cost this
+# many times above the cost of the previous potential
+SWEEP_RESET = 10.0
+# sweep mode: a warm-started fit may take this many times the function
+# evaluations of the last fit from PINIT before it is repeated from PINIT
+SWEEP_BUDGET = 5
+# preprocessing between loading and fitting (see preprocess.py): frequency
+# range in Hz (0 = no limit), dropping of inductive points, weighting
+# ('unit' or 'modulus'), KK outlier rejection (0 = off) and KK validation
+F_MIN = 0.0
+F_MAX = 0.0
+DROP_INDUCTIVE = 0
+WEIGHTING = "unit"
+OUTLIER_SIGMA = 0.0
+KK_TEST = 0
+KK_MAX = 0.01
+# fit only new or changed files of a directory, see manifest.py
+INCREMENTAL = 0
+# keep polling the directory and fit files as they appear (implies INCREMENTAL)
+WATCH = 0
+# seconds between two polls; files modified more recently are left for the next poll
+WATCH_INTERVAL = 2.0
+# sampled starting points per fit besides PINIT, best fit kept, 0 = off (see Models.modelcore.multistart)
+MULTISTART = 0
+# 'sobol' or 'lhs'
+MULTISTART_METHOD = "sobol"
+# 1 = start with a short differential evolution over the PARAMS bounds
+MULTISTART_DE = 0
+# processes fitting the starts of one file; a batch already runs one process per file
+MULTISTART_WORKERS = 1
+# 1 = start fits without p0 from the DRT guess() of the model script instead of PINIT
+# (see drt.py); MULTISTART takes precedence
+DRT_INIT = 0
+# Tikhonov regularization of the DRT, relative to the data scaled by max|Z|
+DRT_LAMBDA = 1e-3
+# 1 = compute the DRT of -f (file, directory or archive) instead of fitting a model
+DRT = 0
+# peaks per spectrum written to result/drt.txt
+DRT_PEAKS = 3
 
+# comma separated models to screen against each other, empty = off (see screening.py)
+SCREEN = ""
+# screening: drop a model after its AIC was this much above the best on SCREEN_MIN_FILES files in a row
+SCREEN_DELTA = 10.0
+SCREEN_MIN_FILES = 5
 
-def do_fit(modelName, filename):
+# address to serve fits of live spectra on ("port", "host:port" or a Unix socket path), empty = off (see service.py)
+SERVE = ""
+# sweeps waiting for a fit before the service stops reading
+SERVE_QUEUE = 64
+
+# bootstrap replicates refitted per file for resampled standard errors, 0 = off
+BOOTSTRAP = 0
+# 'residual' (resample the fit residuals) or 'montecarlo' (normal noise), see Models.modelcore.bootstrap
+BOOTSTRAP_MODE = "residual"
+
+# module settings a batch worker needs to fit like the parent process
+WORKER_SETTINGS = ('SKIPROWS', 'POTENTIAL', 'DELIMITER', 'IMPORT_TYPE', 'RELOAD_MODELS', 'BACKEND',
+                   'TRANSFORM', 'EXPORT_TEXT', 'METRICS', 'BOOTSTRAP', 'BOOTSTRAP_MODE',
+                   'MULTISTART', 'MULTISTART_METHOD', 'MULTISTART_DE', 'F_MIN', 'F_MAX', 'DROP_INDUCTIVE',
+                   'WEIGHTING', 'OUTLIER_SIGMA', 'KK_TEST', 'KK_MAX', 'DRT_INIT', 'DRT_LAMBDA')
+
+
+def load_data(filename):
+    """
+    Read one spectrum in the DATAFORMAT / POTENTIAL / IMPORT_TYPE layout, see loader.py
+    :param filename: data file, or a spectrum in a packed archive (see archive.py)
+    :return: (potential, frequency array, complex impedance array), None if unreadable
+    """
     import os
-    import numpy as np
+    import loader
+    import archive
+
+    if archive.is_member(filename):
+        # 打包文件：直接取内存映射的切片，不解析文本
+        return archive.open_archive(os.path.dirname(filename)).spectrum(os.path.basename(filename))
+    # 第一列可以是potential（POTENTIAL == 1），其余为fre，zr，zi
+    try:
+        return loader.load_spectrum(filename, SKIPROWS, DATAFORMAT[DELIMITER], POTENTIAL, IMPORT_TYPE)
+    except ValueError:
+        print("Data is not in right columns")
+        return
+
+
+def read_potential(filename):
+    """
+    :return: potential of a data file, read from the first data line when
+             POTENTIAL == 1, else 0.0; None if unreadable
+    """
+    import os
+    import loader
+    import archive
+
+    if archive.is_member(filename):
+        return archive.open_archive(os.path.dirname(filename)).potential(os.path.basename(filename))
+    return loader.read_potential(filename, SKIPROWS, DATAFORMAT[DELIMITER], POTENTIAL)
+
+
+def prepare_data(filename, data, fileMetrics=None):
+    """
+    Run the preprocessing stage (see preprocess.py) on a loaded spectrum
+    :param data: (potential, freq, zTarg) as returned by load_data, or None
+    :param fileMetrics: FileMetrics to add the dropped points and KK residual to
+    :return: (potential, freq, zTarg, m_weight) of the points to fit, None
+             when data is None or the spectrum is rejected
+    """
+    import preprocess
+
+    if data is None:
+        return None
+    potential, freq, zTarg = data
+    stage = preprocess.Preprocessor(F_MIN or None, F_MAX or None, bool(DROP_INDUCTIVE), WEIGHTING,
+                                    OUTLIER_SIGMA, bool(KK_TEST), KK_MAX)
+    try:
+        freq, zTarg, m_weight, report = stage(freq, zTarg)
+    except preprocess.SpectrumRejected as e:
+        # 验证失败的谱图不进行拟合
+        print("%s skipped: %s" % (filename, e))
+        return None
+    if fileMetrics is not None:
+        fileMetrics.update(report)
+    return potential, freq, zTarg, m_weight
+
+
+def data_files(dirname):
+    """
+    :param dirname: directory of data files, or a packed archive (see archive.py)
+    :return: sorted paths of the data files, or the member paths of the archive
+    """
+    import os
+    import archive
     from os import path
-    from importlib import import_module, reload
+
+    if archive.is_archive(dirname):
+        return archive.open_archive(dirname).paths()
+    files = sorted(path.join(dirname, file) for file in os.listdir(dirname))
+    return [file for file in files if path.isfile(file)]
+
+
+def file_metrics(filename, modelName):
+    """
+    :return: metrics.FileMetrics collecting the metrics of one file, or
+             metrics.OFF when METRICS is not set
+    """
+    import metrics
+
+    return metrics.FileMetrics(filename, modelName) if METRICS else metrics.OFF
+
+
+def fit_transform():
+    """
+    :return: transform argument of the fitters, see Models.modelcore.Fitter:
+             None for the TRANSFORM of the model script, else the TRANSFORM setting
+    """
+    return None if TRANSFORM == "" else bool(int(TRANSFORM))
+
+
+def fit_spectrum(model, freq, zTarg, p0=None, fileMetrics=None, m_weight=None, maxfev=None):
+    """
+    :param model: ModelSpec from Models.registry.get_model()
+    :param p0: starting parameters, default PINIT; with MULTISTART a fit
+               without p0 searches from several sampled starts instead, with
+               DRT_INIT it starts from the DRT guess of the model
+    :param fileMetrics: FileMetrics to add the model/Jacobian call counts and times to
+    :param m_weight: modeling weights from prepare_data, default all ones
+    :param maxfev: limit of function evaluations, default the fitter's own
+    :return: (fitresult as returned by Models.modelcore.fit_model, cost)
+             where cost is the final sum of squared residuals
+    """
+    import time
+    import numpy as np
     import Models.modelcore as mc
 
-    filePath = path.split(filename)[0]
-    if (os.path.isfile(filename)):
-        # 获取到文件名和模块名
-        model = import_module("Models." + modelName)
-        model = reload(model)
-
-        # 获取data
-        #data = np.loadtxt(filename, skiprows=dataFormat['skiprows'], delimiter=dataFormat['delimiter']).T
-        # 由于第一列是potential，数据不适用上面函数
- 
-        data = []
-        potential = 0.0
-
-        if POTENTIAL == 0:
-            data = np.loadtxt(filename, skiprows=SKIPROWS, delimiter=DATAFORMAT[DELIMITER]).T
-        elif POTENTIAL == 1:
-            with open(filename) as _f:
-                d = _f.read().splitlines()[SKIPROWS:]
-
-            # 现在的数据是带有电位的data
-            data = [_d.split(DATAFORMAT[DELIMITER]) for _d in d]
-            potential = float(data[0][0])
-            # 提取出电位，将剩下的转换为fre，zr，zi的数据格式
-            data = np.array([_d[1:] for _d in data],dtype=np.float64).T
-            # print(data[0])
-        try:
-            # potential,
-            frequency, Zreal, Zimage = data[0:3]
-            # phase = np.ones(len(data[0]))
-        except:
-            print("Data is not in right columns")
-            return
-        if IMPORT_TYPE == "Zreal_Zimag":
-            # z target 输入的是Z’ 和Z“
-            zTarg = np.array([_Zreal - _Zimage * 1j for _Zreal, _Zimage in zip(Zreal, Zimage)],dtype=np.complex128)
-            # print(zTarg)
-        elif IMPORT_TYPE == "Z_Phase":
-            # 如果输入phase 和Z
-            p = np.radians(Zimage)
-            m = Zreal
-            zTarg = m * np.exp(1j*p)
+    if m_weight is None:
+        m_weight = np.ones(len(zTarg)).astype(np.float64)
+    if DRT_INIT and MULTISTART <= 0 and p0 is None:
+        import drt
+
+        # 没有峰或模型没有guess()时仍从PINIT开始
+        p0 = drt.initial_guess(model, freq, zTarg, lam=DRT_LAMBDA)
+    if MULTISTART > 0 and p0 is None:
+        start = time.perf_counter()
+        fitresult = mc.multistart(model, zTarg, m_weight, freq, MULTISTART, MULTISTART_METHOD,
+                                  MULTISTART_WORKERS, backend=BACKEND or None, transform=fit_transform(),
+                                  evolve=bool(MULTISTART_DE), seed=0)
+        if fileMetrics is not None:
+            fileMetrics.update({'fit_s': time.perf_counter() - start, 'starts': fitresult[2]['starts'],
+                                'nfev': int(fitresult[2]['nfev']), 'ier': int(fitresult[4])})
+    elif fileMetrics is not None and fileMetrics.enabled:
+        fitresult, values = mc.fit_model_profiled(model, zTarg, m_weight, freq, backend=BACKEND or None,
+                                                  transform=fit_transform(), p0=p0, maxfev=maxfev)
+        fileMetrics.add_fit(values)
+    else:
+        fitresult = mc.fit_model(model, zTarg, m_weight, freq,
+                                 backend=BACKEND or None, transform=fit_transform(), p0=p0, maxfev=maxfev)
+    cost = float(np.sum(fitresult[2]['fvec'] ** 2))
+    return fitresult, cost
 
 
-        freq = np.array(frequency,dtype=np.float64)
+def derived_columns(modelName, params):
+    """
+    :return: OrderedDict of the extra result columns computed from the fitted parameters
+    """
+    from collections import OrderedDict
+
+    derived = OrderedDict()
+    # 对R(Q(RW))模型，序号为 Rs,Yq,n,Rf,W
+    # Cd = Y0**(1/n) * ( (Rs+Rp)/Rs*Rp **(1-1/n) )
+    if modelName=="R(Q(RW))":
+        derived["Capacity_d"] = ( params[1] ** (1. / params[2]) )  * \
+                ( (params[0] + params[3]) / (params[0] * params[3])) ** (1 - 1. / params[2])
+    return derived
+
+
+def fit_record(modelName, filename, potential, params, cost, nfev, ier, infodict=None, bootStderr=None):
+    """
+    :param infodict: infodict of the fit holding 'stderr' and 'corr', see
+                     Models.modelcore.parameter_errors; None if unknown
+    :param bootStderr: bootstrap standard errors, see bootstrap_stderr
+    :return: result record of one file, see results.record; the file is
+             recorded by its name in the data directory, as in the manifest,
+             however the path was spelled on the command line
+    """
+    import os
+    import results
 
-        # assign modelcore objects to this model
-        mc.model = model.model
-        mc.PINIT = model.PINIT
-        mc.PBOUNDS = model.PBOUNDS
-        mc.PARAMS = model.PARAMS
-        mc.BOUNDWEIGHT = model.BOUNDWEIGHT
+    infodict = infodict if infodict is not None else {}
+    return results.record(os.path.basename(filename), modelName, potential, params, cost, nfev, ier,
+                          derived_columns(modelName, params), infodict.get('stderr'),
+                          infodict.get('corr'), bootStderr)
 
-        keys, params = [], []
 
-        fitresult = mc.fit_model(zTarg, np.ones(len(Zreal)).astype(np.float64), freq)
+def bootstrap_stderr(model, filename, freq, zTarg, params, m_weight):
+    """
+    :return: standard errors of params over BOOTSTRAP resampled refits, or
+             None when BOOTSTRAP is 0.  The replicates are fitted with the
+             backend and transform of the fit itself.  The seed follows from
+             the file name, so a rerun or another worker gives the same
+             replicates.
+    """
+    import os
+    import zlib
+    import Models.modelcore as mc
+
+    if BOOTSTRAP <= 0:
+        return None
+    seed = zlib.crc32(os.path.basename(filename).encode('utf-8'))
+    fitter = mc.Fitter(model, backend=BACKEND or None, transform=fit_transform())
+    return mc.bootstrap(model, zTarg, m_weight, freq, params, BOOTSTRAP, mode=BOOTSTRAP_MODE,
+                        seed=seed, fitter=fitter)[0]
+
+
+def record_values(keys, rec):
+    """
+    :return: OrderedDict of the parameter and derived columns of a result record
+    """
+    from collections import OrderedDict
+
+    values = OrderedDict(zip(keys, rec['params']))
+    values.update(rec['derived'])
+    return values
+
+
+def para_row(rec):
+    """
+    :param rec: result record of one file
+    :return: one line of paras.txt as a list of strings, see write_paras
+    """
+    row = [str(para) for para in rec['params']]
+    row.extend("%.15f" % value for value in rec['derived'].values())
+    row.append("%.3f" % rec['potential'])
+    return row
+
+
+def write_fitted(model, filename, freq, params, potential):
+    """
+    Write the fitted spectrum of one data file to result/fitedData/
+    """
+    import os
+    import numpy as np
+    from os import path
+
+    filePath, originFilename = path.split(filename)
+    # exist_ok: several batch workers may create it at the same time
+    fittedPath = path.join(filePath, "result", "fitedData/")
+    os.makedirs(fittedPath, exist_ok=True)
+
+    # 输出模拟值
+    zOmega = np.array([2.0 * np.pi * f for f in freq])
+    zFited = model.model(zOmega, params)
+    phase = np.array([np.rad2deg(np.arctan(z.imag / z.real)) for z in zFited])
+
+    fittedFile = os.path.join(fittedPath,"fitted_%.2fV_"%potential + originFilename)
+
+    with open(fittedFile, mode='w') as f:
+        print('Frequency[Hz] \t Z\'[Omega]\t -Z\"[Omega]\t Z[Omega]\t -Phase[deg]', file=f)
+
+        for _f, _zfitted, _p in zip(freq, zFited, phase):
+            print('{0}\t{1}\t{2}\t{3}\t{4}'.format(_f, np.real(_zfitted), -np.imag(_zfitted), np.abs(_zfitted), -_p), file=f)
+
+
+def do_fit(modelName, filename):
+    import os
+    import archive
+    from Models.registry import get_model
+
+    if os.path.isfile(filename) or archive.is_member(filename):
+        # 获取模型，每个进程只导入一次；RELOAD_MODELS时模型文件修改后重新导入
+        model = get_model(modelName, reload=RELOAD_MODELS)
+        fileMetrics = file_metrics(filename, modelName)
+
+        with fileMetrics.phase('load'):
+            data = load_data(filename)
+        with fileMetrics.phase('preprocess'):
+            data = prepare_data(filename, data, fileMetrics)
+        if data is None:
+            return
+        potential, freq, zTarg, m_weight = data
+
+        fitresult, cost = fit_spectrum(model, freq, zTarg, fileMetrics=fileMetrics, m_weight=m_weight)
         # with open('d:/test2.txt',mode='w') as f:
         #     print(zTarg,file=f)
         params = fitresult[0]
-        keys = model.PARAMS.keys()
         infodict = fitresult[2]
         mesg = fitresult[3]
         ier = fitresult[4]
         # print(params)
         # print(infodict['fjac'])
 
-        storePath = path.join(filePath, "result")
-        if not path.exists(storePath):
-            os.mkdir(storePath)
+        if EXPORT_TEXT:
+            with fileMetrics.phase('write'):
+                write_fitted(model, filename, freq, params, potential)
 
-        # 写入title，只写入一次，默认如果文件存在就不重复写入
-        if not os.path.isfile(path.join(storePath, 'paras.txt')):
-            with open(path.join(storePath, 'paras.txt'), mode='a', encoding='utf-8') as f:
-                for key in keys:
-                    print(str(key), file=f, end='\t')
-                # 在这里加上potential和capacity
-                if modelName == "R(Q(RW))":
-                    print("Capacity_d",file=f,end='\t')
-                print("potential", file=f)
-        # 写入para的值
-        # 对R(Q(RW))模型，序号为 Rs,Yq,n,Rf,W
-        # Cd = Y0**(1/n) * ( (Rs+Rp)/Rs*Rp **(1-1/n) )
-        if modelName=="R(Q(RW))":
-            capacityD = ( params[1] ** (1. / params[2]) )  * \
-                    ( (params[0] + params[3]) / (params[0] * params[3])) ** (1 - 1. / params[2])
+        # print('\r' + originFilename+ '\t'+mesg + '\n ier=' + str(ier) + '\t fevl=' + str(infodict['nfev']),end='\r')
+
+        # 这一行的结果，由调用者统一写入（见write_results）
+        rec = fit_record(modelName, filename, potential, params, cost, infodict['nfev'], ier, infodict,
+                         bootstrap_stderr(model, filename, freq, zTarg, params, m_weight))
+        rec['metrics'] = fileMetrics.entry()
+        return model.keys, rec
 
 
-        with open(path.join(storePath, 'paras.txt'), mode='a', encoding='utf-8') as f:
-            for para in params:
-                print(str(para), file=f, end='\t')
-            if modelName == "R(Q(RW))":
-                print("%.15f" % capacityD, file=f, end='\t')
-            print("%.3f"%potential, file=f)
+def fit_sweep(modelName, files):
+    """
+    Fit the files of one potential sweep in the order given, seeding each fit
+    with the parameters of the previous file.  Neighbouring potentials give
+    nearly the same parameters, so a warm start converges in a few iterations.
+    A warm-started fit may take SWEEP_BUDGET times the function evaluations
+    of the last fit from PINIT.  One that runs out of them, or whose cost ends
+    more than SWEEP_RESET times above the previous one, is repeated from
+    PINIT, and the better of the two is kept.
+    :param modelName: model script name in Models/
+    :param files: data files, sorted by potential
+    :return: list of (keys, record) as returned by do_fit, None for unreadable files
+    """
+    from Models.registry import get_model
 
+    model = get_model(modelName, reload=RELOAD_MODELS)
+    results = []
+    p0, lastCost, coldNfev = None, None, None
+    for filename in files:
+        fileMetrics = file_metrics(filename, modelName)
+        with fileMetrics.phase('load'):
+            data = load_data(filename)
+        with fileMetrics.phase('preprocess'):
+            data = prepare_data(filename, data, fileMetrics)
+        if data is None:
+            results.append(None)
+            continue
+        potential, freq, zTarg, m_weight = data
+
+        maxfev = SWEEP_BUDGET * coldNfev if p0 is not None else None
+        fitresult, cost = fit_spectrum(model, freq, zTarg, p0, fileMetrics, m_weight, maxfev)
+        if p0 is None:
+            coldNfev = int(fitresult[2]['nfev'])
+        restarted = p0 is not None and (fitresult[4] == 5 or not cost <= SWEEP_RESET * lastCost)
+        if restarted:
+            # 超出计算预算或残差突增（如越过一个峰），从PINIT重新拟合
+            coldresult, coldCost = fit_spectrum(model, freq, zTarg, fileMetrics=fileMetrics, m_weight=m_weight)
+            coldNfev = int(coldresult[2]['nfev'])
+            if coldCost < cost:
+                fitresult, cost = coldresult, coldCost
+        fileMetrics.update({'warm_start': p0 is not None, 'restarted': restarted})
+        params = fitresult[0]
+        if EXPORT_TEXT:
+            with fileMetrics.phase('write'):
+                write_fitted(model, filename, freq, params, potential)
+        rec = fit_record(modelName, filename, potential, params, cost, fitresult[2]['nfev'], fitresult[4],
+                         fitresult[2], bootstrap_stderr(model, filename, freq, zTarg, params, m_weight))
+        rec['metrics'] = fileMetrics.entry()
+        results.append((model.keys, rec))
+        p0, lastCost = params, cost
+    return results
 
-        # 输出模拟值
-        zOmega = np.array([2.0 * np.pi * f for f in freq])
-        zFited = model.model(zOmega, params)
-        phase = np.array([np.rad2deg(np.arctan(z.imag / z.real)) for z in zFited])
 
+def fit_vectorized(modelName, files, progress=None):
+    """
+    Fit a set of files as batched problems (Models.modelcore.fit_batch): the
+    spectra are grouped by frequency grid and every group is stepped together
+    in one vectorized Levenberg-Marquardt loop in this process.
+    :param modelName: model script name in Models/
+    :param files: data files
+    :param progress: optional callable(done, total) called after every group
+    :return: (keys, records) with records in the order of files
+    """
+    import time
+    import numpy as np
+    import Models.modelcore as mc
+    from Models.registry import get_model
 
+    model = get_model(modelName, reload=RELOAD_MODELS)
+    loaded = []
+    for file in files:
+        fileMetrics = file_metrics(file, modelName)
+        with fileMetrics.phase('load'):
+            data = load_data(file)
+        with fileMetrics.phase('preprocess'):
+            data = prepare_data(file, data, fileMetrics)
+        if data is not None:
+            loaded.append((file, data, fileMetrics))
 
-        originFilename = path.split(filename)[1]
-        fittedPath = path.join(storePath, "fitedData/")
-        if not path.exists(fittedPath):
-            os.mkdir(fittedPath)
-        fittedFile = os.path.join(fittedPath,"fitted_%.2fV_"%potential + originFilename)
+    groups = {}
+    for j, (file, (potential, freq, zTarg, m_weight), fileMetrics) in enumerate(loaded):
+        groups.setdefault(freq.tobytes(), []).append(j)
 
-        with open(fittedFile, mode='w') as f:
-            print('Frequency[Hz] \t Z\'[Omega]\t -Z\"[Omega]\t Z[Omega]\t -Phase[deg]', file=f)
+    records = [None] * len(loaded)
+    done = 0
+    for members in groups.values():
+        freq = loaded[members[0]][1][1]
+        Z = np.array([loaded[j][1][2] for j in members])
+        W = np.array([loaded[j][1][3] for j in members])
+        start = time.perf_counter()
+        p0 = None
+        if DRT_INIT:
+            import drt
 
-            for _f, _zfitted, _p in zip(frequency, zFited, phase):
-                print('{0}\t{1}\t{2}\t{3}\t{4}'.format(_f, np.real(_zfitted), -np.imag(_zfitted), np.abs(_zfitted), -_p), file=f)
+            # 同一频率网格的谱图一起求DRT
+            p0 = drt.initial_guesses(model, freq, Z, DRT_LAMBDA)
+        # 达到迭代上限或代价异常高的谱图用与单个拟合相同的设置重新拟合
+        fitter = mc.Fitter(model, backend=BACKEND or None, transform=fit_transform())
+        params, info = mc.fit_batch(model, Z, W, freq, p0, fitter=fitter)
+        elapsed = time.perf_counter() - start
+        for s, (j, p) in enumerate(zip(members, params)):
+            file, (potential, freq, zTarg, m_weight), fileMetrics = loaded[j]
+            if EXPORT_TEXT:
+                with fileMetrics.phase('write'):
+                    write_fitted(model, file, freq, p, potential)
+            records[j] = fit_record(modelName, file, potential, p, info['cost'][s],
+                                    info['nfev'][s], info['ier'][s])
+            # 批量拟合的时间只能按组记录
+            fileMetrics.update({'batch_size': len(members), 'batch_fit_s': elapsed,
+                                'nfev': int(info['nfev'][s]), 'nit': int(info['nit'][s]),
+                                'ier': int(info['ier'][s]), 'cost': float(info['cost'][s]),
+                                'refit': bool(info['refit'][s])})
+            records[j]['metrics'] = fileMetrics.entry()
+        done += len(members)
+        if progress is not None:
+            progress(done, len(loaded))
+    return model.keys, records
 
 
-        # print('\r' + originFilename+ '\t'+mesg + '\n ier=' + str(ier) + '\t fevl=' + str(infodict['nfev']),end='\r')
-   
+def drt_batch(filename, progress=None):
+    """
+    Distribution of relaxation times (see drt.py) of a data file, of every
+    file of a directory or of every spectrum of an archive.  The spectra are
+    grouped by frequency grid and every group is solved as one batch.
+    Writes to the result directory
+    - drt.txt: filename, potential, R_inf and time constant / resistance of
+      the DRT_PEAKS largest peaks (nan when there are fewer)
+    - drt.npz: filenames, potentials, R_inf and offsets; tau and gamma of
+      spectrum k are tau[offsets[k]:offsets[k+1]], gamma[...]
+    :param filename: data file, directory or archive
+    :param progress: optional callable(done, total) called after every group
+    :return: number of spectra analysed
+    """
+    import os
+    import numpy as np
+    import drt
+    from os import path
+
+    if os.path.isdir(filename):
+        files = data_files(filename)
+        storePath = path.join(filename, "result")
+    else:
+        files = [filename]
+        storePath = path.join(path.split(filename)[0], "result")
+    loaded = []
+    for file in files:
+        data = prepare_data(file, load_data(file))
+        if data is not None:
+            loaded.append((file, data))
+    groups = {}
+    for j, (file, (potential, freq, zTarg, m_weight)) in enumerate(loaded):
+        groups.setdefault(freq.tobytes(), []).append(j)
+
+    found = [None] * len(loaded)
+    done = 0
+    for members in groups.values():
+        freq = loaded[members[0]][1][1]
+        tau, gamma, R_inf, nit = drt.drt(freq, np.array([loaded[j][1][2] for j in members]), DRT_LAMBDA)
+        for s, j in enumerate(members):
+            found[j] = (tau, gamma[s], R_inf[s])
+        done += len(members)
+        if progress is not None:
+            progress(done, len(loaded))
+    if not loaded:
+        return 0
+
+    os.makedirs(storePath, exist_ok=True)
+    with open(path.join(storePath, 'drt.txt'), mode='w', encoding='utf-8') as f:
+        title = ['filename', 'potential', 'R_inf']
+        for k in range(1, DRT_PEAKS + 1):
+            title.extend(['tau_%d' % k, 'R_%d' % k])
+        print('\t'.join(title), file=f)
+        for (file, data), (tau, gamma, R_inf) in zip(loaded, found):
+            peaks = drt.peaks(tau, gamma)[:DRT_PEAKS]
+            peaks += [(np.nan, np.nan)] * (DRT_PEAKS - len(peaks))
+            row = [path.basename(file), str(data[0]), str(R_inf)]
+            row.extend(str(value) for peak in peaks for value in peak)
+            print('\t'.join(row), file=f)
+    offsets = np.zeros(len(found) + 1, dtype=np.int64)
+    np.cumsum([len(tau) for tau, gamma, R_inf in found], out=offsets[1:])
+    np.savez(path.join(storePath, 'drt.npz'), filenames=np.array([path.basename(file) for file, data in loaded]),
+             potentials=np.array([data[0] for file, data in loaded], dtype=np.float64),
+             R_inf=np.array([R_inf for tau, gamma, R_inf in found]), offsets=offsets,
+             tau=np.concatenate([tau for tau, gamma, R_inf in found]),
+             gamma=np.concatenate([gamma for tau, gamma, R_inf in found]))
+    return len(loaded)
+
+
+def screen_file(modelNames, filename):
+    """
+    Fit one spectrum with each of several models, loading it only once
+    :param modelNames: model names (scripts in Models/ or circuit strings)
+    :param filename: data file
+    :return: dict of filename, potential, n_points and fits, the latter
+             {model name: {'keys', 'params', 'cost', 'nfev', 'ier'}}, see
+             screening.Screening.add; None if the file is unreadable
+    """
+    from collections import OrderedDict
+    from Models.registry import get_model
+
+    data = prepare_data(filename, load_data(filename))
+    if data is None:
+        return None
+    potential, freq, zTarg, m_weight = data
+    fits = OrderedDict()
+    for modelName in modelNames:
+        model = get_model(modelName, reload=RELOAD_MODELS)
+        fitresult, cost = fit_spectrum(model, freq, zTarg, m_weight=m_weight)
+        fits[modelName] = {'keys': model.keys, 'params': fitresult[0], 'cost': cost,
+                           'nfev': int(fitresult[2]['nfev']), 'ier': int(fitresult[4])}
+    return {'filename': filename, 'potential': potential, 'n_points': len(freq), 'fits': fits}
+
+
+def _screen_file(args):
+    modelNames, filename = args
+    return screen_file(modelNames, filename)
+
+
+def screen_batch(modelNames, dirname, workers=1, progress=None):
+    """
+    Screen several models on every file of a directory (or on one file).  The
+    files are fitted in rounds of two files per worker; after each round the
+    models that are clearly losing are dropped (see screening.Screening) and
+    no longer fitted.  The comparison is written to result/screening.txt, one
+    row per file, and result/screening_summary.txt, one row per model.
+    :param modelNames: model names (scripts in Models/ or circuit strings)
+    :param dirname: directory holding the data files, or a single data file
+    :param workers: number of processes, 0 for one per CPU, 1 to fit in this process
+    :param progress: optional callable(done, total) called after every file
+    :return: screening.Screening
+    """
+    import os
+    from os import path
+    from concurrent.futures import ProcessPoolExecutor
+    import screening
+
+    if path.isfile(dirname):
+        files = [dirname]
+        storePath = path.join(path.dirname(dirname), "result")
+    else:
+        files = data_files(dirname)
+        storePath = path.join(dirname, "result")
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    workers = min(workers, max(len(files), 1))
+
+    screen = screening.Screening(modelNames, SCREEN_DELTA, SCREEN_MIN_FILES)
+    pool = None
+    if workers > 1:
+        settings = dict((name, globals()[name]) for name in WORKER_SETTINGS)
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(settings,))
+    try:
+        size = 2 * workers if pool is not None else 1
+        done = 0
+        for j in range(0, len(files), size):
+            # 每一轮只拟合仍在竞争中的模型
+            tasks = [(list(screen.active), file) for file in files[j:j + size]]
+            for result in (pool.map(_screen_file, tasks) if pool is not None else map(_screen_file, tasks)):
+                if result is not None:
+                    screen.add(result)
+                done += 1
+                if progress is not None:
+                    progress(done, len(files))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if screen.rows:
+        os.makedirs(storePath, exist_ok=True)
+        screen.write(path.join(storePath, 'screening.txt'))
+        screen.write_summary(path.join(storePath, 'screening_summary.txt'))
+    return screen
+
+
+def write_paras(storePath, modelName, keys, rows, replace=False):
+    """
+    Append fitted rows to storePath/paras.txt in the order given.
+    Only the calling process writes here, so batch workers never race on the file.
+    :param storePath: result directory
+    :param modelName: name of the fitted model, selects the extra columns
+    :param keys: parameter names of the model
+    :param rows: list of rows as returned by para_row
+    :param replace: write a new paras.txt holding rows only
+    """
+    import os
+    from os import path
+
+    os.makedirs(storePath, exist_ok=True)
+    paraFile = path.join(storePath, 'paras.txt')
+    # 写入title，只写入一次，默认如果文件存在就不重复写入
+    writeTitle = replace or not os.path.isfile(paraFile)
+    with open(paraFile, mode='w' if replace else 'a', encoding='utf-8') as f:
+        if writeTitle:
+            title = [str(key) for key in keys]
+            # 在这里加上potential和capacity
+            title.extend(derived_columns(modelName, [1.0] * len(keys)))
+            title.append("potential")
+            print('\t'.join(title), file=f)
+        for row in rows:
+            print('\t'.join(row), file=f)
+
+
+def stored_rows(store, modelName, keys):
+    """
+    :param store: binary result store, see results.read_results
+    :return: the rows of the store as lines of paras.txt, see para_row
+    """
+    import results
+
+    table = results.read_results(store)
+    table = table[table['model'] == modelName]
+    derived = list(derived_columns(modelName, [1.0] * len(keys)))
+    rows = []
+    for values in table[list(keys) + derived + ['potential']].itertuples(index=False):
+        row = [str(para) for para in values[:len(keys)]]
+        row.extend("%.15f" % value for value in values[len(keys):-1])
+        row.append("%.3f" % values[-1])
+        rows.append(row)
+    return rows
+
+
+def write_results(storePath, modelName, keys, records, summary=None, replaced=None, append=False):
+    """
+    Write the records of a batch to the binary result store (see results.py) in
+    one go, plus paras.txt when EXPORT_TEXT is set, and their metrics to the
+    METRICS file when it is set.
+    The rows of the records are appended to paras.txt, unless a file was fitted
+    before: paras.txt is then written anew from the store, so that every file
+    keeps one row only.
+    :param storePath: result directory
+    :param modelName: name of the fitted model
+    :param keys: parameter names of the model
+    :param records: list of records returned by do_fit
+    :param summary: dict of batch figures, written as the closing "batch" metrics line
+    :param replaced: whether some of the records replace stored ones, None to
+                     look it up in the store
+    :param append: write the records as a new part of the store, see
+                   results.ResultSink.close
+    :return: name of the binary store
+    """
+    import time
+    import results
+
+    start = time.perf_counter()
+    sink = results.ResultSink(storePath, keys, RESULT_FORMAT or None)
+    sink.extend(records)
+    if EXPORT_TEXT and replaced is None:
+        replaced = False
+        if records and results.has_results(sink.filename):
+            table = results.read_results(sink.filename)
+            stored = set(zip(table['filename'], table['model']))
+            replaced = any((rec['filename'], rec['model']) in stored for rec in records)
+    store = sink.close(append=append)
+    if EXPORT_TEXT and records:
+        if replaced:
+            write_paras(storePath, modelName, keys, stored_rows(store, modelName, keys), replace=True)
+        else:
+            write_paras(storePath, modelName, keys, [para_row(rec) for rec in records])
+    if METRICS:
+        import metrics
+
+        entries = [rec.get('metrics') for rec in records]
+        if summary is not None:
+            line = {'event': 'batch', 'model': modelName, 'files': len(records)}
+            line.update(summary)
+            line['store_s'] = time.perf_counter() - start
+            entries.append(line)
+        metrics.write_lines(METRICS, entries)
+    return store
+
+
+def _init_worker(settings):
+    """
+    Copy the settings read from config.ini / command line into a batch worker.
+    Spawned workers re-import this module and would otherwise see the defaults.
+    :param settings: dict of WORKER_SETTINGS names and values
+    """
+    globals().update(settings)
+
+
+def _fit_file(args):
+    modelName, filename = args
+    return do_fit(modelName, filename)
+
+
+def _fit_sweep(args):
+    modelName, files = args
+    return fit_sweep(modelName, files)
+
+
+def fit_settings():
+    """
+    :return: dict of the settings a fit result depends on, see manifest.fit_stamp
+    """
+    return dict((name, globals()[name]) for name in WORKER_SETTINGS
+                if name not in ('RELOAD_MODELS', 'EXPORT_TEXT', 'METRICS'))
+
+
+def add_stored_stats(storePath, modelName, files, stats):
+    """
+    Add the stored results of files to stats, for the files an incremental
+    batch did not fit again.
+    """
+    import os
+    import results
+    from collections import OrderedDict
+    from Models.registry import get_model
+
+    store = results.ResultSink(storePath, [], RESULT_FORMAT or None).filename
+    if not results.has_results(store):
+        return
+    table = results.read_results(store)
+    keys = get_model(modelName, reload=RELOAD_MODELS).keys
+    columns = list(keys) + list(derived_columns(modelName, [1.0] * len(keys)))
+    if not set(columns) <= set(table.columns):
         return
+    names = [os.path.basename(file) for file in files]
+    table = table[table['filename'].isin(names) & (table['model'] == modelName)]
+    for potential, values in zip(table['potential'], table[columns].itertuples(index=False)):
+        stats.add(potential, OrderedDict(zip(columns, values)))
+
+
+def batch_fit(modelName, dirname, workers=1, progress=None, vectorized=False, sweep=False,
+              stats=None, incremental=False, settle=0.0, append=False):
+    """
+    Fit every file of a directory, spreading the files over a process pool.
+    Results are merged into the store in dirname/result/ (see write_results) in
+    sorted file name order, whatever order the workers finish in.
+    :param modelName: model script name in Models/
+    :param dirname: directory holding the data files, or a packed archive (see archive.py)
+    :param workers: number of processes, 0 for one per CPU, 1 to fit in this process
+    :param progress: optional callable(done, total) called after every file
+    :param vectorized: fit all spectra as one batched problem instead (see fit_vectorized),
+                       workers is then ignored
+    :param sweep: sort the files by potential and warm-start each fit from the
+                  previous one (see fit_sweep).  The sweep is cut into one
+                  contiguous segment per worker; each segment is chained on its
+                  own, so only the first file of a segment starts from PINIT.
+    :param stats: optional streamstats.StreamingStats, updated as each result
+                  arrives so that partial statistics can be read during the batch
+    :param incremental: fit only the files that are new or changed since their
+                        last fit, or whose model or settings changed (see
+                        manifest.py); stats also gets the stored results of the
+                        others.  Ignored for an archive
+    :param settle: incremental batches leave out files modified less than
+                   this many seconds ago
+    :param append: add the results to the store as a new part rather than
+                   merging them into it (see results.compact), for the many
+                   small batches of a watched directory
+    :return: (keys, records) of the fitted files, keys None when nothing was fitted
+    """
+    import os
+    import time
+    import archive
+    from os import path
+    from concurrent.futures import ProcessPoolExecutor
+
+    start = time.perf_counter()
+    files = data_files(dirname)
+    book = None
+    replaced = None
+    # 打包文件不逐个记录在manifest中，总是全部拟合
+    if incremental and not archive.is_archive(dirname):
+        import manifest
+        from Models.registry import get_model
+
+        storePath = path.join(dirname, "result")
+        book = manifest.Manifest(storePath)
+        stamp = manifest.fit_stamp(modelName, get_model(modelName, reload=RELOAD_MODELS), fit_settings())
+        current, entries = book.stale(files, stamp, settle)
+        files = list(entries)
+        # 已拟合过的文件重新拟合时，paras.txt需要从存储重写；没有manifest时查存储
+        replaced = any(os.path.basename(file) in book.files for file in files) if book.files else None
+        if stats is not None and current and files:
+            add_stored_stats(storePath, modelName, current, stats)
+    if sweep:
+        # sorted() is stable: equal potentials (or POTENTIAL == 0) keep the name order
+        potentials = dict((file, read_potential(file)) for file in files)
+        files = sorted(files, key=lambda file: (potentials[file] is None, potentials[file] or 0.0))
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    workers = min(workers, max(len(files), 1))
+
+    tasks = [(modelName, file) for file in files]
+    keys, records = None, []
+
+    def collect(results):
+        nonlocal keys
+        for j, result in enumerate(results, 1):
+            if result is not None:
+                keys = result[0]
+                records.append(result[1])
+                if stats is not None:
+                    stats.add(result[1]['potential'], record_values(keys, result[1]))
+            if progress is not None:
+                progress(j, len(tasks))
+
+    if vectorized:
+        keys, records = fit_vectorized(modelName, files, progress)
+        for rec in records if stats is not None else ():
+            stats.add(rec['potential'], record_values(keys, rec))
+    elif sweep:
+        size = -(-len(files) // workers)
+        segments = [(modelName, files[j:j + size]) for j in range(0, len(files), size)]
+        if workers == 1:
+            collect(result for chain in map(_fit_sweep, segments) for result in chain)
+        else:
+            settings = dict((name, globals()[name]) for name in WORKER_SETTINGS)
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(settings,)) as pool:
+                collect(result for chain in pool.map(_fit_sweep, segments) for result in chain)
+    elif workers == 1:
+        collect(map(_fit_file, tasks))
+    else:
+        # map() yields in submission order, which keeps the results deterministic
+        chunksize = max(1, len(tasks) // (workers * 4))
+        settings = dict((name, globals()[name]) for name in WORKER_SETTINGS)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(settings,)) as pool:
+            collect(pool.map(_fit_file, tasks, chunksize=chunksize))
+
+    if keys is not None:
+        mode = 'vectorized' if vectorized else 'sweep' if sweep else 'files'
+        summary = {'mode': mode, 'workers': workers, 'wall_s': time.perf_counter() - start}
+        write_results(path.join(dirname, "result"), modelName, keys, records, summary, replaced, append)
+    if book is not None:
+        # 结果写入后再记录，中断的批次下次会重新拟合
+        book.update(entries)
+        book.save()
+    return keys, records
 #    elif path.isdir(filename):
 #        for file in os.listdir(filename):
 #            do_fit(modelName, os.path.join(filename,file))
@@ -151,24 +909,42 @@ if __name__ == '__main__':
 
     import sys,os,getopt
     import configparser
-    import pandas as pd
+    import streamstats
     def usage():
         print('''
         args:
         
         -f finelame
         -v version
-        -m model
+        -m model     (script name in Models/, or a circuit string such as Rs-p(Q1,R1-W1))
+        -j workers   (batch processes for a directory, 0 = all cores)
+        --vectorized (fit a directory as one batched problem)
+        --backend=   (leastsq or trf)
+        --transform  (step log/normalized parameters, for every model)
+        --no-transform (step the raw parameters, for every model)
+        --sweep      (sort a directory by potential, warm-start each fit from the previous)
+        --no-text    (binary result store only, no paras.txt / fitedData text files)
+        --metrics=   (append per-file fit metrics as JSON lines to this file)
+        --screen=    (comma separated models to fit side by side, compared by chi2/AIC/BIC)
+        --bootstrap= (resampled refits per file for bootstrap standard errors, 0 = off)
+        --multistart= (sampled starting points per fit, best fit kept, 0 = off)
+        --drt        (distribution of relaxation times of -f to result/drt.txt, no model fit)
+        --drt-init   (start fits from the DRT guess of the model instead of PINIT)
+        --incremental (fit only new or changed files of a directory)
+        --watch      (keep fitting new files of a directory as they appear)
+        --pack=      (pack the data files of -f into this archive, then fit -f archive)
+        --serve=     (fit spectra sent as JSON lines to this port / host:port / socket path, -j workers)
         
         
         ''')
 
     basePath = os.path.dirname(os.path.abspath(__file__))
 
-    shortArgs = 'f:m:v'
-    longArgs = ['file=', 'mode=', 'version']
+    shortArgs = 'f:m:vj:'
+    longArgs = ['file=', 'mode=', 'version', 'jobs=', 'vectorized', 'backend=', 'transform', 'no-transform', 'sweep', 'no-text', 'metrics=', 'screen=', 'bootstrap=', 'multistart=', 'drt', 'drt-init', 'serve=', 'incremental', 'watch', 'pack=']
 
     modelName = "ls(cpr)"
+    packPath = ""
     filename = os.path.join(basePath,"Sample.csv")
 
     opts,args = getopt.getopt(sys.argv[1:],shortArgs,longArgs)
@@ -181,9 +957,41 @@ if __name__ == '__main__':
         conf.read(confPath)
         filename = conf.get('Configs','File_Path')
         modelName= conf.get('Configs','Equiv_Circle_Model')
+        RELOAD_MODELS = conf.getint('Configs', 'Reload_Models', fallback=RELOAD_MODELS)
         SKIPROWS =conf.getint('DataFormat','SkipRows')
         POTENTIAL=conf.getint('DataFormat','Potential_Position')
         DELIMITER=str(conf.get('DataFormat','Delimiter')).lower()
+        WORKERS = conf.getint('Batch', 'Workers', fallback=WORKERS)
+        VECTORIZED = conf.getint('Batch', 'Vectorized', fallback=VECTORIZED)
+        SWEEP = conf.getint('Batch', 'Sweep', fallback=SWEEP)
+        INCREMENTAL = conf.getint('Batch', 'Incremental', fallback=INCREMENTAL)
+        WATCH = conf.getint('Batch', 'Watch', fallback=WATCH)
+        WATCH_INTERVAL = conf.getfloat('Batch', 'Watch_Interval', fallback=WATCH_INTERVAL)
+        BACKEND = conf.get('Fitting', 'Backend', fallback=BACKEND).strip().lower()
+        TRANSFORM = conf.get('Fitting', 'Transform', fallback=TRANSFORM).strip()
+        MULTISTART = conf.getint('Fitting', 'Multistart', fallback=MULTISTART)
+        MULTISTART_METHOD = conf.get('Fitting', 'Multistart_Method', fallback=MULTISTART_METHOD).strip().lower()
+        MULTISTART_DE = conf.getint('Fitting', 'Differential_Evolution', fallback=MULTISTART_DE)
+        DRT_INIT = conf.getint('DRT', 'Init', fallback=DRT_INIT)
+        DRT_LAMBDA = conf.getfloat('DRT', 'Lambda', fallback=DRT_LAMBDA)
+        DRT_PEAKS = conf.getint('DRT', 'Peaks', fallback=DRT_PEAKS)
+        RESULT_FORMAT = conf.get('Output', 'Format', fallback=RESULT_FORMAT).strip().lower()
+        EXPORT_TEXT = conf.getint('Output', 'Export_Text', fallback=EXPORT_TEXT)
+        METRICS = conf.get('Output', 'Metrics', fallback=METRICS).strip()
+        F_MIN = conf.getfloat('Preprocess', 'F_Min', fallback=F_MIN)
+        F_MAX = conf.getfloat('Preprocess', 'F_Max', fallback=F_MAX)
+        DROP_INDUCTIVE = conf.getint('Preprocess', 'Drop_Inductive', fallback=DROP_INDUCTIVE)
+        WEIGHTING = conf.get('Preprocess', 'Weighting', fallback=WEIGHTING).strip().lower()
+        OUTLIER_SIGMA = conf.getfloat('Preprocess', 'Outlier_Sigma', fallback=OUTLIER_SIGMA)
+        KK_TEST = conf.getint('Preprocess', 'KK_Test', fallback=KK_TEST)
+        KK_MAX = conf.getfloat('Preprocess', 'KK_Max', fallback=KK_MAX)
+        SCREEN = conf.get('Screening', 'Models', fallback=SCREEN).strip()
+        SCREEN_DELTA = conf.getfloat('Screening', 'Delta_AIC', fallback=SCREEN_DELTA)
+        SCREEN_MIN_FILES = conf.getint('Screening', 'Min_Files', fallback=SCREEN_MIN_FILES)
+        SERVE = conf.get('Service', 'Address', fallback=SERVE).strip()
+        SERVE_QUEUE = conf.getint('Service', 'Queue_Size', fallback=SERVE_QUEUE)
+        BOOTSTRAP = conf.getint('Uncertainty', 'Bootstrap', fallback=BOOTSTRAP)
+        BOOTSTRAP_MODE = conf.get('Uncertainty', 'Mode', fallback=BOOTSTRAP_MODE).strip().lower()
         print('read config.ini success!')
         # print(DATAFORMAT[DELIMITER])
 
@@ -196,36 +1004,138 @@ if __name__ == '__main__':
             elif opt in ('-m', '--model='):
                 modelName = val
                 modelPath = os.path.join(basePath, 'Models/' + modelName + '.py')
+                from Models import circuit
+                # 不在Models/中的模型名按电路字符串编译, 如 Rs-p(Q1,R1-W1)
                 if not os.path.exists(modelPath):
-                    print("model does not exit", file=sys.stdout)
-                    sys.exit(2)
+                    if not circuit.is_circuit(modelName):
+                        print("model does not exit", file=sys.stdout)
+                        sys.exit(2)
+                    try:
+                        circuit.parameter_names(circuit.parse(modelName))
+                    except ValueError as e:
+                        print(e, file=sys.stdout)
+                        sys.exit(2)
+            elif opt in ('-j', '--jobs'):
+                WORKERS = int(val)
+            elif opt == '--vectorized':
+                VECTORIZED = 1
+            elif opt == '--sweep':
+                SWEEP = 1
+            elif opt == '--incremental':
+                INCREMENTAL = 1
+            elif opt == '--watch':
+                WATCH = 1
+            elif opt == '--pack':
+                packPath = val
+            elif opt == '--backend':
+                BACKEND = val.strip().lower()
+            elif opt == '--transform':
+                TRANSFORM = "1"
+            elif opt == '--no-transform':
+                TRANSFORM = "0"
+            elif opt == '--no-text':
+                EXPORT_TEXT = 0
+            elif opt == '--metrics':
+                METRICS = val.strip()
+            elif opt == '--screen':
+                SCREEN = val.strip()
+            elif opt == '--bootstrap':
+                BOOTSTRAP = int(val)
+            elif opt == '--multistart':
+                MULTISTART = int(val)
+            elif opt == '--drt':
+                DRT = 1
+            elif opt == '--drt-init':
+                DRT_INIT = 1
+            elif opt == '--serve':
+                SERVE = val.strip()
             elif opt in ('-v', '--version'):
                     print('VERSION %s'.format(VERSIONS))
                     usage()
                     sys.exit(2)
 
 
-    if os.path.isfile(filename):
+    if packPath:
+        # 把目录中的数据文件打包为一个内存映射文件，之后用 -f 打包文件 拟合
+        import archive
+
+        if not os.path.isdir(filename):
+            print("--pack needs a data directory")
+            sys.exit(2)
+        try:
+            count, skipped = archive.pack(filename, packPath, SKIPROWS, DATAFORMAT[DELIMITER], POTENTIAL,
+                                          IMPORT_TYPE)
+        except ValueError as e:
+            print(e)
+            sys.exit(2)
+        print("packed %d spectra into %s, %d files skipped" % (count, packPath, len(skipped)))
+
+    elif SERVE:
+        # 服务模式：从套接字接收实时谱图并拟合，直到中断
+        import service
+
+        service.serve(modelName, SERVE, WORKERS if WORKERS > 0 else (os.cpu_count() or 1), SERVE_QUEUE,
+                      backend=BACKEND or None, transform=fit_transform())
+
+    elif DRT and (os.path.isfile(filename) or os.path.isdir(filename)):
+        # DRT分析：不拟合模型，同一频率网格的谱图批量求解
+        count = drt_batch(filename)
+        print("DRT of %d spectra written to result/drt.txt" % count)
+
+    elif SCREEN and (os.path.isfile(filename) or os.path.isdir(filename)):
+        # 多模型筛选：每个文件只读一次，依次拟合所有候选模型
+        import screening
+
+        sys.stdout.write("#"*int(81)+'|')
+        def progress(j, total):
+            sys.stdout.write('\r'+(j*80//total)*'-'+'->|'+"\b"*3)
+            sys.stdout.flush()
+
+        screen = screen_batch(screening.split_models(SCREEN), filename, WORKERS, progress)
+        sys.stdout.write("\n")
+        print(screen.summary().to_string(index=False))
+
+    elif os.path.isfile(filename):
         print("data is file")
-        do_fit(modelName, filename)
+        # 单个文件：多起点拟合的各个起点分配到 -j 个进程
+        MULTISTART_WORKERS = WORKERS if WORKERS > 0 else (os.cpu_count() or 1)
+        result = do_fit(modelName, filename)
+        if result is not None:
+            write_results(os.path.join(os.path.split(filename)[0], "result"), modelName, result[0], [result[1]])
+
+    elif os.path.isdir(filename) and WATCH:
+        # 监视目录：定时检查，只拟合新增或修改的文件
+        import time
+        print("watching %s, Ctrl-C to stop" % filename)
+        try:
+            while True:
+                stats = streamstats.StreamingStats()
+                keys, records = batch_fit(modelName, filename, WORKERS, vectorized=VECTORIZED, sweep=SWEEP,
+                                          stats=stats, incremental=True, settle=WATCH_INTERVAL, append=True)
+                if records:
+                    stats.write(os.path.join(filename,"result/statstistic.txt"))
+                    print("%s fitted %d files" % (time.strftime('%H:%M:%S'), len(records)))
+                time.sleep(WATCH_INTERVAL)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # 每次检查只写入新增的部分，结束时合并为一个存储
+            import results
+            results.compact(results.ResultSink(os.path.join(filename, "result"), [], RESULT_FORMAT or None).filename)
 
     elif os.path.isdir(filename):
         print("data is dir")
         sys.stdout.write("#"*int(81)+'|')
-        j=0
-        for file in os.listdir(filename):
-            _filename = os.path.join(filename,file)
-            if os.path.isfile(_filename):
-                do_fit(modelName,_filename)
-                j+=1
-                sys.stdout.write('\r'+(j*80//len(os.listdir(filename)))*'-'+'->|'+"\b"*3)
-                sys.stdout.flush()
-
-        paraFile = os.path.join(filename,"result/paras.txt")
-        stat = pd.read_csv(paraFile,sep='\t',index_col=-1)
-        gp = stat.groupby('potential')
-        gpStat = gp.describe()
-        gpStat.to_csv(os.path.join(filename,"result/statstistic.txt"),sep='\t')
+        def progress(j, total):
+            sys.stdout.write('\r'+(j*80//total)*'-'+'->|'+"\b"*3)
+            sys.stdout.flush()
+
+        # 每个拟合结果到达时即更新统计，不再重新读取paras.txt
+        stats = streamstats.StreamingStats()
+        batch_fit(modelName, filename, WORKERS, progress, vectorized=VECTORIZED, sweep=SWEEP, stats=stats,
+                  incremental=INCREMENTAL)
+        if len(stats):
+            stats.write(os.path.join(filename,"result/statstistic.txt"))
         
         sys.stdout.write("\nFINISHED! at %s\\result \n"%filename)
         
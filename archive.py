@@ -0,0 +1,172 @@
+"""
+Packed spectrum archive for large campaigns
+
+A campaign of many small data files is packed once into an archive
+directory holding
+
+    freq.npy        all frequencies, one spectrum after the other (float64)
+    impedance.npy   the complex impedances in the same order (complex128)
+    index.npz       names, offsets (spectrum k is offsets[k]:offsets[k+1]),
+                    potentials, and the loader settings and source directory
+                    as a JSON string
+
+Both data arrays are opened with np.load(mmap_mode='r'): opening an archive
+reads the index only, and a spectrum is a slice of the mapped arrays, read
+from the page cache without a copy and without parsing text.  Every process
+that opens the archive shares those pages, so batch workers are handed the
+name of a spectrum, never its data.
+
+A spectrum is addressed like a file in a directory, as
+os.path.join(archivePath, name); Zfit.py reads such paths through
+open_archive() and fits an archive like a directory of files:
+
+    py Zfit.py -f ./FRA --pack=./FRA.zfa
+    py Zfit.py -f ./FRA.zfa -j 4
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+INDEX = 'index.npz'
+FREQ = 'freq.npy'
+IMPEDANCE = 'impedance.npy'
+
+# archives opened in this process, by absolute path
+_archives = {}
+
+
+def is_archive(path):
+    """
+    :return: True when path is an archive directory written by pack()
+    """
+    return os.path.isfile(os.path.join(path, INDEX)) and os.path.isfile(os.path.join(path, FREQ))
+
+
+def is_member(filename):
+    """
+    :return: True when filename names a spectrum inside an archive
+    """
+    return is_archive(os.path.dirname(filename))
+
+
+class Archive(object):
+    """
+    Read access to one packed archive
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with np.load(os.path.join(path, INDEX)) as index:
+            self.names = index['names']
+            self.offsets = index['offsets']
+            self.potentials = index['potentials']
+            self.meta = json.loads(str(index['meta']))
+        self._position = None
+        self.freq = np.load(os.path.join(path, FREQ), mmap_mode='r')
+        self.impedance = np.load(os.path.join(path, IMPEDANCE), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.names)
+
+    def index(self, k):
+        """
+        :param k: position of a spectrum, or its name
+        :return: position of the spectrum
+        """
+        if isinstance(k, (int, np.integer)):
+            return k
+        if self._position is None:
+            # built on the first lookup by name only, opening stays cheap
+            self._position = dict((str(name), j) for j, name in enumerate(self.names))
+        return self._position[k]
+
+    def paths(self):
+        """
+        :return: member paths of all spectra, in packing order
+        """
+        return [os.path.join(self.path, str(name)) for name in self.names]
+
+    def spectrum(self, k):
+        """
+        :param k: position of the spectrum, or its name
+        :return: (potential, frequency array, complex impedance array); the
+                 arrays are read-only views of the mapping
+        """
+        k = self.index(k)
+        start, stop = self.offsets[k], self.offsets[k + 1]
+        return float(self.potentials[k]), self.freq[start:stop], self.impedance[start:stop]
+
+    def potential(self, k):
+        return float(self.potentials[self.index(k)])
+
+
+def open_archive(path):
+    """
+    :return: Archive of path, opened once per process
+    """
+    key = os.path.abspath(path)
+    archive = _archives.get(key)
+    if archive is None:
+        archive = _archives[key] = Archive(path)
+    return archive
+
+
+def pack(dirname, archivePath, skiprows=1, delimiter='\t', potential=0, import_type="Zreal_Zimag"):
+    """
+    Pack every readable data file of a directory into an archive.  The
+    archive is written next to its final place and renamed into it, so a
+    reader never sees a half-written archive.
+    :param dirname: directory holding the data files
+    :param archivePath: archive directory to create; the data of an existing
+                        archive is replaced, while everything else in it, such
+                        as the result directory of Zfit.py, is kept.  Any other
+                        existing path is left alone
+    :param skiprows, delimiter, potential, import_type: loader settings of the files, see loader.load_spectrum
+    :return: (number of packed spectra, list of files that could not be read)
+    :raises ValueError: when archivePath is dirname or inside it, or exists
+                        and is not an archive
+    """
+    import loader
+
+    source, target = os.path.realpath(dirname), os.path.realpath(archivePath)
+    if os.path.commonpath([source, target]) == source:
+        raise ValueError("archive %s must not be the data directory %s or inside it" % (archivePath, dirname))
+    if os.path.exists(archivePath) and not is_archive(archivePath):
+        raise ValueError("%s exists and is not an archive, not replaced" % archivePath)
+    files = sorted(name for name in os.listdir(dirname) if os.path.isfile(os.path.join(dirname, name)))
+    names, potentials, freqs, impedances, skipped = [], [], [], [], []
+    for name in files:
+        try:
+            E, freq, Z = loader.load_spectrum(os.path.join(dirname, name), skiprows, delimiter,
+                                              potential, import_type)
+        except ValueError:
+            skipped.append(name)
+            continue
+        names.append(name)
+        potentials.append(E)
+        freqs.append(freq)
+        impedances.append(Z)
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum([len(freq) for freq in freqs], out=offsets[1:])
+    meta = {'source': os.path.abspath(dirname), 'skiprows': skiprows, 'delimiter': delimiter,
+            'potential': potential, 'import_type': import_type}
+
+    temp = archivePath.rstrip('/\\') + '.%d.tmp' % os.getpid()
+    os.makedirs(temp)
+    np.save(os.path.join(temp, FREQ), np.concatenate(freqs) if freqs else np.zeros(0))
+    np.save(os.path.join(temp, IMPEDANCE), np.concatenate(impedances) if impedances
+            else np.zeros(0, dtype=np.complex128))
+    np.savez(os.path.join(temp, INDEX), names=np.array(names, dtype=str), offsets=offsets,
+             potentials=np.array(potentials, dtype=np.float64), meta=np.array(json.dumps(meta)))
+    if os.path.isdir(archivePath):
+        # keep the fit results and the manifest Zfit.py wrote into the archive
+        for entry in os.listdir(archivePath):
+            if entry not in (INDEX, FREQ, IMPEDANCE):
+                os.replace(os.path.join(archivePath, entry), os.path.join(temp, entry))
+        shutil.rmtree(archivePath)
+    os.replace(temp, archivePath)
+    _archives.pop(os.path.abspath(archivePath), None)
+    return len(names), skipped
@@ -0,0 +1,49 @@
+"""
+Penalty-based leastsq against bounded least_squares(method='trf')
+
+    python benchmarks/bench_backends.py [n_points]
+
+For every bundled model, fits one synthetic spectrum with both backends of
+modelcore.Fitter and reports the time to converge, the number of function
+evaluations and the final cost.  The cost is the plain sum of squared
+residuals, without the bound penalties of leastsq, so the two are comparable.
+'inside' tells whether the result respects the (min, max) bounds in PARAMS.
+"""
+
+import sys
+import time
+import warnings
+
+import numpy as np
+
+from synthetic import frequency_grid, synthetic_spectrum
+from Models.registry import get_model, available_models
+from Models.modelcore import Fitter, _ResidualEngine
+
+REPEAT = 3
+
+
+def bench(name, n_points, backend):
+    spec = get_model(name)
+    f = frequency_grid(name, n_points)
+    Z, p = synthetic_spectrum(spec, f)
+    m_weight = np.ones(n_points)
+    fitter = Fitter(spec, backend=backend)
+    best = np.inf
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        params, cov_x, infodict, mesg, ier = fitter.fit(Z, m_weight, f)
+        best = min(best, time.perf_counter() - start)
+    engine = _ResidualEngine(spec.model, 2 * np.pi * f, Z, m_weight, spec.lower, spec.upper, None)
+    cost = np.sum(engine.residuals(params) ** 2)
+    inside = bool(np.all((params >= spec.lower) & (params <= spec.upper)))
+    return best * 1e3, infodict['nfev'], cost, ier, inside
+
+
+if __name__ == '__main__':
+    n_points = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    warnings.simplefilter('ignore', RuntimeWarning)
+    print('%-15s %-8s %10s %7s %12s %4s %6s' % ('model', 'backend', 'time[ms]', 'nfev', 'cost', 'ier', 'inside'))
+    for name in available_models():
+        for backend in ('leastsq', 'trf'):
+            print('%-15s %-8s %10.2f %7d %12.5g %4d %6s' % ((name, backend) + bench(name, n_points, backend)))
@@ -0,0 +1,55 @@
+"""
+Batched fits (Models.modelcore.fit_batch) against one fit per spectrum
+
+    python benchmarks/bench_batch.py [n_spectra] [n_points] [model ...]
+
+For every model, n_spectra synthetic spectra are generated from PINIT moved
+by up to 30% at random (kept inside the bounds) plus 0.1% noise, and fitted
+from PINIT once by fit_batch() and once per spectrum by fit_model().  The
+table gives both wall times, the number of spectra whose batched cost is
+above twice their single-fit cost, and the spectra that fit_batch refitted
+one by one (iteration limit reached, or cost far above the others).
+"""
+
+import sys
+import time
+import warnings
+
+import numpy as np
+
+from synthetic import frequency_grid
+from Models.registry import get_model, available_models
+from Models.modelcore import fit_batch, fit_model
+
+
+def spectra(spec, f, n_spectra, spread=0.3, noise=1e-3, seed=0):
+    rng = np.random.default_rng(seed)
+    P = spec.init_val * (1 + spread * rng.uniform(-1, 1, (n_spectra, len(spec.init_val))))
+    P = np.clip(P, spec.lower, spec.upper)
+    w = 2 * np.pi * f
+    Z = np.array([spec.model(w, p) for p in P])
+    return Z * (1 + noise * (rng.standard_normal(Z.shape) + 1j * rng.standard_normal(Z.shape)))
+
+
+def bench(name, n_spectra, n_points):
+    spec = get_model(name)
+    f = frequency_grid(name, n_points)
+    Z = spectra(spec, f, n_spectra)
+    m_weight = np.ones(n_points)
+    start = time.perf_counter()
+    params, info = fit_batch(spec, Z, m_weight, f)
+    t_batch = time.perf_counter() - start
+    start = time.perf_counter()
+    single = [fit_model(spec, z, m_weight, f) for z in Z]
+    t_single = time.perf_counter() - start
+    cost = np.array([np.sum(result[2]['fvec'] ** 2) for result in single])
+    return t_batch, t_single, int(np.sum(info['cost'] > 2 * cost)), int(np.sum(info['refit']))
+
+
+if __name__ == '__main__':
+    n_spectra = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    n_points = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    warnings.simplefilter('ignore', RuntimeWarning)
+    print('%-15s %9s %10s %10s %9s' % ('model', 'batch_s', 'single_s', 'cost>2x', 'refitted'))
+    for name in sys.argv[3:] or available_models():
+        print('%-15s %9.2f %10.2f %10d %9d' % ((name,) + bench(name, n_spectra, n_points)))
@@ -0,0 +1,46 @@
+"""
+Fused model evaluation (Models/fusion.py) against the plain model scripts
+
+    python benchmarks/bench_fusion.py [n_points,...] [model ...]
+
+For every bundled model and grid size, times one model(w, params) call of
+the script and of the script decorated with @fused, and checks that both
+give the same impedance.  Below fusion.MIN_POINTS the fused model calls the
+plain one, so the sizes are timed with the threshold lowered to 0.
+"""
+
+import sys
+import timeit
+import warnings
+
+import numpy as np
+
+from synthetic import frequency_grid
+from Models import fusion
+from Models.registry import get_model, available_models
+
+
+def per_call(fn, number=100):
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number
+
+
+def bench(name, n_points):
+    spec = get_model(name)
+    w = 2 * np.pi * frequency_grid(name, n_points)
+    p = spec.init_val * 1.1
+    plain = getattr(spec.model, 'plain', spec.model)
+    model = fusion.fused(plain)
+    diff = np.max(np.abs(model(w, p) - plain(w, p)))
+    return per_call(lambda: plain(w, p)) * 1e6, per_call(lambda: model(w, p)) * 1e6, diff
+
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1].split(',')] if len(sys.argv) > 1 else [60, 1000, 10000]
+    warnings.simplefilter('ignore', RuntimeWarning)
+    fusion.MIN_POINTS = 0
+    print('%-15s %7s %10s %10s %8s %9s' % ('model', 'points', 'plain_us', 'fused_us', 'ratio', 'max_diff'))
+    for name in sys.argv[2:] or available_models():
+        for n_points in sizes:
+            t_plain, t_fused, diff = bench(name, n_points)
+            print('%-15s %7d %10.1f %10.1f %8.2f %9.1e' % (name, n_points, t_plain, t_fused,
+                                                          t_fused / t_plain, diff))
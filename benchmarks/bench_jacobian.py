@@ -0,0 +1,55 @@
+"""
+Function evaluations and time per fit with and without a Jacobian
+
+    python benchmarks/bench_jacobian.py [n_points]
+
+Without a Jacobian, leastsq estimates one by finite differences and every
+such estimate counts n_params extra function calls in nfev.  With one, nfev
+only counts the residual evaluations and njev the Jacobian evaluations.
+R(Q(RW)) declares jacobian() in its model script, the other models are
+differentiated automatically (Models/autodiff.py) here, whether or not their
+script sets AUTODIFF: fewer evaluations do not make a faster fit when a Dual
+evaluation costs several model calls, which is why only the models where it
+measured faster opt in.
+"""
+
+import copy
+import sys
+import time
+
+import numpy as np
+
+from synthetic import frequency_grid, synthetic_spectrum
+from Models.registry import get_model
+from Models.autodiff import jacobian_for
+from Models.modelcore import Fitter
+
+MODELS = ['R(Q(RW))', 'rp(csr)p(lsr)', 'trans_line1', 'R(C(RW))']
+REPEAT = 5
+
+
+def bench(name, n_points):
+    spec = copy.copy(get_model(name))
+    if spec.jacobian is None:
+        spec.jacobian = jacobian_for(spec.model, len(spec.keys))
+    f = frequency_grid(name, n_points)
+    Z, p = synthetic_spectrum(spec, f)
+    m_weight = np.ones(len(f))
+    rows = []
+    for use_jacobian in (False, True):
+        fitter = Fitter(spec, jacobian=use_jacobian)
+        start = time.perf_counter()
+        for _ in range(REPEAT):
+            params, cov_x, infodict, mesg, ier = fitter.fit(Z, m_weight, f)
+        elapsed = (time.perf_counter() - start) / REPEAT
+        rows.append((name, 'jacobian' if use_jacobian else 'finite diff', infodict['nfev'],
+                     infodict.get('njev', 0), elapsed * 1e3, np.sum(infodict['fvec'] ** 2), ier))
+    return rows
+
+
+if __name__ == '__main__':
+    n_points = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    print('%-15s %-12s %8s %8s %10s %12s %4s' % ('model', 'jacobian', 'nfev', 'njev', 'time[ms]', 'cost', 'ier'))
+    for name in MODELS:
+        for row in bench(name, n_points):
+            print('%-15s %-12s %8d %8d %10.2f %12.4g %4d' % row)
@@ -0,0 +1,68 @@
+"""
+Spectrum files loaded per second
+
+    python benchmarks/bench_loader.py [n_files] [n_points]
+
+Writes n_files four-column spectra (potential, frequency, Z', Z") into a
+temporary directory and loads them with the per-line split parser Zfit.py
+used to have (copied below as _legacy_load) and with loader.load_spectrum.
+Both results are compared before the timings are printed.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from loader import load_spectrum
+
+
+def _legacy_load(filename, skiprows=1, delimiter='\t'):
+    with open(filename) as _f:
+        d = _f.read().splitlines()[skiprows:]
+    data = [_d.split(delimiter) for _d in d]
+    potential = float(data[0][0])
+    data = np.array([_d[1:] for _d in data], dtype=np.float64).T
+    frequency, Zreal, Zimage = data[0:3]
+    zTarg = np.array([_Zreal - _Zimage * 1j for _Zreal, _Zimage in zip(Zreal, Zimage)], dtype=np.complex128)
+    return potential, np.array(frequency, dtype=np.float64), zTarg
+
+
+def write_files(dirname, n_files, n_points):
+    rng = np.random.default_rng(0)
+    f = np.logspace(-1, 5, n_points)
+    files = []
+    for k in range(n_files):
+        filename = os.path.join(dirname, 'spec_%05d.txt' % k)
+        rows = np.column_stack([np.full(n_points, -0.5 + 0.01 * k), f, 1e4 * rng.random((n_points, 2))])
+        np.savetxt(filename, rows, fmt=['%.4f', '%g', '%.6f', '%.6f'], delimiter='\t',
+                   header='E\tf\tZr\tZi', comments='')
+        files.append(filename)
+    return files
+
+
+def timed(load, files):
+    start = time.perf_counter()
+    results = [load(file) for file in files]
+    return results, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    n_files = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_points = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    with tempfile.TemporaryDirectory() as dirname:
+        files = write_files(dirname, n_files, n_points)
+        legacy, t_legacy = timed(_legacy_load, files)
+        loaded, t_loaded = timed(lambda file: load_spectrum(file, 1, '\t', 1), files)
+    for (E0, f0, Z0), (E1, f1, Z1) in zip(legacy, loaded):
+        assert E0 == E1 and np.array_equal(f0, f1) and np.array_equal(Z0, Z1)
+    print('%d files of %d points' % (n_files, n_points))
+    print('%-15s %12s' % ('loader', 'files/s'))
+    print('%-15s %12.0f' % ('legacy split', n_files / t_legacy))
+    print('%-15s %12.0f' % ('load_spectrum', n_files / t_loaded))
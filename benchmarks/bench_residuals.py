@@ -0,0 +1,70 @@
+"""
+Residual evaluations per second
+
+    python benchmarks/bench_residuals.py [n_points ...]
+
+Compares the residual function leastsq used to be given (copied below as
+_legacy_b_residuals) with modelcore._ResidualEngine, which writes into
+buffers allocated once per fit.  The model evaluation itself is included in
+both, so the gain shrinks for expensive models such as trans_line1.
+"""
+
+import sys
+import timeit
+
+import numpy as np
+
+from synthetic import frequency_grid, synthetic_spectrum
+from Models.registry import get_model
+from Models.modelcore import _ResidualEngine
+
+MODELS = ['R(CR)', 'R(Q(RW))', 'xdcr2', 'trans_line1']
+
+
+def _legacy_residuals(params, model, w, Z, m_weight):
+    diff = Z - model(w, params)
+    diff *= m_weight
+    diff.astype(np.complex128)
+    zd = np.zeros(Z.size*2, dtype=np.float64)
+    zd[0:zd.size:2] = diff.real.astype(np.float64)
+    zd[1:zd.size:2] = diff.imag.astype(np.float64)
+    return zd
+
+
+def _legacy_penalties(params, bounds, b_weight):
+    penalties = [np.fmin(x-lo, 0) + np.fmax(0, x-hi) for x, (lo, hi) in zip(params, bounds)]
+    return b_weight * np.array(penalties)
+
+
+def _legacy_b_residuals(params, model, w, Z, m_weight, bounds, b_weight):
+    return np.hstack((_legacy_residuals(params, model, w, Z, m_weight),
+                      _legacy_penalties(params, bounds, b_weight)))
+
+
+def evals_per_second(func, *args):
+    number, elapsed = timeit.Timer(lambda: func(*args)).autorange()
+    best = min([elapsed] + timeit.Timer(lambda: func(*args)).repeat(3, number))
+    return number / best
+
+
+def bench(name, n_points):
+    spec = get_model(name)
+    f = frequency_grid(name, n_points)
+    w = 2 * np.pi * f
+    Z, p = synthetic_spectrum(spec, f)
+    m_weight = np.ones(n_points)
+    b_weight = n_points * spec.boundweight
+    engine = _ResidualEngine(spec.model, w, Z, m_weight, spec.lower, spec.upper, b_weight)
+    assert np.array_equal(engine.residuals(spec.init_val),
+                          _legacy_b_residuals(spec.init_val, spec.model, w, Z, m_weight, spec.bounds, b_weight))
+    before = evals_per_second(_legacy_b_residuals, spec.init_val, spec.model, w, Z, m_weight, spec.bounds, b_weight)
+    after = evals_per_second(engine.residuals, spec.init_val)
+    return name, n_points, before, after, after / before
+
+
+if __name__ == '__main__':
+    sizes = [int(n) for n in sys.argv[1:]] or [100, 1000, 10000]
+    print('%-12s %8s %14s %14s %8s' % ('model', 'points', 'before[1/s]', 'after[1/s]', 'speedup'))
+    for name in MODELS:
+        for n_points in sizes:
+            print('%-12s %8d %14.0f %14.0f %8.2f' % bench(name, n_points))
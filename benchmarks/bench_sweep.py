@@ -0,0 +1,74 @@
+"""
+Warm-starting the fits of a potential sweep
+
+    python benchmarks/bench_sweep.py [n_potentials] [n_points] [model ...]
+
+For every bundled model, generates a sweep of spectra whose parameters drift
+smoothly from -40% to +40% around PINIT, and fits it three times: every
+spectrum from PINIT ('PINIT'), every spectrum from the result of the
+previous one ('chained'), and chained with the fall-back of Zfit.py --sweep
+('sweep': a warm start limited to SWEEP_BUDGET times the evaluations of the
+last PINIT fit, repeated from PINIT when it runs out or its cost jumps
+SWEEP_RESET times).  Reports the mean and largest number of function
+evaluations per spectrum (a repeated fit included), the time per spectrum
+and the number of fits repeated from PINIT.
+"""
+
+import sys
+import time
+import warnings
+
+import numpy as np
+
+from synthetic import frequency_grid
+from Models.registry import get_model, available_models
+from Models.modelcore import Fitter, batch_model
+from Zfit import SWEEP_BUDGET, SWEEP_RESET
+
+
+def bench(name, n_potentials, n_points, start):
+    spec = get_model(name)
+    f = frequency_grid(name, n_points)
+    signs = np.where(np.arange(len(spec.keys)) % 2 == 0, 1.0, -1.0)
+    drift = np.linspace(-0.4, 0.4, n_potentials)[:, np.newaxis] * signs
+    P = np.clip(spec.init_val * (1 + drift), spec.lower, spec.upper)
+    rng = np.random.default_rng(0)
+    Z = batch_model(spec.model, 2 * np.pi * f, P)
+    Z = Z * (1 + 1e-3 * (rng.standard_normal(Z.shape) + 1j * rng.standard_normal(Z.shape)))
+    m_weight = np.ones(n_points)
+    fitter = Fitter(spec)
+    nfev, most, restarts = 0, 0, 0
+    p0, lastCost, coldNfev = None, None, None
+    begin = time.perf_counter()
+    for z in Z:
+        if start == 'sweep' and p0 is not None:
+            result = Fitter(spec, maxfev=SWEEP_BUDGET * coldNfev).fit(z, m_weight, f, p0)
+        else:
+            result = fitter.fit(z, m_weight, f, p0)
+        spent = result[2]['nfev']
+        cost = np.sum(result[2]['fvec'] ** 2)
+        if p0 is None:
+            coldNfev = spent
+        if start == 'sweep' and p0 is not None and (result[4] == 5 or not cost <= SWEEP_RESET * lastCost):
+            cold = fitter.fit(z, m_weight, f)
+            coldNfev = cold[2]['nfev']
+            spent += coldNfev
+            restarts += 1
+            if np.sum(cold[2]['fvec'] ** 2) < cost:
+                result, cost = cold, np.sum(cold[2]['fvec'] ** 2)
+        nfev += spent
+        most = max(most, spent)
+        if start != 'PINIT':
+            p0, lastCost = result[0], cost
+    elapsed = time.perf_counter() - begin
+    return nfev / n_potentials, most, elapsed / n_potentials * 1e3, restarts
+
+
+if __name__ == '__main__':
+    n_potentials = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    n_points = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    warnings.simplefilter('ignore', RuntimeWarning)
+    print('%-15s %-8s %10s %10s %10s %9s' % ('model', 'start', 'nfev/fit', 'max nfev', 'ms/fit', 'restarts'))
+    for name in sys.argv[3:] or available_models():
+        for start in ('PINIT', 'chained', 'sweep'):
+            print('%-15s %-8s %10.1f %10d %10.2f %9d' % ((name, start) + bench(name, n_potentials, n_points, start)))
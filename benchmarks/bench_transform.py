@@ -0,0 +1,54 @@
+"""
+Fitting in the scaled parameter space of modelcore.ParamTransform
+
+    python benchmarks/bench_transform.py [n_spectra] [n_points] [model ...]
+
+For every bundled model, fits a batch of synthetic spectra whose true
+parameters are spread up to +-50% around PINIT, with and without the
+transform, and reports the mean number of function evaluations, the time per
+fit and the number of failed fits.  A fit counts as failed when its cost
+ends above twice the cost of the true parameters.
+"""
+
+import sys
+import time
+import warnings
+
+import numpy as np
+
+from synthetic import frequency_grid
+from Models.registry import get_model, available_models
+from Models.modelcore import Fitter, _ResidualEngine, batch_model
+
+
+def bench(name, n_spectra, n_points, transform, backend='leastsq'):
+    spec = get_model(name)
+    f = frequency_grid(name, n_points)
+    w = 2 * np.pi * f
+    rng = np.random.default_rng(0)
+    P = spec.init_val * (1 + 0.5 * rng.uniform(-1, 1, (n_spectra, len(spec.keys))))
+    P = np.clip(P, spec.lower, spec.upper)
+    Z = batch_model(spec.model, w, P)
+    Z = Z * (1 + 1e-3 * (rng.standard_normal(Z.shape) + 1j * rng.standard_normal(Z.shape)))
+    m_weight = np.ones(n_points)
+    fitter = Fitter(spec, backend=backend, transform=transform)
+    nfev, failed = 0, 0
+    start = time.perf_counter()
+    for p, z in zip(P, Z):
+        params, cov_x, infodict, mesg, ier = fitter.fit(z, m_weight, f)
+        nfev += infodict['nfev']
+        engine = _ResidualEngine(spec.model, w, z, m_weight, spec.lower, spec.upper, None)
+        if not np.sum(engine.residuals(params) ** 2) <= 2 * np.sum(engine.residuals(p) ** 2):
+            failed += 1
+    elapsed = time.perf_counter() - start
+    return nfev / n_spectra, elapsed / n_spectra * 1e3, failed
+
+
+if __name__ == '__main__':
+    n_spectra = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    n_points = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    warnings.simplefilter('ignore', RuntimeWarning)
+    print('%-15s %-10s %10s %10s %8s' % ('model', 'transform', 'nfev/fit', 'ms/fit', 'failed'))
+    for name in sys.argv[3:] or available_models():
+        for transform in (False, True):
+            print('%-15s %-10s %10.1f %10.2f %8d' % ((name, transform) + bench(name, n_spectra, n_points, transform)))
@@ -0,0 +1,170 @@
+"""
+Benchmark suite: every bundled model, from model() up to Zfit.py
+
+    python benchmarks/suite.py [-o FILE] [--sizes 10,100,1000,10000] [--models NAME,...]
+                               [--no-zfit] [--files 50]
+    python benchmarks/suite.py compare OLD.json NEW.json
+
+For every model in Models/ and every grid size, a synthetic spectrum is
+generated from PINIT (see synthetic.py: PINIT moved by 10%, plus 0.1% noise)
+on a log-spaced grid of the model's frequency range, and the suite times
+
+    model_us        one model(w, params) evaluation
+    b_residuals_us  one modelcore._b_residuals call (what leastsq used to get)
+    engine_us       one _ResidualEngine.residuals call (what leastsq gets now)
+    fit_ms          one full fit_model() from PINIT, with its nfev, ier and cost
+    fd_fit_ms       the same fit with the Jacobian estimated by finite
+                    differences (Fitter(jacobian=False)), as fit_ms is for
+                    a model without jacobian() or AUTODIFF; its cost should
+                    match fit_ms's
+
+plus, per model, the end-to-end time of "Zfit.py -f DIR -m MODEL" on a
+directory of --files four-column spectra.  The per-call times are the best of
+three runs of a loop lasting at least 0.2 s.
+
+The results are written as JSON (default: suite_<commit>.json in the current
+directory) together with the commit, Python/NumPy/SciPy versions and the
+machine, so that runs of two commits can be compared with "compare", which
+prints the new/old ratio of every timing.  Nothing needs a network
+connection.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import warnings
+
+import numpy as np
+import scipy
+
+from synthetic import ROOT, frequency_grid, synthetic_spectrum
+from Models.registry import get_model, available_models
+from Models.modelcore import _b_residuals, _ResidualEngine, Fitter, fit_model
+
+SIZES = [10, 100, 1000, 10000]
+TIMINGS = ['model_us', 'b_residuals_us', 'engine_us', 'fit_ms', 'fd_fit_ms', 'zfit_s']
+
+
+def per_call(fn, min_time=0.2):
+    """
+    :return: best time of one call of fn, in seconds
+    """
+    timer = timeit.Timer(fn)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    return min(timer.repeat(3, number)) / number
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def bench_model(name, n_points):
+    spec = get_model(name)
+    f = frequency_grid(name, n_points)
+    w = 2 * np.pi * f
+    Z, p = synthetic_spectrum(spec, f)
+    m_weight = np.ones(n_points)
+    b_weight = n_points * spec.boundweight
+    engine = _ResidualEngine(spec.model, w, Z, m_weight, spec.lower, spec.upper, b_weight)
+    result = {'model': name, 'n_points': n_points,
+              'model_us': per_call(lambda: spec.model(w, p)) * 1e6,
+              'b_residuals_us': per_call(lambda: _b_residuals(p, spec.model, w, Z, m_weight,
+                                                              spec.bounds, b_weight)) * 1e6,
+              'engine_us': per_call(lambda: engine.residuals(p)) * 1e6}
+    start = time.perf_counter()
+    params, cov_x, infodict, mesg, ier = fit_model(spec, Z, m_weight, f)
+    result.update(fit_ms=(time.perf_counter() - start) * 1e3, nfev=int(infodict['nfev']), ier=int(ier),
+                  cost=float(np.sum(infodict['fvec'] ** 2)))
+    start = time.perf_counter()
+    params, cov_x, infodict, mesg, ier = Fitter(spec, jacobian=False).fit(Z, m_weight, f)
+    result.update(fd_fit_ms=(time.perf_counter() - start) * 1e3, fd_nfev=int(infodict['nfev']),
+                  fd_ier=int(ier), fd_cost=float(np.sum(infodict['fvec'] ** 2)))
+    return result
+
+
+def bench_zfit(name, n_files, n_points=60):
+    """
+    Time Zfit.py on a directory of n_files synthetic sweep files
+    """
+    spec = get_model(name)
+    f = frequency_grid(name, n_points)
+    with tempfile.TemporaryDirectory() as dirname:
+        for k in range(n_files):
+            Z, p = synthetic_spectrum(spec, f, seed=k)
+            rows = np.column_stack([np.full(n_points, -0.5 + 0.01 * k), f, Z.real, -Z.imag])
+            np.savetxt(os.path.join(dirname, 'spec_%04d.txt' % k), rows, delimiter='\t',
+                       header='E\tf\tZr\tZi', comments='')
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(ROOT, 'Zfit.py'), '-f', dirname, '-m', name],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return time.perf_counter() - start
+
+
+def run(args):
+    models = args.models.split(',') if args.models else available_models()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    report = {'commit': commit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+              'machine': platform.machine(), 'processor': platform.processor(),
+              'cpus': os.cpu_count(), 'results': [], 'zfit': []}
+    print('%-15s %7s %10s %14s %10s %10s %6s %10s %6s %9s' % (
+        'model', 'points', 'model_us', 'b_residuals_us', 'engine_us', 'fit_ms', 'nfev',
+        'fd_fit_ms', 'fd_nfev', 'fd/cost'))
+    for name in models:
+        for n_points in sizes:
+            result = bench_model(name, n_points)
+            report['results'].append(result)
+            print('%-15s %7d %10.1f %14.1f %10.1f %10.2f %6d %10.2f %6d %9.3g' % (
+                name, n_points, result['model_us'], result['b_residuals_us'], result['engine_us'],
+                result['fit_ms'], result['nfev'], result['fd_fit_ms'], result['fd_nfev'],
+                result['fd_cost'] / max(result['cost'], 1e-300)))
+        if not args.no_zfit:
+            elapsed = bench_zfit(name, args.files)
+            report['zfit'].append({'model': name, 'files': args.files, 'zfit_s': elapsed})
+            print('%-15s Zfit.py on %d files: %.2f s' % (name, args.files, elapsed))
+    output = args.output or 'suite_%s.json' % report['commit']
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('written to %s' % output)
+
+
+def compare(old_file, new_file):
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    print('%s -> %s, ratio new/old (< 1 is faster)' % (old['commit'], new['commit']))
+    for section, key in (('results', ('model', 'n_points')), ('zfit', ('model', 'files'))):
+        before = dict((tuple(r[k] for k in key), r) for r in old[section])
+        for r in new[section]:
+            o = before.get(tuple(r[k] for k in key))
+            if o is None:
+                continue
+            ratios = ['%s %.2f' % (t, r[t] / o[t]) for t in TIMINGS if t in r and t in o and o[t] > 0]
+            print('%-15s %-6s %s' % (r['model'], r[key[1]], '  '.join(ratios)))
+
+
+if __name__ == '__main__':
+    warnings.simplefilter('ignore', RuntimeWarning)
+    if len(sys.argv) == 4 and sys.argv[1] == 'compare':
+        compare(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+    parser = argparse.ArgumentParser(description='pyZfit benchmark suite')
+    parser.add_argument('-o', '--output', help='JSON file to write, default suite_<commit>.json')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in SIZES),
+                        help='comma separated numbers of frequency points')
+    parser.add_argument('--models', help='comma separated model names, default all')
+    parser.add_argument('--files', type=int, default=50, help='files for the Zfit.py run')
+    parser.add_argument('--no-zfit', action='store_true', help='skip the end-to-end Zfit.py runs')
+    run(parser.parse_args())
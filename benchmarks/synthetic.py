@@ -0,0 +1,58 @@
+"""
+Synthetic spectra for the benchmarks
+
+The spectra are generated from each model's own PARAMS: the "true" parameters
+are the initial guesses moved by a fixed relative offset (kept inside the
+bounds), and a little proportional noise is added.  Fitting therefore starts
+from PINIT and has to walk to a known answer.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def frequency_range(name):
+    """
+    :param name: model script name
+    :return: (fmin, fmax) in Hz that shows the features of this model
+    """
+    # The electrochemical cells are measured from mHz to 100 kHz, the
+    # pF / uH cable and transducer models only do something in the MHz range
+    if name.startswith('R('):
+        return 0.1, 1e5
+    return 1e3, 1e8
+
+
+def frequency_grid(name, n_points):
+    fmin, fmax = frequency_range(name)
+    return np.logspace(np.log10(fmin), np.log10(fmax), n_points)
+
+
+def true_params(spec, offset=0.1):
+    """
+    :param spec: ModelSpec
+    :param offset: relative distance from PINIT, alternating in sign
+    :return: parameter array the synthetic data is generated from
+    """
+    signs = np.where(np.arange(len(spec.init_val)) % 2 == 0, 1.0, -1.0)
+    p = spec.init_val * (1 + offset * signs)
+    return np.clip(p, spec.lower, spec.upper)
+
+
+def synthetic_spectrum(spec, f, offset=0.1, noise=1e-3, seed=0):
+    """
+    :param spec: ModelSpec
+    :param f: Hz frequency array
+    :return: (complex impedance array, parameters it was generated from)
+    """
+    rng = np.random.default_rng(seed)
+    p = true_params(spec, offset)
+    Z = spec.model(2 * np.pi * f, p)
+    Z = Z * (1 + noise * (rng.standard_normal(len(f)) + 1j * rng.standard_normal(len(f))))
+    return Z, p
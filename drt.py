@@ -0,0 +1,171 @@
+"""
+Distribution of relaxation times (DRT)
+
+A spectrum is written as a series resistance and a continuum of RC
+relaxations,
+
+    Z(w) = R_inf + sum_k x_k / (1 + j w tau_k)
+
+on a fixed log-spaced grid of PER_DECADE time constants per decade, one
+decade beyond the measured range on each side.  gamma_k = x_k / dln(tau)
+is the DRT.  x >= 0 is found by non-negative Tikhonov regularized least
+squares,
+
+    min ||A x - b||**2 + lam * ||x_1..x_M||**2,   x >= 0
+
+with b the real and imaginary parts stacked and scaled by max|Z| of the
+spectrum.  A, the Gram matrix A^T A + lam and its largest eigenvalue depend
+on the frequency grid only and are cached in its
+Models.modelcore.FrequencyContext, so every spectrum on the grid shares
+them; the spectra are then solved together by FISTA (accelerated projected
+gradient), one matrix product per iteration for all of them.
+
+peaks() locates the relaxations and their resistances.  A model script may
+define guess(w, Z, R_inf, peaks) returning starting parameters from them
+(see R(CR), R(C(RW)), R(Q(RW))); initial_guess() calls it, so the nonlinear
+fit starts close to its result instead of PINIT.  Resonant models such as
+xdcr2 have no such hook: inductive branches are not relaxations.
+"""
+
+import numpy as np
+
+PER_DECADE = 10
+LAMBDA = 1e-3
+MAXITER = 5000
+TOL = 1e-7
+# peaks holding less than this fraction of the total polarization resistance are ignored
+PEAK_MIN = 0.02
+# guesses are kept this fraction of the PBOUNDS box (in the space of
+# Models.modelcore.ParamTransform) away from the bounds, where a fit stalls
+MARGIN = 0.01
+
+
+def tau_grid(w):
+    """
+    :param w: radian frequency array
+    :return: time constants of the DRT, log-spaced from 0.1/w_max to 10/w_min
+    """
+    lo, hi = np.log10(0.1 / w.max()), np.log10(10 / w.min())
+    return np.logspace(lo, hi, int(np.ceil((hi - lo) * PER_DECADE)) + 1)
+
+
+def _system(w, lam):
+    """
+    :return: (tau, A, Q, lipschitz) of the grid: design matrix with columns
+             R_inf, x_1..x_M, real rows over imaginary rows, Gram matrix and
+             its largest eigenvalue
+    """
+    tau = tau_grid(w)
+    wt = w[:, np.newaxis] * tau
+    A = np.zeros((2 * len(w), len(tau) + 1))
+    A[:len(w), 0] = 1
+    A[:len(w), 1:] = 1 / (1 + wt ** 2)
+    A[len(w):, 1:] = -wt / (1 + wt ** 2)
+    Q = A.T @ A
+    Q[np.arange(1, len(tau) + 1), np.arange(1, len(tau) + 1)] += lam
+    return tau, A, Q, float(np.linalg.eigvalsh(Q)[-1])
+
+
+def drt(freq, Z, lam=LAMBDA, maxiter=MAXITER, tol=TOL):
+    """
+    DRT of one or many spectra measured on the same frequency grid
+    :param freq: Hz frequency array
+    :param Z: complex impedance, (len(freq),) or (n_spectra, len(freq))
+    :param lam: regularization parameter, relative to the data scaled by max|Z|
+    :param maxiter: iteration limit
+    :param tol: relative change of x below which the iteration stops
+    :return: (tau, gamma, R_inf, nit): time constants (n_tau,), DRT gamma
+             (n_spectra, n_tau) in ohm, R_inf (n_spectra,) and iterations run
+    """
+    from Models.modelcore import frequency_context
+
+    w = 2 * np.pi * np.asarray(freq, dtype=np.float64)
+    tau, A, Q, lipschitz = frequency_context(w).term(('drt', PER_DECADE, lam), lambda w: _system(w, lam))
+    Z = np.atleast_2d(Z)
+    scale = np.abs(Z).max(axis=1)
+    B = np.concatenate([Z.real, Z.imag], axis=1).T / scale
+    C = A.T @ B
+    X = np.zeros_like(C)
+    Y, t = X, 1.0
+    for nit in range(1, maxiter + 1):
+        Xn = np.maximum(Y - (Q @ Y - C) / lipschitz, 0)
+        tn = (1 + np.sqrt(1 + 4 * t * t)) / 2
+        Y = Xn + ((t - 1) / tn) * (Xn - X)
+        converged = np.abs(Xn - X).max() <= tol * max(np.abs(Xn).max(), 1e-300)
+        X, t = Xn, tn
+        if converged:
+            break
+    X = X * scale
+    dlntau = np.log(tau[1] / tau[0])
+    return tau, (X[1:] / dlntau).T, X[0], nit
+
+
+def peaks(tau, gamma):
+    """
+    :param tau: time constants as returned by drt()
+    :param gamma: DRT of one spectrum, (n_tau,)
+    :return: list of (tau, R) of the peaks, largest R first; R is the
+             resistance under the peak, between its neighbouring minima
+    """
+    x = gamma * np.log(tau[1] / tau[0])
+    total = x.sum()
+    if not total > 0:
+        return []
+    padded = np.concatenate([[0], gamma, [0]])
+    top = np.flatnonzero((padded[1:-1] > padded[:-2]) & (padded[1:-1] >= padded[2:]))
+    bottom = np.flatnonzero((padded[1:-1] <= padded[:-2]) & (padded[1:-1] < padded[2:]))
+    found = []
+    for k in top:
+        left = bottom[bottom < k].max() if (bottom < k).any() else 0
+        right = bottom[bottom > k].min() if (bottom > k).any() else len(x) - 1
+        R = x[left:right + 1].sum()
+        if R >= PEAK_MIN * total:
+            found.append((float(tau[k]), float(R)))
+    return sorted(found, key=lambda peak: -peak[1])
+
+
+def initial_guess(model, freq, Z, tau=None, gamma=None, R_inf=None, lam=LAMBDA):
+    """
+    Starting parameters of a model from the DRT of Z, by the guess() of its
+    script, moved inside the PBOUNDS box by MARGIN.
+    :param model: ModelSpec
+    :param Z: complex impedance array of one spectrum
+    :param tau, gamma, R_inf: DRT of Z when already computed, see drt()
+    :param lam: regularization parameter of the DRT computed otherwise
+    :return: parameter array, None when the model has no guess() or no peak was found
+    """
+    from Models.modelcore import _search_box
+
+    if model.guess is None:
+        return None
+    if gamma is None:
+        tau, gammas, R_infs, nit = drt(freq, Z, lam)
+        gamma, R_inf = gammas[0], R_infs[0]
+    found = peaks(tau, gamma)
+    if not found:
+        return None
+    w = 2 * np.pi * np.asarray(freq, dtype=np.float64)
+    params = np.asarray(model.guess(w, Z, float(R_inf), found), dtype=np.float64)
+    if not np.isfinite(params).all():
+        return None
+    t, lo, hi = _search_box(model)
+    margin = MARGIN * (hi - lo)
+    u = t.to_u(params)
+    return t.to_x(np.where(hi > lo, np.clip(u, lo + margin, hi - margin), u))
+
+
+def initial_guesses(model, freq, Z, lam=LAMBDA):
+    """
+    initial_guess() for many spectra on the same grid, with one batched DRT
+    :param Z: (n_spectra, len(freq)) complex impedance array
+    :return: (n_spectra, n_params) array, PINIT where no guess was found
+    """
+    P = np.tile(model.init_val, (len(Z), 1))
+    if model.guess is None:
+        return P
+    tau, gamma, R_inf, nit = drt(freq, Z, lam)
+    for s in range(len(Z)):
+        params = initial_guess(model, freq, Z[s], tau, gamma[s], R_inf[s])
+        if params is not None:
+            P[s] = params
+    return P
@@ -0,0 +1,73 @@
+"""
+Bulk loading of spectrum files
+
+A spectrum file holds one row per frequency:
+
+    [potential] frequency  Zreal  Zimag        (IMPORT_TYPE Zreal_Zimag)
+    [potential] frequency  |Z|    phase[deg]   (IMPORT_TYPE Z_Phase)
+
+with the potential column present when Potential_Position = 1 in config.ini
+(the potential is the same on every row).  The columns are parsed by the C
+parser of np.loadtxt straight into a float64 array, and the complex target
+impedance is built with array arithmetic, so no Python loop runs per row.
+"""
+
+import numpy as np
+
+IMPORT_TYPES = ("Zreal_Zimag", "Z_Phase")
+
+
+def impedance(a, b, import_type="Zreal_Zimag"):
+    """
+    :param a: Z' or |Z| column
+    :param b: Z" or phase column in degrees
+    :param import_type: 'Zreal_Zimag' or 'Z_Phase'
+    :return: complex impedance array, Z' - jZ" for Zreal_Zimag
+    """
+    if import_type == "Zreal_Zimag":
+        Z = np.empty(len(a), dtype=np.complex128)
+        Z.real = a
+        Z.imag = -b
+        return Z
+    if import_type == "Z_Phase":
+        return a * np.exp(1j * np.radians(b))
+    raise ValueError("unknown IMPORT_TYPE %r, expected one of %s" % (import_type, IMPORT_TYPES))
+
+
+def load_spectrum(filename, skiprows=1, delimiter='\t', potential=0, import_type="Zreal_Zimag"):
+    """
+    :param filename: data file
+    :param skiprows: header lines to skip
+    :param delimiter: column separator
+    :param potential: 1 when the first column holds the potential
+    :param import_type: 'Zreal_Zimag' or 'Z_Phase'
+    :return: (potential, frequency array, complex impedance array); the
+             potential is 0.0 for files without a potential column
+    :raises ValueError: when the file does not hold the expected columns
+    """
+    first = 1 if potential == 1 else 0
+    data = np.loadtxt(filename, skiprows=skiprows, delimiter=delimiter, dtype=np.float64,
+                      usecols=range(first + 3), ndmin=2)
+    if data.shape[0] == 0:
+        raise ValueError("%s holds no data rows" % filename)
+    E = float(data[0, 0]) if first else 0.0
+    freq = np.ascontiguousarray(data[:, first])
+    return E, freq, impedance(data[:, first + 1], data[:, first + 2], import_type)
+
+
+def read_potential(filename, skiprows=1, delimiter='\t', potential=0):
+    """
+    Read only the potential of a data file, without parsing the spectrum
+    :return: potential from the first data line when potential == 1, else 0.0;
+             None if the file cannot be read
+    """
+    if potential != 1:
+        return 0.0
+    try:
+        with open(filename) as f:
+            for j, line in enumerate(f):
+                if j == skiprows:
+                    return float(line.split(delimiter)[0])
+    except (OSError, ValueError, UnicodeDecodeError):
+        pass
+    return None
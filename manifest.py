@@ -0,0 +1,137 @@
+"""
+Manifest of fitted files for incremental batches
+
+result/manifest.json records, for every data file fitted by an incremental
+batch, what its fit was made from:
+
+    {"version": 1,
+     "files": {"spec_001.txt": {"size": ..., "mtime_ns": ..., "sha1": ...,
+                                "stamp": ...}, ...}}
+
+size and mtime_ns are taken before the fit, sha1 is the hash of the file
+contents and stamp the hash of the model name, the model source (the script,
+or the circuit string and generator version) and the fit settings.  A file
+is up to date when its stamp is unchanged and its size and mtime are too;
+a file whose mtime moved but whose contents hash the same (copied, touched)
+is up to date as well.  Checking a file costs one stat(), so a campaign of
+thousands of files where a few were added is checked in milliseconds and
+only those few are fitted.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+MANIFEST = 'manifest.json'
+VERSION = 1
+
+
+def file_hash(filename):
+    """
+    :return: sha1 hex digest of the contents of the file
+    """
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def model_hash(spec):
+    """
+    :param spec: ModelSpec from Models.registry.get_model()
+    :return: sha1 hex digest of the model source
+    """
+    module = spec.module
+    if hasattr(module, 'CIRCUIT'):
+        from Models import circuit
+
+        source = '%s\n%s' % (module.CIRCUIT, circuit.GENERATOR_VERSION)
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+    return file_hash(spec.path)
+
+
+def fit_stamp(modelName, spec, settings):
+    """
+    :param settings: dict of the settings the fit results depend on
+    :return: hash of everything besides the data file that a fit result depends on
+    """
+    key = json.dumps([modelName, model_hash(spec), settings], sort_keys=True, default=str)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class Manifest(object):
+    """
+    The manifest of one result directory
+    """
+
+    def __init__(self, storePath):
+        """
+        :param storePath: result directory, the manifest is storePath/manifest.json
+        """
+        self.path = storePath
+        self.files = {}
+        try:
+            with open(self.filename, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == VERSION:
+                self.files = data['files']
+        except (OSError, ValueError, KeyError):
+            # missing or unreadable: every file is fitted again
+            pass
+
+    @property
+    def filename(self):
+        return os.path.join(self.path, MANIFEST)
+
+    def stale(self, files, stamp, settle=0.0):
+        """
+        Split data files into those whose fit is up to date and those to fit.
+        Entries of files that no longer exist are dropped.
+        :param files: data file paths
+        :param stamp: fit_stamp() of this batch
+        :param settle: leave out files modified less than this many seconds
+                       ago, which the instrument may still be writing
+        :return: (up-to-date files, dict of file -> entry for the files to fit);
+                 pass the entries to update() once their results are written
+        """
+        current, todo = [], {}
+        now = time.time()
+        names = set()
+        for filename in files:
+            name = os.path.basename(filename)
+            names.add(name)
+            st = os.stat(filename)
+            if settle and now - st.st_mtime < settle:
+                continue
+            entry = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'stamp': stamp}
+            old = self.files.get(name)
+            if old is not None and old['stamp'] == stamp and old['size'] == st.st_size:
+                if old['mtime_ns'] == st.st_mtime_ns:
+                    current.append(filename)
+                    continue
+                entry['sha1'] = file_hash(filename)
+                if entry['sha1'] == old.get('sha1'):
+                    old['mtime_ns'] = st.st_mtime_ns
+                    current.append(filename)
+                    continue
+            entry.setdefault('sha1', file_hash(filename))
+            todo[filename] = entry
+        for name in set(self.files) - names:
+            del self.files[name]
+        return current, todo
+
+    def update(self, entries):
+        """
+        :param entries: dict of file -> entry as returned by stale(), for the fitted files
+        """
+        for filename, entry in entries.items():
+            self.files[os.path.basename(filename)] = entry
+
+    def save(self):
+        """
+        Write the manifest, replacing the old one only once the new one is complete
+        """
+        os.makedirs(self.path, exist_ok=True)
+        temp = self.filename + '.%d.tmp' % os.getpid()
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump({'version': VERSION, 'files': self.files}, f)
+        os.replace(temp, self.filename)
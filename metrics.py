@@ -0,0 +1,115 @@
+"""
+Per-file fit metrics as JSON lines
+
+With Metrics set in config.ini (or --metrics=FILE) every fitted file adds
+one JSON object to that file:
+
+    {"event": "fit", "file": ..., "model": ..., "load_s": ..., "fit_s": ...,
+     "write_s": ..., "model_calls": ..., "model_s": ..., "jacobian_calls": ...,
+     "jacobian_s": ..., "nfev": ..., "njev": ..., "ier": ..., "mesg": ...,
+     "cost": ..., "residual_norm": ..., "worker": <pid>}
+
+and every batch ends with one {"event": "batch", ...} summary line.  The
+metrics are collected in the worker that fitted the file and written by the
+calling process only.  When metrics are off, OFF stands in for FileMetrics:
+its phase() is a shared no-op context manager and nothing is timed.
+
+    import pandas as pd
+    pd.read_json('metrics.jsonl', lines=True)
+"""
+
+import json
+import os
+import time
+from contextlib import contextmanager
+
+
+class _NullPhase(object):
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _Off(object):
+    """
+    FileMetrics stand-in used when metrics are off.
+    """
+
+    enabled = False
+    _phase = _NullPhase()
+
+    def phase(self, name):
+        return self._phase
+
+    def add_fit(self, values):
+        pass
+
+    def update(self, values):
+        pass
+
+    def entry(self):
+        return None
+
+
+OFF = _Off()
+
+# fit metrics that add up when a file is fitted more than once (see Zfit.fit_sweep)
+COUNTERS = ('fit_s', 'model_calls', 'model_s', 'jacobian_calls', 'jacobian_s', 'nfev', 'njev')
+
+
+class FileMetrics(object):
+    """
+    Metrics of one fitted file, filled in by the phases of the fit.
+    """
+
+    enabled = True
+
+    def __init__(self, filename, modelName, **fields):
+        self.values = {'event': 'fit', 'file': filename, 'model': modelName, 'worker': os.getpid()}
+        self.values.update(fields)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Add the time spent in the with-block to <name>_s
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            key = name + '_s'
+            self.values[key] = self.values.get(key, 0.0) + time.perf_counter() - start
+
+    def add_fit(self, values):
+        """
+        :param values: metrics of one fit, see Models.modelcore.fit_model_profiled;
+                       COUNTERS add up over the fits of the file, the rest is
+                       taken from the last fit
+        """
+        for key, value in values.items():
+            if key in COUNTERS:
+                self.values[key] = self.values.get(key, 0) + value
+            else:
+                self.values[key] = value
+
+    def update(self, values):
+        self.values.update(values)
+
+    def entry(self):
+        return self.values
+
+
+def write_lines(filename, entries):
+    """
+    Append entries (dicts) to filename, one JSON object per line
+    """
+    dirname = os.path.dirname(filename)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(filename, mode='a', encoding='utf-8') as f:
+        for entry in entries:
+            if entry is not None:
+                f.write(json.dumps(entry, default=float) + '\n')
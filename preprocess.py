@@ -0,0 +1,169 @@
+"""
+Preprocessing of a loaded spectrum before the nonlinear fit
+
+Preprocessor runs, in this order and each only when configured:
+
+1. frequency masking: points outside [fmin, fmax] are dropped, and with
+   drop_inductive the points with a positive imaginary part (inductive
+   cable/lead artefacts at high frequency)
+2. Kramers-Kronig check (linear KK test, Schoenleber et al. 2014): the
+   spectrum is fitted by
+
+       Z_kk = R0 + jwL + 1/(jwC) + sum_k R_k / (1 + jw tau_k)
+
+   with the time constants tau_k fixed, log-spaced over 1/w_max..1/w_min
+   (KK_PER_DECADE per decade).  The model is linear in R0, L, 1/C and the
+   R_k, so this is one weighted linear least-squares solve; the design
+   matrix depends on the frequency grid only and is cached in its
+   Models.modelcore.FrequencyContext.  The residuals, relative to |Z|,
+   measure how far the data are from any causal, linear, stable system.
+3. outlier rejection: while the largest KK residual lies more than
+   outlier_sigma robust standard deviations (1.4826 * MAD) above the median
+   residual, that point is dropped and the KK fit repeated, for at most
+   MAX_OUTLIERS of the points
+4. validation: with kk_test, a spectrum whose KK residuals have an RMS
+   above kk_max is rejected (SpectrumRejected) before any nonlinear fit
+5. weighting: 'unit' (all ones, as before) or 'modulus' (1 / |Z|, for
+   errors proportional to |Z|), scaled to a mean residual magnitude like
+   the unit weights so BOUNDWEIGHT keeps its meaning
+
+A default Preprocessor changes nothing and returns unit weights.
+"""
+
+import numpy as np
+
+WEIGHTINGS = ('unit', 'modulus')
+# RC elements per decade of frequency in the KK test
+KK_PER_DECADE = 3
+# largest accepted RMS of the relative KK residuals
+KK_MAX = 0.01
+# largest fraction of the points outlier rejection may drop
+MAX_OUTLIERS = 0.1
+
+
+class SpectrumRejected(ValueError):
+    """
+    A spectrum that failed validation and is not fitted
+    """
+
+
+def weights(Z, scheme='unit'):
+    """
+    :param Z: complex impedance array
+    :param scheme: 'unit' or 'modulus'
+    :return: modeling weights, see Models.modelcore.fit_model
+    """
+    if scheme == 'unit':
+        return np.ones(len(Z))
+    if scheme == 'modulus':
+        modulus = np.abs(Z)
+        return np.mean(modulus) / modulus
+    raise ValueError("unknown weighting %r, expected one of %s" % (scheme, WEIGHTINGS))
+
+
+def _kk_design(w, elements):
+    """
+    :return: (2 * len(w), elements + 3) design matrix of the linear KK model,
+             real rows over imaginary rows; columns R0, L, 1/C, R_1..R_elements
+    """
+    tau = np.logspace(np.log10(1 / w.max()), np.log10(1 / w.min()), elements)
+    wt = w[:, np.newaxis] * tau
+    A = np.zeros((2 * len(w), elements + 3))
+    A[:len(w), 0] = 1
+    A[len(w):, 1] = w
+    A[len(w):, 2] = -1 / w
+    A[:len(w), 3:] = 1 / (1 + wt ** 2)
+    A[len(w):, 3:] = -wt / (1 + wt ** 2)
+    return A
+
+
+def lin_kk(freq, Z, elements=None):
+    """
+    Linear Kramers-Kronig test of one spectrum
+    :param freq: Hz frequency array
+    :param Z: complex impedance array
+    :param elements: number of RC elements, default KK_PER_DECADE per decade
+    :return: (relative real residuals, relative imaginary residuals, Z_kk)
+    """
+    from Models.modelcore import frequency_context
+
+    w = 2 * np.pi * np.asarray(freq, dtype=np.float64)
+    if elements is None:
+        decades = np.log10(w.max() / w.min()) if len(w) > 1 else 0
+        elements = int(np.ceil(KK_PER_DECADE * max(decades, 1)))
+    # at least two residuals per unknown
+    elements = max(1, min(elements, len(w) - 3))
+    A = frequency_context(w).term(('lin_kk', elements), lambda w: _kk_design(w, elements))
+    weight = 1 / np.abs(Z)
+    b = np.concatenate([Z.real, Z.imag])
+    Wt = np.concatenate([weight, weight])
+    coef = np.linalg.lstsq(A * Wt[:, np.newaxis], b * Wt, rcond=None)[0]
+    fit = A @ coef
+    Zkk = fit[:len(w)] + 1j * fit[len(w):]
+    return (Z.real - Zkk.real) * weight, (Z.imag - Zkk.imag) * weight, Zkk
+
+
+class Preprocessor(object):
+    """
+    The configured preprocessing stage, applied to one spectrum at a time
+    """
+
+    def __init__(self, fmin=None, fmax=None, drop_inductive=False, weighting='unit',
+                 outlier_sigma=0.0, kk_test=False, kk_max=KK_MAX):
+        """
+        :param fmin, fmax: Hz frequency range to keep, None for no limit
+        :param drop_inductive: drop the points with Im(Z) > 0
+        :param weighting: 'unit' or 'modulus', see weights()
+        :param outlier_sigma: drop points with KK residuals this many robust
+                              standard deviations above the median, 0 = off
+        :param kk_test: reject spectra whose KK residual RMS exceeds kk_max
+        """
+        if weighting not in WEIGHTINGS:
+            raise ValueError("unknown weighting %r, expected one of %s" % (weighting, WEIGHTINGS))
+        self.fmin = fmin
+        self.fmax = fmax
+        self.drop_inductive = drop_inductive
+        self.weighting = weighting
+        self.outlier_sigma = outlier_sigma
+        self.kk_test = kk_test
+        self.kk_max = kk_max
+
+    def __call__(self, freq, Z):
+        """
+        :return: (freq, Z, m_weight, report) of the points to fit; report is a
+                 dict of 'dropped' (points removed) and 'kk_rms' (None when
+                 no KK fit was needed)
+        :raises SpectrumRejected: when too few points remain or the KK check fails
+        """
+        keep = np.ones(len(freq), dtype=bool)
+        if self.fmin is not None:
+            keep &= freq >= self.fmin
+        if self.fmax is not None:
+            keep &= freq <= self.fmax
+        if self.drop_inductive:
+            keep &= Z.imag <= 0
+        if not keep.all():
+            freq, Z = freq[keep], Z[keep]
+        dropped = len(keep) - len(freq)
+        if len(freq) < 5:
+            raise SpectrumRejected("only %d points left after masking" % len(freq))
+
+        kkRms = None
+        if self.outlier_sigma or self.kk_test:
+            res_re, res_im, Zkk = lin_kk(freq, Z)
+            # an outlier also pulls the KK fit at its neighbours, so only the
+            # worst point is dropped before fitting again
+            for _ in range(int(MAX_OUTLIERS * len(freq)) if self.outlier_sigma else 0):
+                r = np.hypot(res_re, res_im)
+                median = np.median(r)
+                mad = 1.4826 * np.median(np.abs(r - median))
+                worst = np.argmax(r)
+                if not r[worst] > median + self.outlier_sigma * mad:
+                    break
+                freq, Z = np.delete(freq, worst), np.delete(Z, worst)
+                dropped += 1
+                res_re, res_im, Zkk = lin_kk(freq, Z)
+            kkRms = float(np.sqrt(np.mean(res_re ** 2 + res_im ** 2) / 2))
+            if self.kk_test and not kkRms <= self.kk_max:
+                raise SpectrumRejected("Kramers-Kronig residual RMS %.3g above %.3g" % (kkRms, self.kk_max))
+        return freq, Z, weights(Z, self.weighting), {'dropped': dropped, 'kk_rms': kkRms}
@@ -0,0 +1,229 @@
+"""
+Binary result store of the fits
+
+Every fitted file gives one record (see record()).  A ResultSink buffers the
+records in memory and writes them in one go, column by column, to
+
+    result/paras.parquet    when pyarrow is installed
+    result/paras.npz        otherwise (one array per column, numpy only)
+
+Columns: filename (name in the data directory), model, potential, cost (final sum of squared residuals),
+nfev, ier, one column per model parameter, then the derived columns of the
+model (Capacity_d for R(Q(RW))), the standard error of every parameter
+(<name>_stderr) and the correlation of every pair (corr_<name>_<name>), see
+Models.modelcore.parameter_errors; NaN where the fit gave no covariance.
+When a bootstrap was run, <name>_boot_stderr follows.  An existing store
+is extended, as paras.txt is appended to, and its rows of the same file and
+model are replaced by the new ones.  When the columns differ (another model,
+or a bootstrap in one run only) the store gets the union of both, NaN where
+a row has no value.
+A watched directory gets a batch every poll; rewriting the whole store each
+time would make a poll cost as much as the store is large, so such batches
+are written alone as parts next to it (paras-00000.parquet, ...) and merged
+into it once, by compact(), when the watch ends.
+read_results() loads either format into a pandas DataFrame, parts included.
+"""
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+FORMATS = ('parquet', 'npz')
+INFO_COLUMNS = ['filename', 'model', 'potential', 'cost', 'nfev', 'ier']
+
+
+def parquet_available():
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+
+def record(filename, modelName, potential, params, cost, nfev, ier, derived=None,
+           stderr=None, corr=None, boot_stderr=None):
+    """
+    :param derived: OrderedDict of extra columns computed from the parameters
+    :param stderr: standard errors of the parameters, None if unknown
+    :param corr: (n_params, n_params) correlation matrix, None if unknown
+    :param boot_stderr: bootstrap standard errors, None if no bootstrap was run
+    :return: result record of one fitted file, as consumed by ResultSink
+    """
+    n = len(params)
+    return {'filename': filename, 'model': modelName, 'potential': float(potential),
+            'cost': float(cost), 'nfev': int(nfev), 'ier': int(ier),
+            'params': np.asarray(params, dtype=np.float64),
+            'derived': derived if derived is not None else OrderedDict(),
+            'stderr': np.asarray(stderr, dtype=np.float64) if stderr is not None else np.full(n, np.nan),
+            'corr': np.asarray(corr, dtype=np.float64) if corr is not None else np.full((n, n), np.nan),
+            'boot_stderr': np.asarray(boot_stderr, dtype=np.float64) if boot_stderr is not None else None}
+
+
+class ResultSink(object):
+    """
+    Collects the records of a batch and writes them to storePath in bulk.
+    """
+
+    def __init__(self, storePath, keys, fmt=None):
+        """
+        :param storePath: result directory
+        :param keys: parameter names of the model
+        :param fmt: 'parquet' or 'npz', None for parquet when pyarrow is installed
+        """
+        fmt = fmt or ('parquet' if parquet_available() else 'npz')
+        if fmt not in FORMATS:
+            raise ValueError("unknown result format %r, expected one of %s" % (fmt, FORMATS))
+        self.path = storePath
+        self.keys = list(keys)
+        self.fmt = fmt
+        self.records = []
+
+    @property
+    def filename(self):
+        return os.path.join(self.path, 'paras.' + self.fmt)
+
+    def add(self, rec):
+        self.records.append(rec)
+
+    def extend(self, recs):
+        self.records.extend(recs)
+
+    def columns(self):
+        """
+        :return: OrderedDict of column name -> array over the buffered records
+        """
+        recs = self.records
+        columns = OrderedDict()
+        for name in INFO_COLUMNS:
+            columns[name] = np.array([rec[name] for rec in recs])
+        params = np.array([rec['params'] for rec in recs], dtype=np.float64).reshape(len(recs), len(self.keys))
+        for k, key in enumerate(self.keys):
+            columns[key] = params[:, k]
+        for name in (recs[0]['derived'] if recs else ()):
+            columns[name] = np.array([rec['derived'][name] for rec in recs], dtype=np.float64)
+        n = len(self.keys)
+        stderr = np.array([rec['stderr'] for rec in recs], dtype=np.float64).reshape(len(recs), n)
+        for k, key in enumerate(self.keys):
+            columns[key + '_stderr'] = stderr[:, k]
+        corr = np.array([rec['corr'] for rec in recs], dtype=np.float64).reshape(len(recs), n, n)
+        for a in range(n):
+            for b in range(a + 1, n):
+                columns['corr_%s_%s' % (self.keys[a], self.keys[b])] = corr[:, a, b]
+        if any(rec.get('boot_stderr') is not None for rec in recs):
+            boot = np.array([rec['boot_stderr'] if rec.get('boot_stderr') is not None else np.full(n, np.nan)
+                             for rec in recs], dtype=np.float64)
+            for k, key in enumerate(self.keys):
+                columns[key + '_boot_stderr'] = boot[:, k]
+        return columns
+
+    def frame(self):
+        import pandas as pd
+
+        return pd.DataFrame(self.columns())
+
+    def close(self, append=False):
+        """
+        Write the buffered records, extending an existing store; its rows for
+        the files and model of the new records are dropped, other rows kept
+        :param append: write the records as a new part of the store instead,
+                       without reading the store, see compact()
+        :return: name of the store, None when there was nothing to write
+        """
+        if not self.records:
+            return None
+        os.makedirs(self.path, exist_ok=True)
+        table = self.frame()
+        if append:
+            parts = part_files(self.filename)
+            number = int(os.path.splitext(parts[-1])[0][-5:]) + 1 if parts else 0
+            _write(table, _part_name(self.filename, number))
+        else:
+            if has_results(self.filename):
+                table = _merge([read_results(self.filename), table])
+            _write(table, self.filename)
+            _remove_parts(self.filename)
+        self.records = []
+        return self.filename
+
+
+def _part_name(filename, number):
+    root, ext = os.path.splitext(filename)
+    return '%s-%05d%s' % (root, number, ext)
+
+
+def part_files(filename):
+    """
+    :param filename: paras.parquet or paras.npz
+    :return: names of the parts written by ResultSink.close(append=True), oldest first
+    """
+    import glob
+
+    root, ext = os.path.splitext(filename)
+    return sorted(glob.glob(glob.escape(root) + '-' + '[0-9]' * 5 + ext))
+
+
+def has_results(filename):
+    """
+    :return: whether the store or any part of it exists
+    """
+    return os.path.isfile(filename) or bool(part_files(filename))
+
+
+def _merge(tables):
+    import pandas as pd
+
+    # 列不同时取并集，缺失值为NaN；同一文件和模型只保留最后一行
+    table = pd.concat(tables, ignore_index=True)
+    return table.drop_duplicates(subset=['filename', 'model'], keep='last').reset_index(drop=True)
+
+
+def _write(table, filename):
+    import pandas as pd
+
+    if filename.endswith('.parquet'):
+        table.to_parquet(filename, index=False)
+    else:
+        # text columns as fixed-width unicode arrays, so np.load needs no pickle
+        np.savez(filename, **dict(
+            (name, table[name].to_numpy() if pd.api.types.is_numeric_dtype(table[name])
+             else table[name].to_numpy(dtype=str)) for name in table.columns))
+
+
+def _read(filename):
+    import pandas as pd
+
+    if filename.endswith('.parquet'):
+        return pd.read_parquet(filename)
+    with np.load(filename) as data:
+        return pd.DataFrame(OrderedDict((name, data[name]) for name in data.files))
+
+
+def _remove_parts(filename):
+    for part in part_files(filename):
+        os.remove(part)
+
+
+def compact(filename):
+    """
+    Merge the parts of a store into it and remove them
+    :param filename: paras.parquet or paras.npz
+    :return: whether there were parts to merge
+    """
+    if not part_files(filename):
+        return False
+    _write(read_results(filename), filename)
+    _remove_parts(filename)
+    return True
+
+
+def read_results(filename):
+    """
+    :param filename: paras.parquet or paras.npz written by ResultSink
+    :return: pandas DataFrame, one row per fitted file
+    """
+    parts = part_files(filename)
+    if not parts:
+        return _read(filename)
+    tables = [_read(filename)] if os.path.isfile(filename) else []
+    return _merge(tables + [_read(part) for part in parts])
@@ -0,0 +1,186 @@
+"""
+Screening of several equivalent circuits on the same spectra
+
+Every spectrum is loaded once and fitted with each candidate model; a
+Screening collects the fits and compares them with
+
+    chi2       final sum of squared residuals (cost)
+    chi2_red   chi2 / (m - k), m = 2 * number of frequencies (real and
+               imaginary residuals), k = number of parameters
+    aic        m * ln(chi2 / m) + 2k
+    bic        m * ln(chi2 / m) + k * ln(m)
+
+The best model of a spectrum is the one with the lowest AIC.  A model whose
+AIC has been more than DELTA_AIC above the best one on MIN_FILES spectra in
+a row is clearly losing (Burnham & Anderson: essentially no support) and is
+dropped, i.e. not fitted to the remaining spectra; its columns are then empty.
+The last remaining model is never dropped.
+
+write() writes one row per spectrum with the criteria and parameters of
+every model side by side, and write_summary() one row per model.
+"""
+
+import math
+from collections import OrderedDict
+
+import numpy as np
+
+DELTA_AIC = 10.0
+MIN_FILES = 5
+CRITERIA = ['chi2', 'chi2_red', 'aic', 'bic']
+
+
+def split_models(text):
+    """
+    Split a comma separated list of model names; commas inside parentheses
+    (circuit strings such as Rs-p(Q1,R1-W1)) do not separate.
+    :return: list of model names
+    """
+    names, depth, current = [], 0, []
+    for char in text:
+        if char == ',' and depth == 0:
+            names.append(''.join(current).strip())
+            current = []
+            continue
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        current.append(char)
+    names.append(''.join(current).strip())
+    return [name for name in names if name]
+
+
+def criteria(cost, n_points, n_params):
+    """
+    :param cost: final sum of squared residuals
+    :param n_points: number of frequencies
+    :param n_params: number of fitted parameters
+    :return: OrderedDict of CRITERIA
+    """
+    m = 2 * n_points
+    values = OrderedDict([('chi2', cost), ('chi2_red', cost / max(m - n_params, 1))])
+    if cost > 0 and np.isfinite(cost):
+        loglike = m * math.log(cost / m)
+        values['aic'] = loglike + 2 * n_params
+        values['bic'] = loglike + n_params * math.log(m)
+    else:
+        values['aic'] = values['bic'] = np.nan
+    return values
+
+
+class Screening(object):
+    """
+    Fits of the candidate models, one spectrum at a time, and the models
+    still in the race.
+    """
+
+    def __init__(self, modelNames, delta=DELTA_AIC, min_files=MIN_FILES):
+        self.models = list(modelNames)
+        self.active = list(modelNames)
+        self.delta = delta
+        self.min_files = min_files
+        self.rows = []
+        self.keys = OrderedDict()
+        self.streak = dict((name, 0) for name in self.models)
+        self.dropped = OrderedDict()
+
+    def add(self, result):
+        """
+        :param result: dict with filename, potential, n_points and fits, the
+                       latter {model name: {'keys', 'params', 'cost', 'nfev', 'ier'}}
+                       (see Zfit.screen_file)
+        :return: models dropped after this spectrum
+        """
+        row = OrderedDict([('filename', result['filename']), ('potential', result['potential'])])
+        aic = OrderedDict()
+        for name in self.models:
+            fit = result['fits'].get(name)
+            if fit is None:
+                continue
+            self.keys.setdefault(name, list(fit['keys']))
+            values = criteria(fit['cost'], result['n_points'], len(fit['keys']))
+            values['nfev'] = fit['nfev']
+            values['ier'] = fit['ier']
+            values.update(zip(fit['keys'], fit['params']))
+            row[name] = values
+            if np.isfinite(values['aic']):
+                aic[name] = values['aic']
+        row['best'] = min(aic, key=aic.get) if aic else ''
+        self.rows.append(row)
+        return self._drop_losers(aic)
+
+    def _drop_losers(self, aic):
+        if not aic:
+            return []
+        best = min(aic.values())
+        dropped = []
+        for name in list(self.active):
+            if name not in aic:
+                continue
+            self.streak[name] = self.streak[name] + 1 if aic[name] - best > self.delta else 0
+            if self.streak[name] >= self.min_files and len(self.active) > 1:
+                self.active.remove(name)
+                self.dropped[name] = len(self.rows)
+                dropped.append(name)
+        return dropped
+
+    def frame(self):
+        """
+        :return: DataFrame, one row per spectrum; columns filename, potential,
+                 best, then "<model>:<value>" for every model
+        """
+        import pandas as pd
+
+        columns = ['filename', 'potential', 'best']
+        for name in self.models:
+            columns.extend('%s:%s' % (name, value) for value in
+                           CRITERIA + ['nfev', 'ier'] + self.keys.get(name, []))
+        data = []
+        for row in self.rows:
+            line = dict((key, row[key]) for key in ('filename', 'potential', 'best'))
+            for name in self.models:
+                for value, number in row.get(name, {}).items():
+                    line['%s:%s' % (name, value)] = number
+            data.append(line)
+        table = pd.DataFrame(data, columns=columns)
+        # counts stay integers in the columns of dropped models
+        for name in self.models:
+            for value in ('nfev', 'ier'):
+                column = '%s:%s' % (name, value)
+                table[column] = table[column].astype('Int64')
+        return table
+
+    def summary(self):
+        """
+        :return: DataFrame, one row per model: spectra fitted, spectra won,
+                 mean chi2_red, mean AIC difference to the best model, mean
+                 Akaike weight and the spectrum after which it was dropped
+        """
+        import pandas as pd
+
+        table = []
+        for name in self.models:
+            fitted, wins, chi2, delta, weight = 0, 0, [], [], []
+            for row in self.rows:
+                if name not in row:
+                    continue
+                fitted += 1
+                wins += row['best'] == name
+                chi2.append(row[name]['chi2_red'])
+                aics = np.array([row[other]['aic'] for other in self.models if other in row])
+                if np.isfinite(row[name]['aic']) and np.isfinite(aics).any():
+                    best = np.nanmin(aics)
+                    delta.append(row[name]['aic'] - best)
+                    weights = np.exp(-0.5 * (aics - best))
+                    weight.append(math.exp(-0.5 * delta[-1]) / np.nansum(weights))
+            table.append(OrderedDict([
+                ('model', name), ('fitted', fitted), ('best', wins),
+                ('chi2_red', np.mean(chi2) if chi2 else np.nan),
+                ('delta_aic', np.mean(delta) if delta else np.nan),
+                ('akaike_weight', np.mean(weight) if weight else np.nan),
+                ('dropped_after', self.dropped.get(name, ''))]))
+        return pd.DataFrame(table)
+
+    def write(self, filename):
+        self.frame().to_csv(filename, sep='\t', index=False)
+
+    def write_summary(self, filename):
+        self.summary().to_csv(filename, sep='\t', index=False)
@@ -0,0 +1,367 @@
+"""
+Fit service for live spectra
+
+serve() listens on a local TCP port (or a Unix socket) for spectra sent as
+JSON lines and answers every fitted spectrum with one JSON line:
+
+    -> {"channel": "cell1", "id": 7, "potential": 0.1,
+        "freq": [...], "zreal": [...], "zimag": [...], "final": true}
+    <- {"channel": "cell1", "id": 7, "potential": 0.1, "points": 60,
+        "params": {"Rs": ..., ...}, "cost": ..., "nfev": ..., "ier": ...,
+        "warm_start": true, "queue_s": ..., "fit_s": ...}
+
+zreal / zimag are the columns of a data file (IMPORT_TYPE Zreal_Zimag, see
+loader.impedance).  A sweep may arrive in pieces as the instrument measures
+it: messages with "final": false add their points to the pending sweep of
+the channel, and the message with "final": true (the default) completes it
+and queues the fit.  A message the service cannot use is answered with
+{"channel": ..., "id": ..., "error": ...} and drops the pending sweep of
+its channel, as does a message that would grow the pending sweep beyond
+MAX_POINTS frequencies.  When the client closes its side, the service
+answers the fits still queued for the connection and then closes it.
+
+Completed sweeps wait in a queue of QUEUE_SIZE entries for the workers,
+which fit them in a process pool with Models.modelcore.fit_model.  When the
+queue is full the service stops reading from the connection, so a client
+that sends faster than the spectra are fitted is held back by TCP instead
+of piling up work; the latency of a fit stays below about QUEUE_SIZE /
+workers fits.  Every fit starts from the last parameters of its channel
+(PINIT for the first one), as in the sweep mode of Zfit.py; a fit whose
+cost jumps more than RESET times above the previous one is repeated from
+PINIT.  The fits of one channel run in the order they arrived.
+
+demo() is a stand-in for the instrument: it sends synthetic drifting
+spectra of a model in pieces on several channels and collects the answers.
+
+    py Zfit.py -m "R(Q(RW))" --serve=8765 -j 2
+    py service.py demo "R(Q(RW))" 8765
+"""
+
+import asyncio
+import json
+import time
+
+import numpy as np
+
+PORT = 8765
+QUEUE_SIZE = 64
+# refit from PINIT when a warm-started fit ends with a cost this many times
+# above the previous cost of the channel
+RESET = 10.0
+# longest accepted message line
+LINE_LIMIT = 2 ** 24
+# most frequencies a channel's pending sweep may hold before it is final
+MAX_POINTS = 100000
+
+
+def fit_job(modelName, freq, Z, p0, lastCost, backend=None, transform=None):
+    """
+    Fit one spectrum in a pool worker.
+    :param p0: parameters of the previous spectrum of the channel, None for PINIT
+    :param lastCost: cost of the previous spectrum of the channel
+    :return: (keys, params, cost, nfev, ier, warm_start)
+    """
+    import Models.modelcore as mc
+    from Models.registry import get_model
+
+    model = get_model(modelName)
+    m_weight = np.ones(len(Z))
+
+    def fit(start):
+        result = mc.fit_model(model, Z, m_weight, freq, backend=backend, transform=transform, p0=start)
+        return result, float(np.sum(result[2]['fvec'] ** 2))
+
+    result, cost = fit(p0)
+    warm = p0 is not None
+    if warm and not cost <= RESET * lastCost:
+        cold, coldCost = fit(None)
+        if coldCost < cost:
+            result, cost, warm = cold, coldCost, False
+    return model.keys, [float(p) for p in result[0]], cost, int(result[2]['nfev']), int(result[4]), warm
+
+
+class Channel(object):
+    """
+    Pending sweep and last fit of one measurement channel
+    """
+
+    def __init__(self):
+        self.freq, self.zreal, self.zimag = [], [], []
+        self.points = 0
+        self.params = None
+        self.cost = None
+        # fits of a channel run one after the other, each warm-starting the next
+        self.lock = asyncio.Lock()
+
+    def add(self, message):
+        """
+        Add the points of a message to the pending sweep
+        :raises ValueError: when the values are not numbers, differ in length or
+                            would take the sweep beyond MAX_POINTS
+        """
+        freq, zreal, zimag = [np.asarray(message[name], dtype=np.float64)
+                              for name in ('freq', 'zreal', 'zimag')]
+        if not freq.ndim == zreal.ndim == zimag.ndim == 1:
+            raise ValueError("freq, zreal and zimag must be lists of numbers")
+        if not len(freq) == len(zreal) == len(zimag):
+            raise ValueError("freq, zreal and zimag differ in length")
+        if self.points + len(freq) > MAX_POINTS:
+            raise ValueError("the pending sweep would exceed %d frequencies" % MAX_POINTS)
+        self.points += len(freq)
+        self.freq.append(freq)
+        self.zreal.append(zreal)
+        self.zimag.append(zimag)
+
+    def clear(self):
+        self.freq, self.zreal, self.zimag = [], [], []
+        self.points = 0
+
+    def take(self):
+        """
+        :return: (frequency array, complex impedance array) of the pending sweep, which is cleared
+        """
+        import loader
+
+        freq = np.concatenate(self.freq) if self.freq else np.zeros(0)
+        Z = loader.impedance(np.concatenate(self.zreal) if self.zreal else np.zeros(0),
+                             np.concatenate(self.zimag) if self.zimag else np.zeros(0))
+        self.clear()
+        return freq, Z
+
+
+class Connection(object):
+    """
+    Writer of one client connection and the number of its fits not yet answered
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.outstanding = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def queued(self):
+        self.outstanding += 1
+        self.idle.clear()
+
+    def answered(self):
+        self.outstanding -= 1
+        if self.outstanding == 0:
+            self.idle.set()
+
+
+class FitService(object):
+    """
+    Queue, channels and workers of one running service
+    """
+
+    def __init__(self, modelName, workers=1, queue_size=QUEUE_SIZE, backend=None, transform=None):
+        self.modelName = modelName
+        self.workers = workers
+        self.queue_size = queue_size
+        self.backend = backend
+        self.transform = transform
+        self.channels = {}
+        self.queue = None
+        self.executor = None
+
+    async def handle(self, reader, writer):
+        """
+        Read the messages of one connection; fits are queued, answers written
+        by the workers.  The connection is closed once the client has closed
+        its side and every queued fit has been answered.
+        """
+        connection = Connection(writer)
+        try:
+            await self.read(reader, writer, connection)
+            await connection.idle.wait()
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def read(self, reader, writer, connection):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            message, channel = None, None
+            try:
+                message = json.loads(line)
+                if not isinstance(message, dict):
+                    raise ValueError("a message must be a JSON object")
+                channelName = str(message.get('channel', ''))
+                channel = self.channels.setdefault(channelName, Channel())
+                channel.add(message)
+            except (ValueError, KeyError, TypeError) as e:
+                if channel is not None:
+                    # 丢弃不完整的谱图，下一次扫描重新开始
+                    channel.clear()
+                reply = message if isinstance(message, dict) else {}
+                self.send(writer, {'channel': reply.get('channel'), 'id': reply.get('id'),
+                                   'error': '%s: %s' % (type(e).__name__, e)})
+                continue
+            if message.get('final', True):
+                freq, Z = channel.take()
+                if len(freq) == 0:
+                    self.send(writer, {'channel': channelName, 'id': message.get('id'),
+                                       'error': "ValueError: the sweep holds no frequencies"})
+                    continue
+                # a full queue blocks here, and with it the reading of this connection
+                connection.queued()
+                await self.queue.put((channel, channelName, message.get('id'), message.get('potential'),
+                                      freq, Z, connection, time.perf_counter()))
+
+    def send(self, writer, answer):
+        if not writer.is_closing():
+            writer.write((json.dumps(answer) + '\n').encode('utf-8'))
+
+    async def work(self):
+        """
+        Take queued sweeps and fit them in the executor, one at a time.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            channel, channelName, msgId, potential, freq, Z, connection, queued = await self.queue.get()
+            answer = {'channel': channelName, 'id': msgId, 'potential': potential, 'points': len(freq)}
+            try:
+                async with channel.lock:
+                    start = time.perf_counter()
+                    keys, params, cost, nfev, ier, warm = await loop.run_in_executor(
+                        self.executor, fit_job, self.modelName, freq, Z, channel.params, channel.cost,
+                        self.backend, self.transform)
+                    channel.params, channel.cost = params, cost
+                answer.update({'params': dict(zip(keys, params)), 'cost': cost, 'nfev': nfev, 'ier': ier,
+                               'warm_start': warm, 'queue_s': start - queued,
+                               'fit_s': time.perf_counter() - start})
+            except Exception as e:
+                answer['error'] = '%s: %s' % (type(e).__name__, e)
+            finally:
+                self.queue.task_done()
+            self.send(connection.writer, answer)
+            try:
+                await connection.writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                connection.answered()
+
+    async def run(self, host='127.0.0.1', port=PORT, path=None, started=None):
+        """
+        :param path: Unix socket to listen on instead of host:port
+        :param started: optional callable(server) called once listening
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.queue = asyncio.Queue(self.queue_size)
+        with ProcessPoolExecutor(max_workers=self.workers) as self.executor:
+            tasks = [asyncio.ensure_future(self.work()) for _ in range(self.workers)]
+            if path:
+                server = await asyncio.start_unix_server(self.handle, path, limit=LINE_LIMIT)
+            else:
+                server = await asyncio.start_server(self.handle, host, port, limit=LINE_LIMIT)
+            if started is not None:
+                started(server)
+            try:
+                async with server:
+                    await server.serve_forever()
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+
+def parse_address(address):
+    """
+    :param address: "port", "host:port" or a Unix socket path (holding a '/')
+    :return: (host, port, path)
+    """
+    if '/' in address:
+        return None, None, address
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port or PORT), None
+
+
+def serve(modelName, address=str(PORT), workers=1, queue_size=QUEUE_SIZE, backend=None, transform=None):
+    """
+    Run the service until interrupted.
+    :param modelName: model script name in Models/ or a circuit string
+    :param address: see parse_address
+    :param workers: fitting processes
+    """
+    host, port, path = parse_address(address)
+    service = FitService(modelName, workers, queue_size, backend, transform)
+
+    def started(server):
+        print("fitting %s on %s" % (modelName, path or '%s:%d' % (host, port)))
+
+    try:
+        asyncio.run(service.run(host, port, path, started))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _demo(modelName, host, port, path, channels, spectra, chunk, noise, seed):
+    from Models.registry import get_model
+
+    model = get_model(modelName)
+    rng = np.random.default_rng(seed)
+    freq = np.logspace(5, -1, 60)
+    if path:
+        reader, writer = await asyncio.open_unix_connection(path, limit=LINE_LIMIT)
+    else:
+        reader, writer = await asyncio.open_connection(host, port, limit=LINE_LIMIT)
+    answers = []
+
+    async def receive():
+        for _ in range(channels * spectra):
+            line = await reader.readline()
+            if not line:
+                break
+            answers.append(json.loads(line))
+            print(line.decode('utf-8').rstrip())
+
+    receiver = asyncio.ensure_future(receive())
+    for k in range(spectra):
+        for c in range(channels):
+            # parameters drift slowly over the sweep, as over a potential scan
+            params = model.init_val * (1 + 0.02 * k) * (1 + 0.1 * c)
+            Z = model.model(2 * np.pi * freq, params)
+            Z = Z * (1 + noise * (rng.standard_normal(len(Z)) + 1j * rng.standard_normal(len(Z))))
+            for s in range(0, len(freq), chunk):
+                part = slice(s, s + chunk)
+                message = {'channel': 'ch%d' % c, 'id': k, 'potential': 0.01 * k,
+                           'freq': freq[part].tolist(), 'zreal': Z.real[part].tolist(),
+                           'zimag': (-Z.imag[part]).tolist(), 'final': s + chunk >= len(freq)}
+                writer.write((json.dumps(message) + '\n').encode('utf-8'))
+                await writer.drain()
+    await receiver
+    writer.close()
+    await writer.wait_closed()
+    return answers
+
+
+def demo(modelName, address=str(PORT), channels=2, spectra=10, chunk=20, noise=1e-3, seed=0):
+    """
+    Stand-in for a potentiostat: send spectra computed from the model with
+    drifting parameters and relative noise, chunk frequencies per message,
+    and print the answers.
+    :return: list of the answers
+    """
+    host, port, path = parse_address(address)
+    return asyncio.run(_demo(modelName, host, port, path, channels, spectra, chunk, noise, seed))
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) < 2 or sys.argv[1] != 'demo':
+        print("usage: py service.py demo [model] [address]")
+        sys.exit(2)
+    demo(sys.argv[2] if len(sys.argv) > 2 else "R(Q(RW))", sys.argv[3] if len(sys.argv) > 3 else str(PORT))
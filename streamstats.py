@@ -0,0 +1,169 @@
+"""
+Streaming per-potential statistics of the fitted parameters
+
+StreamingStats is fed one result at a time while a batch runs and keeps, per
+potential and column, the count, mean and variance (Welford's update),
+min/max and the 25/50/75% quantiles (P-square estimates, Jain & Chlamtac
+1985).  Memory does not grow with the number of files, nothing has to be
+re-read at the end, and frame() can be called at any time for the
+statistics so far.  frame() has the layout of
+DataFrame.groupby('potential').describe(), which statstistic.txt used to be
+written from.
+
+Up to P2Quantile.EXACT values per group the quantiles are exact, with linear
+interpolation as in pandas; beyond that they are estimates.
+"""
+
+from bisect import bisect_right
+from collections import OrderedDict
+
+import numpy as np
+
+STATISTICS = ['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
+
+
+class P2Quantile(object):
+    """
+    P-square estimate of the p-quantile of a stream, in constant memory.  The
+    first EXACT values are kept and give the exact quantile; the five markers
+    of the estimator are then placed on their order statistics.
+    """
+
+    EXACT = 50
+
+    def __init__(self, p):
+        self.p = p
+        # marker heights, or the values seen so far until the markers are set up
+        self.q = []
+        self.n = None
+        self.step = [0.0, p / 2, p, (1 + p) / 2, 1.0]
+
+    def _start(self):
+        values = sorted(self.q)
+        last = len(values) - 1
+        self.desired = [last * fraction for fraction in self.step]
+        self.n = [int(round(position)) for position in self.desired]
+        self.q = [values[position] for position in self.n]
+
+    def add(self, x):
+        if self.n is None:
+            self.q.append(x)
+            if len(self.q) <= self.EXACT:
+                return
+            self.q.pop()
+            self._start()
+        q, n = self.q, self.n
+        if x < q[0]:
+            q[0] = x
+        elif x > q[4]:
+            q[4] = x
+        # cell k holds x: q[k] <= x < q[k+1]
+        k = min(max(bisect_right(q, x) - 1, 0), 3)
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.step[i]
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                h = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                    (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < h < q[i + 1]:
+                    h = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = h
+                n[i] += d
+
+    def value(self):
+        if self.n is None:
+            return np.percentile(self.q, 100 * self.p) if self.q else np.nan
+        return self.q[2]
+
+
+class _Group(object):
+    """
+    Running statistics of every column of one potential.
+    """
+
+    def __init__(self, n_columns, quantiles):
+        self.count = np.zeros(n_columns, dtype=np.int64)
+        self.mean = np.zeros(n_columns)
+        self.m2 = np.zeros(n_columns)
+        self.min = np.full(n_columns, np.inf)
+        self.max = np.full(n_columns, -np.inf)
+        self.quantiles = [[P2Quantile(p) for p in quantiles] for _ in range(n_columns)]
+
+    def add(self, x):
+        # NaN parameters (failed fits) are left out, as describe() does
+        ok = ~np.isnan(x)
+        self.count += ok
+        delta = np.where(ok, x - self.mean, 0.0)
+        self.mean += np.where(ok, delta / np.maximum(self.count, 1), 0.0)
+        self.m2 += np.where(ok, delta * (x - self.mean), 0.0)
+        self.min = np.where(ok, np.fmin(self.min, x), self.min)
+        self.max = np.where(ok, np.fmax(self.max, x), self.max)
+        for k in np.flatnonzero(ok):
+            for estimator in self.quantiles[k]:
+                estimator.add(float(x[k]))
+
+    def describe(self):
+        """
+        :return: (n_columns, len(STATISTICS)) array
+        """
+        count = self.count.astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.sqrt(self.m2 / (count - 1))
+        std[count < 2] = np.nan
+        empty = count == 0
+        mean, lo, hi = self.mean.copy(), self.min.copy(), self.max.copy()
+        mean[empty] = lo[empty] = hi[empty] = np.nan
+        q = np.array([[estimator.value() for estimator in column] for column in self.quantiles])
+        return np.column_stack([count, mean, std, lo, q, hi])
+
+
+class StreamingStats(object):
+    """
+    Per-potential describe() statistics, updated one result at a time.
+    """
+
+    def __init__(self, decimals=3):
+        """
+        :param decimals: potentials are grouped after rounding to this many decimals
+        """
+        self.decimals = decimals
+        self.columns = None
+        self.groups = OrderedDict()
+        self.n = 0
+
+    def add(self, potential, values):
+        """
+        :param potential: potential of the fitted file
+        :param values: OrderedDict of column name -> value; the columns of the
+                       first call are used for all later ones
+        """
+        if self.columns is None:
+            self.columns = list(values)
+        key = round(float(potential), self.decimals)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = _Group(len(self.columns), (0.25, 0.5, 0.75))
+        group.add(np.array([values[name] for name in self.columns], dtype=np.float64))
+        self.n += 1
+
+    def __len__(self):
+        return self.n
+
+    def frame(self):
+        """
+        :return: DataFrame indexed by potential (sorted), with (column, statistic) columns
+        """
+        import pandas as pd
+
+        columns = pd.MultiIndex.from_product([self.columns or [], STATISTICS])
+        keys = sorted(self.groups)
+        data = np.array([self.groups[key].describe().ravel() for key in keys]).reshape(len(keys), len(columns))
+        return pd.DataFrame(data, index=pd.Index(keys, name='potential'), columns=columns)
+
+    def write(self, filename):
+        self.frame().to_csv(filename, sep='\t')